@@ -103,3 +103,22 @@ def pixelToGeo(x, y, bbox, width, height):
     y_g = bbox[3] - ((bbox[3]-bbox[1]) / height)*y
 
     return (x_g, y_g)
+
+# CRSs with latitude first axis order from WMS 1.3.0
+LAT_LON_ORDER_CRSS = ['EPSG:4326']
+
+def isLatLonOrderCrs(version, crs):
+    """
+    Return True if bounding boxes and coordinates in crs are given in
+    (lat, lon) order in this WMS version.
+
+    """
+    return ((version != '1.1.1') and (crs.upper() in LAT_LON_ORDER_CRSS))
+
+def swapAxes(bbox):
+    """
+    Return bbox with its x and y axes swapped.
+
+    """
+    (xmin, ymin, xmax, ymax) = bbox
+    return (ymin, xmin, ymax, xmax)
@@ -0,0 +1,860 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Bounded, thread-safe caches used by the COWS services.
+
+The main class is :class:`LRUCache`, an in-memory cache with a budget in
+bytes and/or entries.  The size of each value is estimated from the numpy
+arrays it holds (see :func:`estimateSize`) so that the budget reflects the
+memory actually retained by cached layer slabs.
+
+Values may be placed in a named group (e.g. a layer name) and each group
+can be given its own byte quota so that one busy layer cannot evict
+everything else.  Entries may also be given a time to live.
+
+Caches that can be shared between processes are provided by
+:class:`DiskCache`, which stores pickled values with their numpy arrays
+in memory-mapped .npy files, and :class:`MemcachedCache`.  These are
+normally placed behind a local :class:`LRUCache` using :class:`TieredCache`.
+Values stored in a shared cache must be pickleable.
+
+:class:`SingleFlight` collapses concurrent computations of the same value
+into one so that simultaneous cache misses don't repeat expensive work.
+
+This module must not reference pylons.  Use :func:`cacheFromConfig` to
+build a cache from a mapping such as pylons.config.
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import logging
+import cPickle as pickle
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+try:
+    import memcache
+except ImportError:
+    memcache = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+
+# Nominal size charged for anything that isn't a numpy array or a string.
+_OBJECT_OVERHEAD = 64
+
+_SIZE_SUFFIXES = {'k': 1024, 'm': 1024**2, 'g': 1024**3}
+
+def parseSize(value):
+    """
+    Convert a size such as '512M', '2g' or '1048576' into a number of bytes.
+
+    @return: an integer or None if value is None or empty.
+
+    """
+    if value is None:
+        return None
+
+    value = str(value).strip().lower()
+    if value == '':
+        return None
+
+    if value.endswith('b'):
+        value = value[:-1]
+
+    multiplier = 1
+    if value and value[-1] in _SIZE_SUFFIXES:
+        multiplier = _SIZE_SUFFIXES[value[-1]]
+        value = value[:-1]
+
+    return int(float(value) * multiplier)
+
+def estimateSize(obj, _seen=None, _depth=0):
+    """
+    Estimate the number of bytes retained by obj.
+
+    numpy arrays (including masked arrays and cdms variables) are counted by
+    their nbytes.  Containers and object attributes are followed a few levels
+    deep so that arrays held by slabs and layer drawers are accounted for.
+    Each array is only counted once.
+
+    """
+    if _seen is None:
+        _seen = set()
+
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+
+    if numpy is not None and isinstance(obj, numpy.ndarray):
+        size = obj.nbytes
+        mask = getattr(obj, '_mask', None)
+        if isinstance(mask, numpy.ndarray) and id(mask) not in _seen:
+            _seen.add(id(mask))
+            size += mask.nbytes
+        return size
+
+    if isinstance(obj, basestring):
+        return len(obj)
+
+    if _depth > 4:
+        return _OBJECT_OVERHEAD
+
+    size = _OBJECT_OVERHEAD
+
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += estimateSize(k, _seen, _depth + 1)
+            size += estimateSize(v, _seen, _depth + 1)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for v in obj:
+            size += estimateSize(v, _seen, _depth + 1)
+    elif hasattr(obj, '__dict__'):
+        size += estimateSize(obj.__dict__, _seen, _depth + 1)
+
+    return size
+
+
+class _Entry(object):
+    __slots__ = ('key', 'value', 'size', 'group', 'hits', 'expires', 'prev', 'next')
+
+    def __init__(self, key, value, size, group, expires=None):
+        self.key = key
+        self.value = value
+        self.size = size
+        self.group = group
+        self.expires = expires
+        self.hits = 0
+        self.prev = self.next = None
+
+
+class LRUCache(object):
+    """
+    A thread-safe cache bounded by total size and/or number of entries.
+
+    :ivar maxBytes: The byte budget or None for no limit.
+    :ivar maxEntries: The maximum number of entries or None for no limit.
+    :ivar policy: 'lru' evicts the least recently used entry, 'lfu' evicts
+        the least frequently used entry (ties broken by recency).
+    :ivar groupMaxBytes: The byte quota of each group or None for no quota.
+    :ivar ttl: The time to live of entries in seconds or None for no expiry.
+
+    """
+
+    policies = ['lru', 'lfu']
+
+    def __init__(self, maxBytes=None, maxEntries=None, policy='lru',
+                 groupMaxBytes=None, ttl=None, sizeFunc=estimateSize):
+
+        if policy not in self.policies:
+            raise ValueError("Cache policy %s not recognised, use one of %s"
+                             % (policy, self.policies))
+
+        self.maxBytes = maxBytes
+        self.maxEntries = maxEntries
+        self.policy = policy
+        self.groupMaxBytes = groupMaxBytes
+        self.ttl = ttl
+        self.sizeFunc = sizeFunc
+
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._groupBytes = {}
+        self._bytes = 0
+
+        # Sentinel of a circular doubly linked list ordered from most to
+        # least recently used.
+        self._head = _Entry(None, None, 0, None)
+        self._head.prev = self._head.next = self._head
+
+        self.hits = self.misses = self.evictions = self.rejections = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """
+        Return the value cached for key, or default if there isn't one.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry.expires is not None and \
+                   entry.expires < time.time():
+                self.expirations += 1
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            entry.hits += 1
+            self._unlink(entry)
+            self._linkFront(entry)
+            return entry.value
+        finally:
+            self._lock.release()
+
+    def put(self, key, value, group=None):
+        """
+        Store value under key, evicting older entries to stay within budget.
+
+        @param group: An optional group name (e.g. a layer name) used to
+            enforce self.groupMaxBytes.
+        @return: True if the value was cached.  Values larger than the whole
+            budget are not cached.
+
+        """
+        size = self.sizeFunc(value)
+
+        self._lock.acquire()
+        try:
+            self._remove(key)
+
+            if ((self.maxBytes is not None and size > self.maxBytes) or
+                (group is not None and self.groupMaxBytes is not None and
+                 size > self.groupMaxBytes)):
+                log.debug("Not caching %s, size %s exceeds budget" % (key, size))
+                self.rejections += 1
+                return False
+
+            if self.ttl is not None:
+                expires = time.time() + self.ttl
+            else:
+                expires = None
+
+            entry = _Entry(key, value, size, group, expires)
+            self._entries[key] = entry
+            self._linkFront(entry)
+            self._bytes += size
+            if group is not None:
+                self._groupBytes[group] = self._groupBytes.get(group, 0) + size
+
+            self._enforceLimits(entry)
+            return True
+        finally:
+            self._lock.release()
+
+    def remove(self, key):
+        """
+        Remove key from the cache if present.
+        """
+        self._lock.acquire()
+        try:
+            self._remove(key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._groupBytes.clear()
+            self._bytes = 0
+            self._head.prev = self._head.next = self._head
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def getStats(self):
+        """
+        :return: A dictionary of counters describing the cache.
+        """
+        self._lock.acquire()
+        try:
+            lookups = self.hits + self.misses
+            if lookups > 0:
+                hitRatio = float(self.hits) / lookups
+            else:
+                hitRatio = 0.0
+
+            return dict(hits=self.hits, misses=self.misses,
+                        evictions=self.evictions, rejections=self.rejections,
+                        expirations=self.expirations,
+                        entries=len(self._entries), bytes=self._bytes,
+                        maxBytes=self.maxBytes, maxEntries=self.maxEntries,
+                        hitRatio=hitRatio)
+        finally:
+            self._lock.release()
+
+    #-------------------------------------------------------------------------
+
+    def _enforceLimits(self, newEntry):
+        group = newEntry.group
+
+        if group is not None and self.groupMaxBytes is not None:
+            while self._groupBytes[group] > self.groupMaxBytes:
+                self._evict(self._findVictim(group, newEntry))
+
+        while ((self.maxBytes is not None and self._bytes > self.maxBytes) or
+               (self.maxEntries is not None and len(self._entries) > self.maxEntries)):
+            self._evict(self._findVictim(None, newEntry))
+
+    def _findVictim(self, group, exclude):
+        """
+        Choose the entry to evict, optionally restricted to a group.  The
+        entry just inserted is only chosen if nothing else qualifies.
+        """
+        victim = None
+        entry = self._head.prev
+
+        while entry is not self._head:
+            if entry is not exclude and (group is None or entry.group == group):
+                if self.policy == 'lru':
+                    return entry
+                if victim is None or entry.hits < victim.hits:
+                    victim = entry
+            entry = entry.prev
+
+        if victim is None:
+            victim = exclude
+
+        return victim
+
+    def _evict(self, entry):
+        log.debug("Evicting %s (%s bytes)" % (entry.key, entry.size))
+        self.evictions += 1
+        self._remove(entry.key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+
+        if entry is None:
+            return
+
+        self._unlink(entry)
+        self._bytes -= entry.size
+
+        if entry.group is not None:
+            remaining = self._groupBytes[entry.group] - entry.size
+            if remaining > 0:
+                self._groupBytes[entry.group] = remaining
+            else:
+                del self._groupBytes[entry.group]
+
+    def _linkFront(self, entry):
+        entry.prev = self._head
+        entry.next = self._head.next
+        self._head.next.prev = entry
+        self._head.next = entry
+
+    def _unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+        entry.prev = entry.next = None
+
+
+def _hashKey(key):
+    return sha1(str(key)).hexdigest()
+
+
+class DiskCache(object):
+    """
+    A cache of pickled values in a directory, which may be shared by
+    several processes.
+
+    numpy arrays within a value are written to separate .npy files and
+    are memory-mapped read-only when the value is loaded, so a cached slab
+    costs little resident memory until it is rendered.
+
+    :ivar directory: The cache directory.
+    :ivar maxBytes: If not None the oldest entries are pruned when the
+        directory grows beyond this size.
+
+    """
+
+    _pruneInterval = 50
+
+    def __init__(self, directory, maxBytes=None):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = self.misses = self.evictions = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, key, default=None):
+        path = self._path(key)
+
+        try:
+            fh = open(os.path.join(path, 'value.pkl'), 'rb')
+        except IOError:
+            self.misses += 1
+            return default
+
+        try:
+            unpickler = pickle.Unpickler(fh)
+            unpickler.persistent_load = lambda pid: \
+                numpy.load(os.path.join(path, pid), mmap_mode='r')
+            try:
+                value = unpickler.load()
+            except Exception:
+                log.exception("Failed to load cache entry %s" % (path,))
+                self.misses += 1
+                return default
+        finally:
+            fh.close()
+
+        self.hits += 1
+        return value
+
+    def put(self, key, value, group=None):
+        path = self._path(key)
+        parent = os.path.dirname(path)
+
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                # Another process may have created it
+                pass
+
+        # Write to a temporary directory then rename so that readers in
+        # other processes never see a partially written entry.
+        tmpdir = tempfile.mkdtemp(prefix='.tmp_', dir=parent)
+        try:
+            arrays = []
+
+            def persistent_id(obj):
+                if numpy is not None and type(obj) is numpy.ndarray:
+                    name = 'array_%d.npy' % len(arrays)
+                    numpy.save(os.path.join(tmpdir, name), obj)
+                    arrays.append(name)
+                    return name
+                return None
+
+            fh = open(os.path.join(tmpdir, 'value.pkl'), 'wb')
+            try:
+                pickler = pickle.Pickler(fh, 2)
+                pickler.persistent_id = persistent_id
+                pickler.dump(value)
+            finally:
+                fh.close()
+
+            if os.path.exists(path):
+                shutil.rmtree(path, ignore_errors=True)
+            os.rename(tmpdir, path)
+        except Exception:
+            log.exception("Failed to write cache entry %s" % (path,))
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return False
+
+        self._lock.acquire()
+        try:
+            self._puts += 1
+            prune = (self.maxBytes is not None and 
+                     self._puts % self._pruneInterval == 0)
+        finally:
+            self._lock.release()
+
+        if prune:
+            self.prune()
+
+        return True
+
+    def remove(self, key):
+        shutil.rmtree(self._path(key), ignore_errors=True)
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def prune(self):
+        """
+        Remove the least recently written entries until the directory is
+        within self.maxBytes.
+        """
+        entries = []
+        total = 0
+
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            if 'value.pkl' not in filenames:
+                continue
+            size = sum(os.path.getsize(os.path.join(dirpath, f)) for f in filenames)
+            entries.append((os.path.getmtime(os.path.join(dirpath, 'value.pkl')),
+                            size, dirpath))
+            total += size
+
+        entries.sort()
+
+        for mtime, size, dirpath in entries:
+            if total <= self.maxBytes:
+                break
+            shutil.rmtree(dirpath, ignore_errors=True)
+            total -= size
+            self.evictions += 1
+
+    def getStats(self):
+        lookups = self.hits + self.misses
+        if lookups > 0:
+            hitRatio = float(self.hits) / lookups
+        else:
+            hitRatio = 0.0
+
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, maxBytes=self.maxBytes,
+                    hitRatio=hitRatio)
+
+    def _path(self, key):
+        h = _hashKey(key)
+        return os.path.join(self.directory, h[:2], h)
+
+
+class MemcachedCache(object):
+    """
+    A cache held by one or more memcached servers.  Requires the
+    python-memcached module.
+
+    Note memcached rejects values over its item size limit (1MB by
+    default), so this backend suits small slabs and encoded tiles.
+
+    :ivar servers: A list of 'host:port' strings.
+    :ivar expire: Expiry time in seconds, 0 for none.
+
+    """
+
+    def __init__(self, servers, keyPrefix='cows', expire=0):
+        if memcache is None:
+            raise ImportError("The python-memcached module is required for "
+                              "the memcached cache backend")
+
+        self.servers = servers
+        self.keyPrefix = keyPrefix
+        self.expire = expire
+        self.hits = self.misses = 0
+        self._client = memcache.Client(servers)
+
+    def get(self, key, default=None):
+        value = self._client.get(self._key(key))
+
+        if value is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return value
+
+    def put(self, key, value, group=None):
+        return bool(self._client.set(self._key(key), value, time=self.expire))
+
+    def remove(self, key):
+        self._client.delete(self._key(key))
+
+    def clear(self):
+        self._client.flush_all()
+
+    def getStats(self):
+        lookups = self.hits + self.misses
+        if lookups > 0:
+            hitRatio = float(self.hits) / lookups
+        else:
+            hitRatio = 0.0
+
+        return dict(hits=self.hits, misses=self.misses, hitRatio=hitRatio)
+
+    def _key(self, key):
+        # memcached keys are limited to 250 characters without spaces.
+        return '%s:%s' % (self.keyPrefix, _hashKey(key))
+
+
+class _SharedValue(object):
+    """
+    A value held in the shared cache of a TieredCache together with its
+    group, so the group quota still applies when it is copied to the
+    local cache.
+    """
+
+    def __init__(self, value, group):
+        self.value = value
+        self.group = group
+
+
+class TieredCache(object):
+    """
+    A local cache in front of a shared cache.  Values found in the shared
+    cache are copied to the local cache, in the group they were put with.
+
+    """
+
+    def __init__(self, local, shared):
+        self.local = local
+        self.shared = shared
+
+    def get(self, key, default=None):
+        value = self.local.get(key)
+
+        if value is None:
+            value = self.shared.get(key)
+
+            if value is None:
+                return default
+
+            group = None
+            if isinstance(value, _SharedValue):
+                value, group = value.value, value.group
+
+            self.local.put(key, value, group=group)
+
+        return value
+
+    def put(self, key, value, group=None):
+        self.local.put(key, value, group=group)
+        return self.shared.put(key, _SharedValue(value, group))
+
+    def remove(self, key):
+        self.local.remove(key)
+        self.shared.remove(key)
+
+    def clear(self):
+        self.local.clear()
+        self.shared.clear()
+
+    def __contains__(self, key):
+        return key in self.local
+
+    def __len__(self):
+        return len(self.local)
+
+    def getStats(self):
+        stats = self.local.getStats()
+
+        for k, v in self.shared.getStats().items():
+            stats['shared' + k[0].upper() + k[1:]] = v
+
+        return stats
+
+
+class SingleFlightTimeout(Exception):
+    """
+    Raised when waiting for another thread's call exceeds the timeout.
+    """
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.excInfo = None
+
+
+class SingleFlight(object):
+    """
+    Ensures only one call per key is in progress at a time.  Threads
+    requesting a key that is already being computed wait for that call
+    and receive its result, or its exception.
+
+    :ivar timeout: Seconds a waiting thread will wait before raising
+        SingleFlightTimeout, or None to wait indefinitely.
+
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.calls = self.shared = self.timeouts = 0
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Return func(*args, **kwargs), sharing the result with any
+        concurrent call using the same key.
+        """
+        self._lock.acquire()
+        try:
+            call = self._calls.get(key)
+            isLeader = call is None
+            if isLeader:
+                call = _Call()
+                self._calls[key] = call
+                self.calls += 1
+            else:
+                self.shared += 1
+        finally:
+            self._lock.release()
+
+        if isLeader:
+            try:
+                call.result = func(*args, **kwargs)
+            except:
+                call.excInfo = sys.exc_info()
+                raise
+            finally:
+                self._lock.acquire()
+                try:
+                    del self._calls[key]
+                finally:
+                    self._lock.release()
+                call.event.set()
+
+            return call.result
+
+        log.debug("Waiting for call in progress for %s" % (key,))
+        call.event.wait(self.timeout)
+
+        if not call.event.isSet():
+            self.timeouts += 1
+            raise SingleFlightTimeout("Timed out after %ss waiting for %s"
+                                      % (self.timeout, key))
+
+        if call.excInfo is not None:
+            raise call.excInfo[0], call.excInfo[1], call.excInfo[2]
+
+        return call.result
+
+    def getStats(self):
+        return dict(calls=self.calls, shared=self.shared, timeouts=self.timeouts)
+
+
+def getLastModified(paths):
+    """
+    Return the latest modification time of paths, ignoring any that don't
+    exist, or None if none exist.  Used to validate cached documents
+    derived from files.
+    """
+    lastModified = None
+    for path in paths:
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue
+        if lastModified is None or mtime > lastModified:
+            lastModified = mtime
+
+    return lastModified
+
+
+def requestCacheKey(context, params, bbox=None):
+    """
+    Build a cache key for the response to an OWS request such as a GetMap
+    or GetLegend.  Every parameter can affect the response so the key is
+    the sorted parameter list, with the bbox normalised because tile
+    bboxes computed from a grid differ from the client's in the last few
+    digits.
+
+    @param context: A tuple of whatever else identifies the response, e.g.
+        the controller and the modification time of the layer sources.
+    @param params: A mapping of parameter names to values.
+    @param bbox: If given, the key of the same request for this bbox.
+    :return: A string.
+    """
+    items = []
+    for k, v in sorted(params.items()):
+        if k == 'bbox':
+            try:
+                if bbox is None:
+                    bbox = [float(x) for x in v.split(',')]
+                v = tuple(float('%.10g' % x) for x in bbox)
+            except ValueError:
+                pass
+        items.append((k, v))
+
+    return repr((tuple(context), items))
+
+
+def isCacheable(layerArgs):
+    """
+    Return whether the response rendered from some layers may be cached.
+    A layer whose getCacheKey() returns None doesn't want its slabs
+    cached, e.g. because its data changes without notice, so images drawn
+    from it mustn't be cached either.
+
+    @param layerArgs: A list of tuples of a layer and the arguments of its
+        getCacheKey() method.
+    :return: True if every layer has a cache key.
+    """
+    for args in layerArgs:
+        if args[0].getCacheKey(*args[1:]) is None:
+            return False
+
+    return True
+
+
+def cacheFromConfig(conf, prefix, maxBytes=None, maxEntries=None,
+                    policy='lru', groupMaxBytes=None, ttl=None):
+    """
+    Create a cache from options in a configuration mapping.
+
+    The following options are read, each prefixed with prefix + '.'::
+
+        max_bytes        : byte budget, e.g. 512M (default maxBytes)
+        max_entries      : maximum number of entries (default maxEntries)
+        policy           : lru or lfu (default policy)
+        group_max_bytes  : per group byte quota (default groupMaxBytes)
+        ttl              : time to live in seconds (default ttl)
+        backend          : memory (default), disk or memcached
+        dir              : directory of the disk backend
+        shared_max_bytes : size limit of the disk backend
+        servers          : comma separated host:port list for memcached
+        expire           : memcached expiry time in seconds
+
+    With the disk or memcached backend the shared cache sits behind a
+    local in-memory cache configured as above.
+
+    @param conf: A mapping, usually pylons.config.
+    @param prefix: The option prefix, e.g. 'cows.wms.slab_cache'.
+
+    """
+    def opt(name, default=None):
+        value = conf.get('%s.%s' % (prefix, name))
+        if value is None or str(value).strip() == '':
+            return default
+        return value
+
+    maxEntries = opt('max_entries', maxEntries)
+    if maxEntries is not None:
+        maxEntries = int(maxEntries)
+
+    ttl = opt('ttl', ttl)
+    if ttl is not None:
+        ttl = float(ttl)
+
+    local = LRUCache(maxBytes=parseSize(opt('max_bytes', maxBytes)),
+                     maxEntries=maxEntries,
+                     policy=str(opt('policy', policy)).lower(),
+                     groupMaxBytes=parseSize(opt('group_max_bytes', groupMaxBytes)),
+                     ttl=ttl)
+
+    backend = str(opt('backend', 'memory')).lower()
+
+    if backend == 'memory':
+        return local
+    elif backend == 'disk':
+        directory = opt('dir')
+        if directory is None:
+            raise ValueError("%s.dir must be set for the disk cache backend" % prefix)
+        shared = DiskCache(directory, maxBytes=parseSize(opt('shared_max_bytes')))
+    elif backend == 'memcached':
+        servers = [x.strip() for x in str(opt('servers', '127.0.0.1:11211')).split(',')]
+        shared = MemcachedCache(servers, keyPrefix=prefix,
+                                expire=int(opt('expire', 0)))
+    else:
+        raise ValueError("Cache backend %s not recognised" % backend)
+
+    log.info("Using %s cache backend for %s" % (backend, prefix))
+
+    return TieredCache(local, shared)
@@ -45,3 +45,7 @@ class NoApplicableCode(OwsError):
     def __init__(self, text, locator=None):
         OwsError.__init__(self, 'NoApplicableCode', text, locator)
 
+
+class TileOutOfRange(OwsError):
+    def __init__(self, text, locator=None):
+        OwsError.__init__(self, 'TileOutOfRange', text, locator)
@@ -0,0 +1,243 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Encoding of rendered PIL images into the image formats served by COWS.
+
+Map tiles usually contain few colours, particularly for discrete colour
+maps, so PNG and GIF images are written as 8-bit paletted images whenever
+the colours fit in the palette.  This is typically several times smaller
+than a full RGBA PNG.
+
+This module must not reference pylons.  Use :func:`encoderFromConfig` to
+build an encoder from a mapping such as pylons.config.
+
+"""
+
+from cStringIO import StringIO
+import logging
+log = logging.getLogger(__name__)
+
+import numpy
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+# Mime-types supported by ImageEncoder and the corresponding PIL format
+PIL_FORMATS = {
+    'image/png': 'PNG',
+    'image/jpeg': 'JPEG',
+    'image/jpg': 'JPEG',
+    'image/gif': 'GIF',
+    'image/tiff': 'TIFF'
+    }
+
+# zlib compression strategies accepted by the PIL PNG encoder
+ZLIB_STRATEGIES = {
+    'default': 0,
+    'filtered': 1,
+    'huffman_only': 2,
+    'rle': 3,
+    'fixed': 4
+    }
+
+def parseColour(colour):
+    """
+    Convert a WMS BGCOLOR value (0xRRGGBB) or a #RRGGBB string to an
+    (r, g, b) tuple.
+    """
+    if colour.startswith('0x') or colour.startswith('0X'):
+        colour = colour[2:]
+    elif colour.startswith('#'):
+        colour = colour[1:]
+
+    value = int(colour, 16)
+    return ((value >> 16) & 0xff, (value >> 8) & 0xff, value & 0xff)
+
+def _rgbaArray(pilImage):
+    width, height = pilImage.size
+    a = numpy.fromstring(pilImage.convert('RGBA').tostring(), dtype=numpy.uint8)
+    return a.reshape((height, width, 4))
+
+def toPaletteImage(pilImage, maxColours=256):
+    """
+    Convert an image to an exactly equivalent paletted ('P' mode) image.
+
+    Only fully opaque and fully transparent pixels can be represented.
+    All transparent pixels share one palette entry which is recorded in
+    the image's 'transparency' info.
+
+    :return: The paletted image or None if the image has more than
+        maxColours colours or partially transparent pixels.
+    """
+    if pilImage.mode == 'P':
+        return pilImage
+
+    # getcolors() returns None as soon as it finds too many colours
+    if pilImage.getcolors(maxColours) is None:
+        return None
+
+    width, height = pilImage.size
+    rgba = _rgbaArray(pilImage)
+    alpha = rgba[:, :, 3]
+
+    transparent = (alpha == 0)
+    if not numpy.all(transparent | (alpha == 255)):
+        return None
+
+    # Pack each pixel into one integer, transparent pixels have the same value
+    packed = (rgba[:, :, 0].astype(numpy.uint32) << 16) | \
+             (rgba[:, :, 1].astype(numpy.uint32) << 8) | \
+             rgba[:, :, 2].astype(numpy.uint32)
+    packed[transparent] = 0x1000000
+
+    colours, indices = numpy.unique(packed.ravel(), return_inverse=True)
+
+    palette = []
+    for colour in colours:
+        colour = int(colour) & 0xffffff
+        palette.extend(((colour >> 16) & 0xff, (colour >> 8) & 0xff, colour & 0xff))
+
+    # The transparent entry sorts last.  The PIL encoders ignore a
+    # transparency index of 0 so make sure it isn't the only entry.
+    transparentIndex = None
+    if colours[-1] == 0x1000000:
+        if len(colours) == 1:
+            palette[0:0] = [0, 0, 0]
+            indices = indices + 1
+        transparentIndex = len(palette) / 3 - 1
+
+    paletteImage = Image.fromstring('P', (width, height),
+                                    indices.astype(numpy.uint8).tostring())
+    paletteImage.putpalette(palette)
+    if transparentIndex is not None:
+        paletteImage.info['transparency'] = transparentIndex
+
+    return paletteImage
+
+def flattenImage(pilImage, background=(255, 255, 255)):
+    """
+    Composite an image over a solid background colour and return an
+    RGB image.
+    """
+    if pilImage.mode == 'RGB':
+        return pilImage
+
+    if pilImage.mode != 'RGBA':
+        pilImage = pilImage.convert('RGBA')
+
+    flat = Image.new('RGB', pilImage.size, background)
+    flat.paste(pilImage, None, pilImage)
+    return flat
+
+def composeImages(images):
+    """
+    Alpha blend a list of images of the same size with the first image on
+    top.  Each image is blended under those above it in the same way as
+    Image.composite(upper, image, upper), so all four bands are weighted by
+    the alpha of the layers above.
+
+    :return: An RGBA image.
+    """
+    images = [img.convert('RGBA') for img in images]
+    if len(images) == 1:
+        return images[0]
+
+    width, height = images[0].size
+    composed = numpy.zeros((height, width, 4), dtype=numpy.float32)
+
+    for img in images:
+        cover = composed[:, :, 3:] / 255
+        composed += (_rgbaArray(img) - composed) * (1 - cover)
+
+    composed += 0.5
+    return Image.fromstring('RGBA', (width, height),
+                            composed.astype(numpy.uint8).tostring())
+
+class ImageEncoder(object):
+    """
+    Encodes PIL images as strings of bytes in a given mime-type.
+
+    :ivar palette: Write PNG and GIF images as paletted images when possible.
+    :ivar maxColours: The most colours to put in a palette.
+    :ivar compressLevel: The zlib compression level for PNG, 0-9.
+    :ivar strategy: The zlib strategy for PNG, a key of ZLIB_STRATEGIES.
+    :ivar jpegQuality: The JPEG quality, 1-95.
+
+    """
+
+    def __init__(self, palette=True, maxColours=256, compressLevel=6,
+                 strategy='default', jpegQuality=85):
+        if strategy not in ZLIB_STRATEGIES:
+            raise ValueError("Unknown zlib strategy %r" % (strategy,))
+
+        self.palette = palette
+        self.maxColours = min(int(maxColours), 256)
+        self.compressLevel = int(compressLevel)
+        self.strategy = strategy
+        self.jpegQuality = int(jpegQuality)
+
+    def encode(self, pilImage, format, opaque=False, background=(255, 255, 255)):
+        """
+        Encode an image in the given mime-type.
+
+        @param pilImage: The image, usually in 'RGBA' mode.
+        @param format: A key of PIL_FORMATS.
+        @param opaque: True if the image must be written without
+            transparency, for instance for a GetMap request with
+            TRANSPARENT=FALSE.
+        @param background: The colour that transparent areas are flattened
+            onto for opaque images and formats without transparency (JPEG).
+        :return: The image as a string.
+        """
+        pilFormat = PIL_FORMATS[format]
+        options = {}
+
+        if opaque or pilFormat == 'JPEG':
+            pilImage = flattenImage(pilImage, background)
+
+        if pilFormat in ('PNG', 'GIF') and self.palette:
+            paletteImage = toPaletteImage(pilImage, self.maxColours)
+            if paletteImage is not None:
+                pilImage = paletteImage
+                if 'transparency' in pilImage.info:
+                    options['transparency'] = pilImage.info['transparency']
+            else:
+                log.debug("too many colours for a palette, writing %s" % pilImage.mode)
+
+        if pilFormat == 'PNG':
+            options['compress_level'] = self.compressLevel
+            options['compress_type'] = ZLIB_STRATEGIES[self.strategy]
+        elif pilFormat == 'JPEG':
+            options['quality'] = self.jpegQuality
+
+        buf = StringIO()
+        pilImage.save(buf, pilFormat, **options)
+        return buf.getvalue()
+
+def encoderFromConfig(conf, prefix):
+    """
+    Create an ImageEncoder from options in a configuration mapping.
+
+    Recognised options (all optional) are <prefix>.png_palette (true),
+    <prefix>.png_max_colours (256), <prefix>.png_compress_level (6),
+    <prefix>.png_strategy (default, filtered, huffman_only, rle or fixed)
+    and <prefix>.jpeg_quality (85).
+
+    @param conf: A mapping, usually pylons.config.
+    @param prefix: The option name prefix, e.g. 'cows.wms.image'.
+    """
+    def get(name, default):
+        return conf.get('%s.%s' % (prefix, name), default)
+
+    return ImageEncoder(
+        palette=str(get('png_palette', 'true')).lower() == 'true',
+        maxColours=get('png_max_colours', 256),
+        compressLevel=get('png_compress_level', 6),
+        strategy=str(get('png_strategy', 'default')).lower(),
+        jpegQuality=get('jpeg_quality', 85))
@@ -0,0 +1,308 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+A registry of counters and histograms exposed in the Prometheus text
+exposition format.
+
+Counters and histograms keep a separate shard of values for each thread
+so updating them takes no lock.  The shards are summed when the metrics
+are collected.  Values that already exist elsewhere, such as cache
+statistics, are read at collection time by collector functions.
+
+This module must not reference pylons.  See cows.pylons.metrics_controller
+for the HTTP endpoint.
+
+"""
+
+import threading
+
+class _ThreadShards(object):
+    """
+    One dictionary of values per thread.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Return the calling thread's shard.
+        """
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = {}
+            self._lock.acquire()
+            try:
+                self._shards.append(shard)
+            finally:
+                self._lock.release()
+            self._local.shard = shard
+            return shard
+
+    def sum(self):
+        """
+        Return a dictionary of the values of all the shards added together.
+        """
+        self._lock.acquire()
+        try:
+            shards = list(self._shards)
+        finally:
+            self._lock.release()
+
+        total = {}
+        for shard in shards:
+            # items() copies the shard atomically
+            for k, v in shard.items():
+                total[k] = total.get(k, 0) + v
+        return total
+
+class Counter(object):
+    """
+    A monotonically increasing count, optionally split by labels.
+
+    :ivar name: The metric name.
+    :ivar help: A description of the metric.
+    :ivar labelNames: The names of the labels, in the order their values
+        are passed to inc().
+
+    """
+    type = 'counter'
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self._shards = _ThreadShards()
+
+    def inc(self, labelValues=(), amount=1):
+        shard = self._shards.get()
+        labelValues = tuple(labelValues)
+        shard[labelValues] = shard.get(labelValues, 0) + amount
+
+    def collect(self):
+        """
+        :return: A list of (name, labels, value) samples.
+        """
+        return [(self.name, zip(self.labelNames, k), v)
+                for k, v in sorted(self._shards.sum().items())]
+
+# Default histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+
+class Histogram(object):
+    """
+    Counts observations in cumulative buckets, optionally split by labels.
+
+    :ivar buckets: The upper bounds of the buckets, in increasing order.
+
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.buckets = tuple(sorted(buckets))
+        self._shards = _ThreadShards()
+
+    def observe(self, labelValues, value):
+        shard = self._shards.get()
+        labelValues = tuple(labelValues)
+
+        # Observations are stored in the first bucket they fit, or
+        # len(buckets) for +Inf, and made cumulative when collected
+        i = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            i += 1
+
+        key = (labelValues, i)
+        shard[key] = shard.get(key, 0) + 1
+        key = (labelValues, 'sum')
+        shard[key] = shard.get(key, 0) + value
+
+    def collect(self):
+        values = self._shards.sum()
+
+        labelSets = sorted(set(k[0] for k in values))
+        samples = []
+        for labelValues in labelSets:
+            labels = zip(self.labelNames, labelValues)
+            count = 0
+            for i, bound in enumerate(self.buckets + (None,)):
+                count += values.get((labelValues, i), 0)
+                if bound is None:
+                    le = '+Inf'
+                else:
+                    le = repr(bound)
+                samples.append((self.name + '_bucket', labels + [('le', le)], count))
+            samples.append((self.name + '_sum', labels, values.get((labelValues, 'sum'), 0)))
+            samples.append((self.name + '_count', labels, count))
+
+        return samples
+
+class MetricsRegistry(object):
+    """
+    Holds the metrics of a process.
+
+    Collectors are functions called at collection time that return a
+    list of (name, type, help, samples) tuples, where samples is a list
+    of (name, labels, value) as returned by Counter.collect().
+
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        self._lock.acquire()
+        try:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if existing.type != metric.type or existing.labelNames != metric.labelNames:
+                    raise ValueError("Metric %s already registered differently" % metric.name)
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+        finally:
+            self._lock.release()
+
+    def counter(self, name, help, labelNames=()):
+        """
+        Return the Counter with the given name, creating it if necessary.
+        """
+        return self._register(Counter(name, help, labelNames))
+
+    def histogram(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+        """
+        Return the Histogram with the given name, creating it if necessary.
+        """
+        return self._register(Histogram(name, help, labelNames, buckets))
+
+    def addCollector(self, collector):
+        self._lock.acquire()
+        try:
+            if collector not in self._collectors:
+                self._collectors.append(collector)
+        finally:
+            self._lock.release()
+
+    def collect(self):
+        """
+        :return: A list of (name, type, help, samples) for every metric.
+        """
+        self._lock.acquire()
+        try:
+            metrics = sorted(self._metrics.items())
+            collectors = list(self._collectors)
+        finally:
+            self._lock.release()
+
+        families = [(m.name, m.type, m.help, m.collect()) for name, m in metrics]
+        for collector in collectors:
+            families.extend(collector())
+
+        return families
+
+    def exposition(self):
+        """
+        Return all the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for name, type, help, samples in self.collect():
+            lines.append('# HELP %s %s' % (name, _escapeHelp(help)))
+            lines.append('# TYPE %s %s' % (name, type))
+            for sampleName, labels, value in samples:
+                lines.append('%s%s %s' % (sampleName, _formatLabels(labels),
+                                          _formatValue(value)))
+        return '\n'.join(lines) + '\n'
+
+def _escapeHelp(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+def _formatLabels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                          .replace('"', '\\"').replace('\n', '\\n'))
+                             for k, v in labels)
+
+def _formatValue(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+# The registry of this process
+registry = MetricsRegistry()
+
+#-----------------------------------------------------------------------------
+# Cache statistics
+
+# cows.cache getStats() keys exported for each cache
+_cacheStats = [
+    ('hits', 'cows_cache_hits_total', 'counter', 'Cache lookups that found a value.'),
+    ('misses', 'cows_cache_misses_total', 'counter', 'Cache lookups that found no value.'),
+    ('evictions', 'cows_cache_evictions_total', 'counter', 'Values evicted to respect the cache limits.'),
+    ('rejections', 'cows_cache_rejections_total', 'counter', 'Values too big to cache.'),
+    ('expirations', 'cows_cache_expirations_total', 'counter', 'Values removed when their time to live expired.'),
+    ('sharedHits', 'cows_cache_shared_hits_total', 'counter', 'Shared cache lookups that found a value.'),
+    ('sharedMisses', 'cows_cache_shared_misses_total', 'counter', 'Shared cache lookups that found no value.'),
+    ('entries', 'cows_cache_entries', 'gauge', 'Values held by the cache.'),
+    ('bytes', 'cows_cache_bytes', 'gauge', 'Estimated size of the values held by the cache.'),
+    ('maxBytes', 'cows_cache_max_bytes', 'gauge', 'The byte budget of the cache.'),
+    ]
+
+_caches = {}
+
+def registerCache(name, getCache):
+    """
+    Export the statistics of a cows.cache cache.
+
+    @param name: The value of the cache label.
+    @param getCache: A function returning the cache, or None if the cache
+        hasn't been created yet.
+    """
+    _caches[name] = getCache
+    registry.addCollector(_collectCaches)
+
+def getCaches():
+    """
+    Return a dictionary mapping the names of the registered caches that
+    have been created to the caches.
+    """
+    caches = {}
+    for name, getCache in _caches.items():
+        cache = getCache()
+        if cache is not None:
+            caches[name] = cache
+    return caches
+
+def getCacheStats():
+    """
+    Return a dictionary mapping cache names to their getStats().
+    """
+    return dict((name, cache.getStats()) for name, cache in getCaches().items())
+
+def _collectCaches():
+    stats = sorted(getCacheStats().items())
+
+    families = []
+    for key, metricName, type, help in _cacheStats:
+        samples = [(metricName, [('cache', name)], s[key])
+                   for name, s in stats if s.get(key) is not None]
+        if samples:
+            families.append((metricName, type, help, samples))
+
+    return families
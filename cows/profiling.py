@@ -0,0 +1,197 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Profiling of individual OWS requests with cProfile.
+
+OWSControllerBase profiles a request when the cows.profile.dir option is
+set and either the request has a cows_profile parameter equal to
+cows.profile.secret or it is picked at random at cows.profile.sample_rate.
+Each profile is written to its own pstats file named after the operation,
+layer and fileoruri of the request.
+
+Only the thread handling the request is profiled, so WMS renders the
+layers of a profiled GetMap in that thread rather than the layer pool.
+
+The profiles are summarised with::
+
+    cows-profile-report [options] FILE_OR_DIRECTORY...
+
+This module must not reference pylons.
+
+"""
+
+import sys
+import os
+import re
+import time
+import random
+import fnmatch
+import pstats
+from optparse import OptionParser
+
+try:
+    from cProfile import Profile
+except ImportError:
+    from profile import Profile
+
+try:
+    from hmac import compare_digest as _compareSecret
+except ImportError:
+    def _compareSecret(a, b):
+        return a == b
+
+import logging
+log = logging.getLogger(__name__)
+
+# The request parameter carrying the profiling secret
+PROFILE_PARAM = 'cows_profile'
+
+PROFILE_SUFFIX = '.pstats'
+
+def isProfileRequested(conf, paramValue):
+    """
+    Decide whether to profile a request.
+
+    @param conf: A dictionary of configuration options, e.g. pylons.config.
+    @param paramValue: The value of the request's PROFILE_PARAM or None.
+    :return: True if the request should be profiled.
+    """
+    if not conf.get('cows.profile.dir'):
+        return False
+
+    secret = conf.get('cows.profile.secret')
+    if secret and paramValue is not None and _compareSecret(str(paramValue), str(secret)):
+        return True
+
+    rate = float(conf.get('cows.profile.sample_rate', 0) or 0)
+    return rate > 0 and random.random() < rate
+
+def _cleanTag(value):
+    return re.sub(r'[^A-Za-z0-9_.:+-]+', '_', str(value))[:64]
+
+def getProfileFileName(directory, operation, layer=None, fileoruri=None):
+    """
+    Return a unique file name for a request profile.  The operation,
+    layer and fileoruri are separated by '--' so files can be selected
+    with a glob pattern, e.g. '*WMS.GetMap--temp--*'.
+    """
+    tags = [_cleanTag(x) for x in (operation, layer or '', fileoruri or '')]
+    stamp = time.strftime('%Y%m%dT%H%M%S', time.localtime())
+    name = '%s--%s-%d-%06d%s' % ('--'.join(tags), stamp, os.getpid(),
+                                 random.randint(0, 999999), PROFILE_SUFFIX)
+    return os.path.join(directory, name)
+
+def saveProfile(profiler, path):
+    """
+    Write the statistics of a profiler to a pstats file, creating its
+    directory if necessary.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    profiler.dump_stats(path)
+
+#-----------------------------------------------------------------------------
+# Aggregation
+
+def findProfiles(paths, pattern=None):
+    """
+    Return the pstats files among paths, searching directories.
+
+    @param pattern: Only return files whose name matches this glob pattern.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(PROFILE_SUFFIX):
+                    files.append(os.path.join(path, name))
+        else:
+            files.append(path)
+
+    if pattern is not None:
+        files = [f for f in files if fnmatch.fnmatch(os.path.basename(f), pattern)]
+
+    return files
+
+def mergeProfiles(files, stream=None):
+    """
+    Merge pstats files.
+
+    :return: A pstats.Stats object or None if there are no files.
+    """
+    if not files:
+        return None
+
+    if stream is None:
+        stats = pstats.Stats(files[0])
+    else:
+        stats = pstats.Stats(files[0], stream=stream)
+
+    for f in files[1:]:
+        stats.add(f)
+
+    return stats
+
+def getTopFunctions(stats, n=20, sortKey='cumulative'):
+    """
+    Return the hottest functions of merged profiles.
+
+    @param sortKey: 'cumulative' for time including callees, 'time' for
+        time in the function itself or 'calls'.
+    :return: A list of tuples (function, calls, totalTime, cumulativeTime)
+        where function is 'file:line(name)'.
+    """
+    column = {'calls': 1, 'time': 2, 'tottime': 2,
+              'cumulative': 3, 'cumtime': 3}[sortKey]
+
+    rows = []
+    for (filename, line, name), (cc, nc, tt, ct, callers) in stats.stats.items():
+        rows.append(('%s:%d(%s)' % (filename, line, name), nc, tt, ct))
+
+    rows.sort(key=lambda row: row[column], reverse=True)
+    return rows[:n]
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] FILE_OR_DIRECTORY...",
+                          description="Merge COWS request profiles and print "
+                          "the hottest functions.")
+    parser.add_option('-n', '--top', type='int', default=20,
+                      help="number of functions to print (default %default)")
+    parser.add_option('-s', '--sort', default='cumulative',
+                      choices=['cumulative', 'time', 'calls'],
+                      help="cumulative, time or calls (default %default)")
+    parser.add_option('-m', '--match', metavar='PATTERN',
+                      help="only merge files matching a glob pattern, "
+                      "e.g. 'WMS.GetMap--temp--*'")
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help="also write the merged profile to FILE")
+
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error("No profiles given")
+
+    files = findProfiles(args, options.match)
+    stats = mergeProfiles(files)
+    if stats is None:
+        sys.stderr.write("No profiles found\n")
+        return 1
+
+    if options.output:
+        stats.dump_stats(options.output)
+
+    sys.stdout.write("%d profiles, %.3fs total\n" % (len(files), stats.total_tt))
+    sys.stdout.write("%10s %10s %10s  %s\n" % ('calls', 'tottime', 'cumtime', 'function'))
+    for function, calls, tt, ct in getTopFunctions(stats, options.top, options.sort):
+        sys.stdout.write("%10d %10.4f %10.4f  %s\n" % (calls, tt, ct, function))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,36 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Controller exposing the metrics of cows.metrics for Prometheus to scrape.
+
+Add a route such as::
+
+    map.connect('metrics', controller='metrics', action='index')
+
+The endpoint is disabled with cows.metrics.enabled = false.
+
+"""
+
+from pylons import response, config
+from pylons.controllers import WSGIController
+from pylons.controllers.util import abort
+
+from cows import metrics
+
+import logging
+log = logging.getLogger(__name__)
+
+class MetricsController(WSGIController):
+
+    def index(self):
+        if config.get('cows.metrics.enabled', 'true').lower() != 'true':
+            abort(404)
+
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        response.headers['Cache-Control'] = 'no-cache'
+        return metrics.registry.exposition()
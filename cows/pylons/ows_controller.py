@@ -13,6 +13,13 @@ Base controller for OGC Web Services (OWS).
     for the NDG discovery portal in ows_server.lib.BaseController.
 """
 
+import os
+import time
+import threading
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 
 from pylons import request, response, config, url
 from pylons import tmpl_context as c
@@ -26,6 +33,11 @@ from cows.builder import loadConfigFile
 from cows import helpers
 from cows.qs_util import parse_qsl
 from cows.model import *
+from cows.cache import cacheFromConfig, getLastModified
+from cows.timing import startTimer, getTimer, setTimer, timePhase
+from cows import metrics
+from cows.profiling import Profile, PROFILE_PARAM, isProfileRequested, \
+     getProfileFileName, saveProfile
 
 from genshi.template import TemplateLoader
 from pkg_resources import resource_filename
@@ -37,6 +49,8 @@ except ImportError:
 
 import logging
 log = logging.getLogger(__name__)
+timingLog = logging.getLogger('cows.timing')
+slowLog = logging.getLogger('cows.timing.slow')
 
 # Instantiate Genshi template loader
 templateLoader = TemplateLoader(
@@ -58,6 +72,16 @@ EXCEPTION_TYPE = config.get('cows.exception_type', 'ogc').lower()
 #     treats ';' different to HTML4.
 PARAMETER_MODE = config.get('cows.parameter_mode', 'html_4').lower()
 
+# Request counts and latencies exposed by cows.pylons.metrics_controller
+METRICS_ENABLED = config.get('cows.metrics.enabled', 'true').lower() == 'true'
+
+requestCounter = metrics.registry.counter(
+    'cows_requests_total', 'OWS requests handled.',
+    ['service', 'operation', 'status'])
+requestDuration = metrics.registry.histogram(
+    'cows_request_duration_seconds', 'Time taken to handle OWS requests.',
+    ['service', 'operation'])
+
 ##########################################################################
 
 class OWSControllerBase(WSGIController):
@@ -89,9 +113,36 @@ class OWSControllerBase(WSGIController):
 
     owsOperations = []
 
+    # The cProfile.Profile of a profiled request, see cows.profiling
+    _profiler = None
+
     def __call__(self, environ, start_response):
+        timer = startTimer()
+        try:
+            try:
+                if self._isProfileRequested(environ):
+                    self._profiler = Profile()
+                    return self._profiler.runcall(self._callOws, environ,
+                                                  start_response)
+                return self._callOws(environ, start_response)
+            except OWS_E.OwsError:
+                timer.info.setdefault('status', 'ows_error')
+                raise
+            except:
+                timer.info.setdefault('status', 'error')
+                raise
+        finally:
+            timer.stop()
+            setTimer(None)
+            timer.name = self._getOperationName(environ)
+            if self._profiler is not None:
+                self._saveProfile(timer, environ)
+            self._logTiming(timer, environ)
+            self._recordMetrics(timer)
 
-        self._loadOwsParams()
+    def _callOws(self, environ, start_response):
+
+        timePhase('parse', self._loadOwsParams)
 
         # If the EXCEPTION_TYPE is 'pylons' let Pylons catch any exceptions.
         # Otherwise send an OGC exception report for any OWS_E.OwsError
@@ -106,14 +157,88 @@ class OWSControllerBase(WSGIController):
 
             except OWS_E.OwsError, e:
                 log.exception(e)
+                getTimer().info['error'] = e.__class__.__name__
+                getTimer().info['status'] = 'ows_error'
                 start_response('400 Bad Request', [('Content-type', 'text/xml')])
                 return [render_ows_exception(e)]
 
             except Exception, e:
                 log.exception(e)
+                getTimer().info['error'] = e.__class__.__name__
+                getTimer().info['status'] = 'error'
                 start_response('500 Internal Server Error', [('Content-type', 'text/plain')])
                 return ['Please see server logs for details']
 
+    def _getOperationName(self, environ):
+        """
+        Returns the service and operation of the request, e.g. 'WMS.GetMap'.
+        """
+        action = environ.get('pylons.routes_dict', {}).get('action')
+        return '%s.%s' % (getattr(self, 'service', None) or 
+                          self.__class__.__name__, action)
+
+    def _isProfileRequested(self, environ):
+        """
+        Decide whether to profile the request from its cows_profile
+        parameter and the cows.profile.* options, see cows.profiling.
+        """
+        if not config.get('cows.profile.dir'):
+            return False
+        
+        params = dict(parse_qsl(environ.get('QUERY_STRING', ''),
+                                keep_blank_values=True))
+        return isProfileRequested(config, params.get(PROFILE_PARAM))
+
+    def _saveProfile(self, timer, environ):
+        """
+        Write the request's profile to cows.profile.dir, named after the
+        operation, layer and fileoruri.
+        """
+        owsParams = getattr(self, '_owsParams', {})
+        for param in ('layers', 'layer', 'coverage', 'identifier', 'typename'):
+            layer = owsParams.get(param)
+            if layer:
+                break
+        fileoruri = environ.get('pylons.routes_dict', {}).get('fileoruri')
+        
+        path = getProfileFileName(config['cows.profile.dir'], timer.name,
+                                  layer, fileoruri)
+        try:
+            saveProfile(self._profiler, path)
+        except (IOError, OSError), e:
+            log.error("Cannot write profile %s: %s" % (path, e))
+        else:
+            timer.info['profile'] = os.path.basename(path)
+
+    def _logTiming(self, timer, environ):
+        """
+        Log the phase timings of a request to the cows.timing logger and,
+        if it took longer than cows.timing.slow_threshold seconds, a full
+        report to the cows.timing.slow logger.
+        """
+        timingLog.info(timer.format())
+        
+        threshold = config.get('cows.timing.slow_threshold')
+        if threshold and timer.getTotal() > float(threshold):
+            timer.info['path'] = environ.get('PATH_INFO')
+            timer.info['query'] = environ.get('QUERY_STRING')
+            slowLog.warning(timer.formatDetail())
+
+    def _recordMetrics(self, timer):
+        """
+        Count the request and its duration by service, operation and status,
+        which is ok, ows_error for an OGC exception report or error for any
+        other failure.
+        """
+        if not METRICS_ENABLED:
+            return
+
+        service, operation = timer.name.split('.', 1)
+        status = timer.info.get('status', 'ok')
+
+        requestCounter.inc((service, operation, status))
+        requestDuration.observe((service, operation), timer.getTotal())
+
     def _loadOwsParams(self):
         """
         Method to load OWS parameters from the query string. 
@@ -152,6 +277,9 @@ class OWSControllerBase(WSGIController):
         except UnicodeError:
             raise ValueError("Cannot convert unicode to string.  COWS does not accept unicode parameters")
 
+        # Not an OWS parameter, see _isProfileRequested()
+        self._owsParams.pop(PROFILE_PARAM, None)
+
     def _fixOwsAction(self, environ):
         rdict = environ['pylons.routes_dict']
         
@@ -196,9 +324,42 @@ class OWSControllerBase(WSGIController):
                 raise OWS_E.MissingParameterValue('%s parameter is not specified' % param,
                                                   param)
 
+    def _checkETag(self, etag):
+        """
+        Sets the ETag response header and checks it against the
+        If-None-Match request header.
+
+        :return: True if the client's copy is current, in which case the
+            response status is set to 304 Not Modified and the caller should
+            not write a body.
+
+        """
+        etag = '"%s"' % etag
+        response.headers['ETag'] = etag
+
+        ifNoneMatch = request.environ.get('HTTP_IF_NONE_MATCH')
+        if ifNoneMatch is None:
+            return False
+
+        tags = [t.strip() for t in ifNoneMatch.split(',')]
+        tags = [t[2:] if t.startswith('W/') else t for t in tags]
+
+        if etag in tags or '*' in tags:
+            log.debug("ETag %s matched, returning 304 Not Modified" % (etag,))
+            response.status_int = 304
+            return True
+
+        return False
+
 #-----------------------------------------------------------------------------
 # Functions that populate c.capabilities
 
+def getCapabilitiesConfigFile():
+    try:
+        return config['cows.capabilities_config']
+    except KeyError:
+        return config.get('ows_server.capabilities_config')
+
 def addOperation(opName, formats=[]):
     ops = c.capabilities.operationsMetadata.operationDict
     ops[opName] = helpers.operation(url.current(qualified=True, action="index")+'?', formats=formats)
@@ -234,10 +395,7 @@ def initCapabilities():
 
     """
     # Load the basic ServiceMetadata from a config file
-    try:
-        configFile = config['cows.capabilities_config']
-    except KeyError:
-        configFile = config.get('ows_server.capabilities_config')
+    configFile = getCapabilitiesConfigFile()
     if configFile is None:
         raise RuntimeError('No OWS configuration file')
     
@@ -262,6 +420,11 @@ class OWSController(OWSControllerBase):
     :ivar updateSequence: None if cache-control is not supported or an
         updateSequence identifier.  This attribute should be set in the
         controller's __before__() method.
+
+    If the controller's layerMapper implements getLastModified(**kwargs)
+    rendered capabilities documents are cached until the layer sources or
+    the capabilities config file change, and updateSequence defaults to
+    their modification time.
     """
 
     owsOperations = ['GetCapabilities']
@@ -273,6 +436,11 @@ class OWSController(OWSControllerBase):
 
     # To enable cache control set this instance attribute in self.__before__().
     updateSequence = None
+
+    # Cache of rendered capabilities documents shared by all OWS controllers
+    _capabilitiesCache = None
+    _capabilitiesCacheLock = threading.Lock()
+    _configLastModified = (0, None)
     
     def GetCapabilities(self):
         """
@@ -292,19 +460,112 @@ class OWSController(OWSControllerBase):
         else:
             raise Exception("Request Method '%s' not supported." % rm)
 
+        lastModified = self._getCapabilitiesLastModified()
+        if self.updateSequence is None and lastModified is not None:
+            self.updateSequence = '%d' % lastModified
+        c.updateSequence = self.updateSequence
+
         # Check update sequence
-        check_updatesequence(self.updateSequence, ows_params["updateSequence"])
+        check_updatesequence(ows_params["updateSequence"], self.updateSequence)
 
         # Do version negotiation
         version = negotiate_version(self.validVersions, ows_params["version"])
+        format = ows_params["format"]
+        
+        if lastModified is None:
+            response.headers['content-type'] = format
+            return self._buildCapabilities(version, format)
+        
+        cache = self._getCapabilitiesCache()
+        routesDict = request.environ['pylons.routes_dict']
+        cacheKey = repr((self.service, routesDict.get('fileoruri'), version, format,
+                         url.current(qualified=True), lastModified))
+        
+        cached = cache.get(cacheKey)
+        if cached is None:
+            document = self._buildCapabilities(version, format)
+            if isinstance(document, unicode):
+                etag = sha1(document.encode('utf-8')).hexdigest()
+            else:
+                etag = sha1(document).hexdigest()
+            cache.put(cacheKey, (etag, document))
+        else:
+            log.debug("capabilities cache hit")
+            etag, document = cached
+        
+        response.headers['content-type'] = format
+        if self._checkETag(etag):
+            return ''
+        return document
 
+    def _buildCapabilities(self, version, format):
         # Get information required for the capabilities document
         initCapabilities()
-        self._loadCapabilities()
+        timePhase('load_capabilities', self._loadCapabilities)
         
         # Render the capabilities document        
-        response.headers['content-type'] = ows_params["format"]
-        return self._renderCapabilities(ows_params["version"], ows_params["format"])
+        return timePhase('render_capabilities', self._renderCapabilities, version, format)
+
+    @classmethod
+    def _getCapabilitiesCache(cls):
+        """
+        Returns the cache of rendered capabilities documents, configured by
+        the cows.capabilities_cache.* options.  Values are (etag, document)
+        tuples.
+        """
+        if OWSController._capabilitiesCache is None:
+            OWSController._capabilitiesCacheLock.acquire()
+            try:
+                if OWSController._capabilitiesCache is None:
+                    OWSController._capabilitiesCache = cacheFromConfig(
+                        config, 'cows.capabilities_cache', maxBytes='32M')
+            finally:
+                OWSController._capabilitiesCacheLock.release()
+
+        return OWSController._capabilitiesCache
+
+    def _getCapabilitiesLastModified(self):
+        """
+        Returns the modification time of the sources of the capabilities
+        document, or None if the layer mapper can't provide it, in which
+        case the document isn't cached.
+        """
+        layerMapper = getattr(self, 'layerMapper', None)
+        getLayersLastModified = getattr(layerMapper, 'getLastModified', None)
+        if getLayersLastModified is None:
+            return None
+        
+        kwargs = dict((str(k), v) for k, v in 
+                      request.environ['pylons.routes_dict'].items())
+        lastModified = getLayersLastModified(**kwargs)
+        if lastModified is None:
+            return None
+        
+        configLastModified = self._getConfigLastModified()
+        if configLastModified is not None:
+            lastModified = max(lastModified, configLastModified)
+        
+        return lastModified
+
+    @classmethod
+    def _getConfigLastModified(cls):
+        """
+        Returns the modification time of the capabilities config file,
+        checked at most every cows.capabilities_cache.check_interval seconds.
+        """
+        checked, lastModified = OWSController._configLastModified
+        
+        now = time.time()
+        interval = float(config.get('cows.capabilities_cache.check_interval', 10))
+        if now - checked >= interval:
+            configFile = getCapabilitiesConfigFile()
+            if configFile is None:
+                lastModified = None
+            else:
+                lastModified = getLastModified([configFile])
+            OWSController._configLastModified = (now, lastModified)
+            
+        return lastModified
 
     def _getGCParamsViaGET(self):
         """
@@ -350,6 +611,8 @@ class OWSController(OWSControllerBase):
         raise NotImplementedError
 
 
+metrics.registerCache('capabilities', lambda: OWSController._capabilitiesCache)
+
 def render_ows_exception(e):
     tmpl = templateLoader.load('exception_report.xml')
     return str(tmpl.generate(report=e.report).render('xml'))
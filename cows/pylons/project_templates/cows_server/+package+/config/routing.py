@@ -27,8 +27,15 @@ def make_map():
     map.connect(':fileoruri/wms', controller='csmlwms')
     map.connect('wcsroute', ':fileoruri/wcs', controller='csmlwcs') #wcsroute is a named route.
     map.connect(':fileoruri/wfs', controller='csmlwfs')
+    map.connect(':fileoruri/wmts', controller='csmlwmts')
+    #CF-NetCDF files in cows.csml.netcdfstore, served without CSML documents
+    map.connect('netcdf/:fileoruri/wms', controller='netcdfwms')
+    map.connect('netcdf/:fileoruri/wcs', controller='netcdfwcs')
+    map.connect(':fileoruri/wmts/:layer/:style/:tilematrixset/:tilematrix/:tilerow/:tilecol', controller='csmlwmts')
     #filestore - used for fetching files referenced by (csml) StorageDescriptors (WFS), and  'store' in wcs if implemented
     map.connect('filestore/:file', controller='fetch', action='fetchFile')
+    #Prometheus metrics of the OWS requests and caches
+    map.connect('metrics', controller='metrics', action='index')
     map.connect(':fileoruri/demo', controller='demo')
     map.connect('', controller='catalogue')
 
@@ -0,0 +1,17 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+import logging
+
+from cows.pylons.wmts_controller import WMTSController
+from cows.service.imps.csml_geoplot_backend.csml_geoplot_layer_mapper import CSMLGeoplotLayerMapper
+
+
+log = logging.getLogger(__name__)
+
+class CsmlwmtsController(WMTSController):
+    layerMapper = CSMLGeoplotLayerMapper()
@@ -0,0 +1,11 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+from cows.pylons.metrics_controller import MetricsController as _MetricsController
+
+class MetricsController(_MetricsController):
+    pass
@@ -0,0 +1,17 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+import logging
+
+from cows.pylons.wms_controller import WMSController
+from cows.service.imps.netcdfbackend.netcdf_layer_mapper import NetcdfLayerMapper
+
+
+log = logging.getLogger(__name__)
+
+class NetcdfwmsController(WMSController):
+    layerMapper = NetcdfLayerMapper()
@@ -32,6 +32,7 @@ from cows.model import PossibleValues, WGS84BoundingBox, BoundingBox, Contents
 from cows.pylons import ows_controller
 from cows.exceptions import *
 from cows import bbox_util
+from cows.timing import timePhase
 import ConfigParser
 from cows.service.imps.csmlbackend.config import config
 
@@ -83,7 +84,7 @@ class WCSController(ows_controller.OWSController):
             log.debug('wcs blacklisting %s'%kwargs['fileoruri'] )
             self.layers={}
         else:
-            self.layers = self.layerMapper.map(**kwargs)   
+            self.layers = timePhase('map', self.layerMapper.map, **kwargs)   
 
     #-------------------------------------------------------------------------
     # Methods implementing stubs in OWSController
@@ -214,7 +215,7 @@ class WCSController(ows_controller.OWSController):
                 kwargs[axis.name]=values    
         
 #     
-        filepath = layerObj.getCvg(bbox, time=times, **kwargs) #TODO, refactor so is more flexible (e.g. not just netcdf)
+        filepath = timePhase('extract', layerObj.getCvg, bbox, time=times, **kwargs) #TODO, refactor so is more flexible (e.g. not just netcdf)
         fileToReturn=open(filepath, 'r')
         mType='application/cf-netcdf'
         response.headers['Content-Type']=mType
@@ -28,6 +28,7 @@ from cows.model import PossibleValues, WGS84BoundingBox, BoundingBox, Contents
 from cows.pylons import ows_controller
 from cows.exceptions import *
 from cows import bbox_util
+from cows.timing import timePhase
 from cows.service.imps.csmlbackend.config import config
 from cows.service.imps.csmlbackend.wfs_csmllayer import CSMLFeatureSet
 
@@ -81,7 +82,7 @@ class WFSController(ows_controller.OWSController):
             self.layers={}
             self.featureset=CSMLFeatureSet() #return dummy layers and featureset
         else:
-            self.layers, self.featureset = self.layerMapper.map(**kwargs)
+            self.layers, self.featureset = timePhase('map', self.layerMapper.map, **kwargs)
             log.debug('Feature instances %s'%self.featureset.featureinstances)
                
         
@@ -307,7 +308,7 @@ class WFSController(ows_controller.OWSController):
         for key in self._owsParams.keys():
             if key not in ['query', 'request', 'service', 'version', 'storedquery_id', 'typename', 'maxfeatures']:
                 otherparams[key]=self._owsParams[key]       
-        c.resultset, c.additionalobjects=self._runQuery(queryxml, storedqueryid, typename, maxfeatures, **otherparams)
+        c.resultset, c.additionalobjects=timePhase('query', self._runQuery, queryxml, storedqueryid, typename, maxfeatures, **otherparams)
                
         #Group resultset together in a wfs feature collection (use template)
         response.headers['content-type'] = 'text/xml'
@@ -13,7 +13,18 @@ WMS controller for OGC Web Services (OWS).
 
 import re
 import math
-from cStringIO import StringIO
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+from multiprocessing import TimeoutError
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+try:
+    import json
+except ImportError:
+    import simplejson as json
 from sets import Set
 from pylons import request, response, config, url
 from pylons import tmpl_context as c
@@ -34,6 +45,14 @@ from cows.model import PossibleValues, WGS84BoundingBox, BoundingBox, Contents
 from cows.pylons import ows_controller
 from cows.exceptions import *
 from cows import bbox_util
+from cows.util import index_layer_names
+from cows.cache import cacheFromConfig, requestCacheKey, isCacheable, \
+    LRUCache, SingleFlight
+from cows.image_encoder import PIL_FORMATS, encoderFromConfig, parseColour, \
+     composeImages
+from cows.tile_grid import DEFAULT_ORIGINS, getMetaTile
+from cows.timing import getTimer, setTimer, timePhase, timed
+from cows import metrics
 
 class WMSController(ows_controller.OWSController):
     """
@@ -45,20 +64,28 @@ class WMSController(ows_controller.OWSController):
     """
     layerMapper = None
     #layers = {}    
-    _pilImageFormats = {
-        'image/png': 'PNG',
-        'image/jpg': 'JPEG',
-        'image/gif': 'GIF',
-        'image/tiff': 'TIFF'
-        }
-    _layerSlabCache = {}
+    _pilImageFormats = PIL_FORMATS
+
+    # Caches shared by all WMSController subclasses, see _getCache()
+    _layerSlabCache = None
+    _tileCache = None
+    _legendCache = None
+    _slabFlight = None
+    _getMapPool = None
+    _imageEncoder = None
+    _cacheLock = threading.Lock()
+
+    # Layer name indexes, see _getLayerIndex()
+    _layerIndexCache = LRUCache(maxEntries=256, sizeFunc=lambda value: len(value[1]))
+    _layerIndex = None
 
     #-------------------------------------------------------------------------
     # Attributes required by OWSController
 
     service = 'WMS'
     owsOperations = (ows_controller.OWSController.owsOperations +
-        ['GetMap', 'GetContext', 'GetLegend', 'GetFeatureInfo', 'GetInfo'])
+        ['GetMap', 'GetContext', 'GetLegend', 'GetFeatureInfo', 'GetInfo',
+         'GetCacheStats'])
     
     validVersions = ['1.1.1', '1.3.0']
 
@@ -78,7 +105,7 @@ class WMSController(ows_controller.OWSController):
         #self.updateSequence = "hello"
         log.debug("loading layers")
         #print self.layers
-        self.layers = self.layerMapper.map(**kwargs)
+        self.layers = timePhase('map', self.layerMapper.map, **kwargs)
 
     #-------------------------------------------------------------------------
     # Methods implementing stubs in OWSController
@@ -122,6 +149,13 @@ class WMSController(ows_controller.OWSController):
             c.capabilities.contents.datasetSummaries.append(ds)
         
         
+        self._setServiceTitle()
+                
+        # Add this operation here after we have found all formats
+        ows_controller.addOperation('GetFeatureInfo',
+                                    formats = list(featureInfoFormats))
+
+    def _setServiceTitle(self):
         log.debug('Setting dataset name')
         
         #LayerMapper may optionally implement a datasetName attribute which 
@@ -136,10 +170,6 @@ class WMSController(ows_controller.OWSController):
         if c.capabilities.serviceIdentification.titles[0] is None:
             fileoruri = request.environ['pylons.routes_dict']['fileoruri']
             c.capabilities.serviceIdentification.titles=[fileoruri]
-                
-        # Add this operation here after we have found all formats
-        ows_controller.addOperation('GetFeatureInfo',
-                                    formats = list(featureInfoFormats))
 
 
     def _buildWMSDatasetSummary(self, layer, featureInfoFormats):
@@ -270,18 +300,7 @@ class WMSController(ows_controller.OWSController):
         is found an InvalidParameterValue is raised.
         """
         
-        layerObj = None
-        
-        if layerName in self.layers:
-            layerObj = self.layers[layerName]
-        else:
-            
-            fileoruri = request.environ['pylons.routes_dict']['fileoruri']
-            log.debug("fileoruri = %s" % (fileoruri,))
-            if layerName.find(fileoruri + "_") == 0:
-                
-                reducedName = layerName[len(fileoruri + "_") :]
-                layerObj = self._searchLayerChildren(self.layers.values(), reducedName)
+        layerObj = self._getLayerIndex().get(layerName)
         
         if layerObj is None:
             raise InvalidParameterValue('Layer %s not found, layerNames = %s' 
@@ -289,28 +308,40 @@ class WMSController(ows_controller.OWSController):
         
         return layerObj
     
-    def _searchLayerChildren(self, layerList, name):
-        layerObj = None
-               
-        for l in layerList:
-            # does this layer match?
-            if l.title == name:
-                layerObj = l
-                break
+    def _getLayerIndex(self):
+        """
+        Returns a mapping from every layer name accepted by _getLayerFromMap()
+        to its layer, see cows.util.index_layer_names.  If the layer mapper
+        implements getLastModified() the index is shared between requests
+        until the layers are reloaded, otherwise it is built once per
+        request.
+        """
+        if self._layerIndex is not None and self._layerIndex[0] is self.layers:
+            return self._layerIndex[1]
+        
+        fileoruri = request.environ['pylons.routes_dict'].get('fileoruri')
+        lastModified = self._getLayersLastModified()
+        
+        controller = '%s.%s' % (self.__class__.__module__, self.__class__.__name__)
+        cacheKey = (controller, fileoruri)
+        
+        index = None
+        if lastModified is not None:
+            cached = self._layerIndexCache.get(cacheKey)
+            if cached is not None and cached[0] == lastModified:
+                index = cached[1]
+        
+        if index is None:
+            index = index_layer_names(self.layers, fileoruri)
+            log.debug("built index of %d layer names for fileoruri = %s" % (len(index), fileoruri))
             
-            # does this layer have a child that matches?
-            if name.find(l.title + "_") == 0:
-                
-                reducedName = name[len(l.title + "_"):]
-                
-                found = self._searchLayerChildren(l.childLayers, reducedName)
-                
-                if found is not None:
-                    layerObj = found
-                    break
-
-        return layerObj
-
+            # Replace any index of the layers before they were reloaded
+            if lastModified is not None:
+                self._layerIndexCache.put(cacheKey, (lastModified, index))
+        
+        self._layerIndex = (self.layers, index)
+        
+        return index
 
     def _getFormatParam(self):
         format = self.getOwsParam('format', default='image/png')
@@ -334,6 +365,21 @@ class WMSController(ows_controller.OWSController):
                                                   default=defaultValue)
         return dimValues
 
+    def _getRestoredDimValues(self, layerObj):
+        """
+        Returns the dimension values of a request keyed by the real
+        dimension names, see _mapParamToDim().
+        """
+        dimValues = self._getDimValues(layerObj)
+        
+        #now need to revert modified dim values (e.g. height_dim) back to dim values the layerMapper understands (e.g. height)
+        restoredDimValues={}
+        for dim in dimValues:
+            restoredDim=self._mapParamToDim(dim)
+            restoredDimValues[restoredDim]=dimValues[dim]
+        
+        return restoredDimValues
+
     def _mapDimToParam(self, dimName):
         """
         Dimension names might clash with WMS parameter names, making
@@ -364,21 +410,325 @@ class WMSController(ows_controller.OWSController):
             return dimParam
 
 
+    @classmethod
+    def _getCache(cls, attrName, prefix, **defaults):
+        """
+        Returns one of the caches shared by all WMS controllers, creating
+        it from the prefix.* config options on first use.
+
+        @param attrName: The WMSController class attribute holding the cache.
+        @param prefix: The config option prefix, see cows.cache.cacheFromConfig
+        @param defaults: Default cacheFromConfig arguments.
+
+        """
+        cache = getattr(WMSController, attrName)
+
+        if cache is None:
+            WMSController._cacheLock.acquire()
+            try:
+                cache = getattr(WMSController, attrName)
+                if cache is None:
+                    cache = cacheFromConfig(config, prefix, **defaults)
+                    setattr(WMSController, attrName, cache)
+                    log.info("Created %s with max_bytes=%s" % (prefix, cache.getStats()['maxBytes']))
+            finally:
+                WMSController._cacheLock.release()
+
+        return cache
+
+    @classmethod
+    def _getSlabCache(cls):
+        return cls._getCache('_layerSlabCache', 'cows.wms.slab_cache', maxBytes='512M')
+
+    @classmethod
+    def _getTileCache(cls):
+        """
+        Returns the cache of encoded GetMap images.  Each value is a
+        tuple (etag, data).
+        """
+        return cls._getCache('_tileCache', 'cows.wms.tile_cache', maxBytes='64M')
+
+    @classmethod
+    def _getLegendCache(cls):
+        """
+        Returns the cache of encoded GetLegend images.  Each value is a
+        tuple (etag, data).
+        """
+        return cls._getCache('_legendCache', 'cows.wms.legend_cache', maxBytes='16M')
+
+    def _getRequestCacheKey(self, bbox=None):
+        """
+        Build a tile or legend cache key from all the parameters of this
+        request, see cows.cache.requestCacheKey.
+
+        @param bbox: If given, the key of the same request for this bbox.
+        """
+        return requestCacheKey(self._getCacheContext(), self._owsParams, bbox)
+
+    def _getCacheContext(self):
+        """
+        Returns what identifies a cached tile or legend besides the request
+        parameters.  The tile and legend caches are shared by every
+        WMSController subclass so this includes the controller class.  It
+        also includes the modification time of the layer sources, if the
+        layer mapper implements getLastModified(), so images rendered
+        before the layers were reloaded are no longer used.
+        """
+        routesDict = request.environ['pylons.routes_dict']
+        
+        controller = '%s.%s' % (self.__class__.__module__, self.__class__.__name__)
+        
+        return (controller, routesDict.get('fileoruri'), self._getLayersLastModified(),
+                self._isMsie6())
+
+    def _getLayersLastModified(self):
+        """
+        Returns the modification time of the layers' sources from the layer
+        mapper's getLastModified(), or None if it isn't implemented or the
+        time is unknown.
+        """
+        getLayersLastModified = getattr(self.layerMapper, 'getLastModified', None)
+        if getLayersLastModified is None:
+            return None
+        
+        routesDict = request.environ['pylons.routes_dict']
+        return getLayersLastModified(**dict((str(k), v) for k, v in routesDict.items()))
+
+    @classmethod
+    def _getSlabFlight(cls):
+        """
+        Returns the SingleFlight object used to ensure concurrent requests
+        for the same uncached slab only build it once.  Waiting requests
+        give up after cows.wms.slab_cache.wait_timeout seconds.
+        """
+        if WMSController._slabFlight is None:
+            WMSController._cacheLock.acquire()
+            try:
+                if WMSController._slabFlight is None:
+                    timeout = float(config.get('cows.wms.slab_cache.wait_timeout', 120))
+                    WMSController._slabFlight = SingleFlight(timeout=timeout)
+            finally:
+                WMSController._cacheLock.release()
+
+        return WMSController._slabFlight
+
+    @classmethod
+    def _getLayerPool(cls):
+        """
+        Returns the thread pool used to render the layers of multi-layer
+        GetMap requests concurrently, or None if layers should be rendered
+        serially.  The pool size is set by cows.wms.getmap.pool_size.
+        """
+        if WMSController._getMapPool is None:
+            poolSize = int(config.get('cows.wms.getmap.pool_size', 1))
+            if poolSize <= 1:
+                return None
+            
+            WMSController._cacheLock.acquire()
+            try:
+                if WMSController._getMapPool is None:
+                    log.info("Creating GetMap layer pool of %d threads" % poolSize)
+                    WMSController._getMapPool = ThreadPool(poolSize)
+            finally:
+                WMSController._cacheLock.release()
+
+        return WMSController._getMapPool
+
     def _retrieveSlab(self, layerObj, srs, style, dimValues, transparent, bgcolor, additionalParams):
         
         # Find the slab in the cache first
         cacheKey = layerObj.getCacheKey(srs, style, dimValues, transparent, bgcolor, additionalParams)
-        slab = self._layerSlabCache.get(cacheKey)
+
+        if cacheKey is None:
+            return timePhase('slab', layerObj.getSlab, srs, style, dimValues, 
+                             transparent, bgcolor, additionalParams)
+
+        slabCache = self._getSlabCache()
+        slab = slabCache.get(cacheKey)
         
         if slab is None:
             
-            slab = layerObj.getSlab(srs, style, dimValues, transparent, bgcolor, additionalParams)
+            def buildSlab():
+                # The slab may have been built since our cache miss
+                slab = slabCache.get(cacheKey)
+                if slab is not None:
+                    return slab
+                
+                slab = timePhase('slab', layerObj.getSlab, srs, style, dimValues, 
+                                 transparent, bgcolor, additionalParams)
+                slabCache.put(cacheKey, slab, group=layerObj.name)
+                return slab
             
-            if cacheKey is not None:
-                self._layerSlabCache[cacheKey] = slab
+            # Other requests for this slab wait for this one to build it
+            slab = self._getSlabFlight().do(cacheKey, buildSlab)
 
         return slab
 
+    def _renderLayer(self, layerObj, srs, style, dimValues, transparent, bgcolor, 
+                     additionalParams, bbox, width, height):
+        slab = self._retrieveSlab(layerObj, srs, style, dimValues, 
+                                  transparent, bgcolor, additionalParams)
+
+        return timePhase('render', slab.getImage, bbox, width, height)
+
+    def _renderLayers(self, layerArgs):
+        """
+        Render the image of each layer, in the GetMap layer pool if there is
+        more than one and the request isn't being profiled.  Raises
+        NoApplicableCode if the images are not ready within
+        cows.wms.getmap.deadline seconds.
+
+        @param layerArgs: A list of _renderLayer() argument tuples.
+        :return: A list of images in the same order as layerArgs.
+
+        """
+        deadline = config.get('cows.wms.getmap.deadline')
+        if deadline:
+            deadline = time.time() + float(deadline)
+        
+        pool = self._getLayerPool()
+        
+        # Profiled requests render in this thread so the profiler sees them
+        if pool is None or len(layerArgs) == 1 or self._profiler is not None:
+            images = []
+            for args in layerArgs:
+                images.append(self._renderLayer(*args))
+                if deadline and time.time() > deadline:
+                    raise NoApplicableCode('GetMap deadline exceeded')
+            return images
+        
+        # Make sure the shared caches exist before other threads need them
+        self._getSlabCache()
+        self._getSlabFlight()
+        
+        # Pylons request globals are thread-local so lend them to the workers
+        proxies = [(request, request._current_obj()), (c, c._current_obj())]
+        
+        timer = getTimer()
+        results = [pool.apply_async(self._renderLayerInThread, (proxies, timer, args))
+                   for args in layerArgs]
+        
+        images = []
+        try:
+            for result in results:
+                if deadline:
+                    images.append(result.get(max(0, deadline - time.time())))
+                else:
+                    images.append(result.get())
+        except TimeoutError:
+            raise NoApplicableCode('GetMap deadline exceeded')
+        
+        return images
+
+    def _renderLayerInThread(self, proxies, timer, args):
+        for proxy, obj in proxies:
+            proxy._push_object(obj)
+        setTimer(timer)
+        try:
+            return self._renderLayer(*args)
+        finally:
+            setTimer(None)
+            for proxy, obj in proxies:
+                proxy._pop_object(obj)
+
+    @timed('compose')
+    def _composeImages(self, images, width, height):
+        """
+        Alpha blend images with the first image on top.
+
+        :return: An RGBA PIL image.
+
+        """
+        return composeImages(images)
+
+    def _renderMap(self, layerArgs, bbox, width, height):
+        """
+        Render and compose the layers of a GetMap request.
+
+        @param layerArgs: A list of _renderLayer() argument tuples without
+            the bbox, width and height.
+        :return: An RGBA PIL image.
+
+        """
+        images = self._renderLayers([args + (bbox, width, height)
+                                     for args in layerArgs])
+        
+        # The first layer is drawn on top
+        finalImg = self._composeImages(images, width, height)
+
+        # IE 6.0 doesn't display the alpha layer right.  Here we sniff the
+        # user agent and remove the alpha layer if necessary.
+        if self._isMsie6():
+            finalImg = finalImg.convert('RGB')
+
+        return finalImg
+
+    def _getMetaTile(self, bbox, width, height, srs):
+        """
+        Returns the cows.tile_grid.MetaTile containing the requested map or
+        None if metatiling is disabled or the map isn't a tile.
+
+        Metatiling is enabled by setting cows.wms.metatile.size to the
+        number of tiles along each side of a metatile.  Tiles are found by
+        aligning the bbox to a grid starting at the CRS's origin in
+        cows.tile_grid.DEFAULT_ORIGINS or cows.wms.metatile.origin.<CRS>.
+
+        """
+        metaSize = int(config.get('cows.wms.metatile.size', 1))
+        if metaSize <= 1:
+            return None
+
+        maxSize = int(config.get('cows.wms.metatile.max_size', 2048))
+        if max(width, height) * metaSize > maxSize:
+            return None
+
+        origin = config.get('cows.wms.metatile.origin.%s' % srs)
+        if origin:
+            origin = tuple(float(x) for x in origin.split(','))
+        else:
+            origin = DEFAULT_ORIGINS.get(srs.upper(), (0.0, 0.0))
+
+        buffer = int(config.get('cows.wms.metatile.buffer', 0))
+
+        return getMetaTile(bbox, width, height, metaSize, origin, buffer)
+
+    def _renderMetaTile(self, metaTile, layerArgs, width, height, version, srs,
+                        encodeArgs):
+        """
+        Render a metatile, store all its tiles in the tile cache and return
+        the requested tile.  Concurrent requests for tiles of the same
+        metatile wait for one rendering.
+
+        :return: A tuple (etag, data) of the requested tile.
+
+        """
+        tileCache = self._getTileCache()
+
+        def render():
+            img = self._renderMap(layerArgs, metaTile.bbox, 
+                                  metaTile.width, metaTile.height)
+            
+            tiles = {}
+            for index, (tileBBox, (x, y)) in metaTile.tiles.items():
+                tileImg = img.crop((x, y, x + width, y + height))
+                data = self._encodeImage(tileImg, *encodeArgs)
+                etag = sha1(data).hexdigest()
+                
+                tileKey = self._getRequestCacheKey(
+                    self._convertBboxForCrs(tileBBox, version, srs))
+                tileCache.put(tileKey, (etag, data))
+                tiles[index] = (etag, data)
+            
+            return tiles
+
+        metaKey = 'metatile:' + self._getRequestCacheKey(
+            self._convertBboxForCrs(metaTile.bbox, version, srs))
+        
+        tiles = self._getSlabFlight().do(metaKey, render)
+        
+        return tiles[metaTile.index]
+
+
     #-------------------------------------------------------------------------
     # OWS Operation methods
     
@@ -400,9 +750,11 @@ class WMSController(ows_controller.OWSController):
         
         log.debug("layerNames = %s" % ([o.name for o in layerObjects],))
         
-        finalImg = Image.new('RGBA', (width, height), (0,0,0,0))
-
-        # Multiple Layers handling..  
+        bbox = self._convertBboxForCrs(bbox, version, srs)
+        
+        # Work out everything each layer needs from the request before
+        # rendering them, possibly in other threads.
+        layerArgs = []
         for i in range(len(layerObjects)):
             layerObj = layerObjects[i]
             
@@ -420,13 +772,7 @@ class WMSController(ows_controller.OWSController):
             if srs not in layerObj.crss:
                 raise InvalidParameterValue('Layer %s does not support SRS %s' % (layerObj.name, srs))
 
-            dimValues = self._getDimValues(layerObj)
-            
-            #now need to revert modified dim values (e.g. height_dim) back to dim values the layerMapper understands (e.g. height)
-            restoredDimValues={}
-            for dim in dimValues:
-                restoredDim=self._mapParamToDim(dim)
-                restoredDimValues[restoredDim]=dimValues[dim]
+            restoredDimValues = self._getRestoredDimValues(layerObj)
             
             expectedParams = []
             expectedParams.extend(self._escapedDimNames)
@@ -435,27 +781,40 @@ class WMSController(ows_controller.OWSController):
             #get any other parameters on the request that the layer might need
             additionalParams = self._getAdditionalParameters(expectedParams)
             
-            slab = self._retrieveSlab(layerObj, srs, style, restoredDimValues, 
-                                      transparent, bgcolor, additionalParams)
-
-            bbox = self._convertBboxForCrs(bbox, version, srs)
-
-            img = slab.getImage(bbox, width, height)
-            
-            finalImg = Image.composite(finalImg, img, finalImg)    
-
-        # IE 6.0 doesn't display the alpha layer right.  Here we sniff the
-        # user agent and remove the alpha layer if necessary.
-        try:
-            ua = request.headers['User-Agent']
-            log.debug("ua = %s" % (ua,))
-        except:
-            pass
+            layerArgs.append((layerObj, srs, style, restoredDimValues, transparent,
+                              bgcolor, additionalParams))
+
+        # Layers without a slab cache key mustn't be cached as images either
+        cacheable = isCacheable(layerArgs)
+        if cacheable:
+            tileCache = self._getTileCache()
+            tileKey = self._getRequestCacheKey()
+
+            cached = tileCache.get(tileKey)
+            if cached is not None:
+                etag, data = cached
+                log.debug("tile cache hit")
+                self._writeImageData(data, format, etag)
+                return
+
+        encodeArgs = (format, not transparent, parseColour(bgcolor))
+
+        # The other tiles of a metatile are only worth rendering to cache them
+        metaTile = None
+        if cacheable:
+            metaTile = self._getMetaTile(bbox, width, height, srs)
+
+        if metaTile is not None:
+            etag, data = self._renderMetaTile(metaTile, layerArgs, width, height,
+                                              version, srs, encodeArgs)
         else:
-            if 'MSIE 6.0' in ua:
-                finalImg = finalImg.convert('RGB')
+            finalImg = self._renderMap(layerArgs, bbox, width, height)
+            data = self._encodeImage(finalImg, *encodeArgs)
+            etag = sha1(data).hexdigest()
+            if cacheable:
+                tileCache.put(tileKey, (etag, data))
 
-        self._writeImageResponse(finalImg, format)
+        self._writeImageData(data, format, etag)
 
 
     def GetContext(self):
@@ -562,13 +921,16 @@ class WMSController(ows_controller.OWSController):
             log.debug("dimName: %s  dimValue: %s" % (dimName, dimValues[dimName]))
 
         value = layerObj.getFeatureInfo(format, srs, (x, y), dimValues)
-        htmlResponse = (("<table style='width:100%%'><tr><td>Longitude</td><td>%s</td></tr>" +
-                         "<tr><td>Latitude</td><td>%s</td></tr>" +
-                         "<tr><td>Value</td><td>%s</td></tr></table>")
-                        % (str(x), str(y), value))
+        
+        # Other formats are complete documents written by the layer
+        if format == 'text/html':
+            value = (("<table style='width:100%%'><tr><td>Longitude</td><td>%s</td></tr>" +
+                      "<tr><td>Latitude</td><td>%s</td></tr>" +
+                      "<tr><td>Value</td><td>%s</td></tr></table>")
+                     % (str(x), str(y), value))
 
         response.headers['Content-Type'] = format
-        response.write(htmlResponse)
+        response.write(value)
 
     def GetLegend(self):
         """
@@ -582,12 +944,7 @@ class WMSController(ows_controller.OWSController):
         # This hook alows extra arguments to be passed to the layer backend.
         additionalParams = self._getAdditionalParameters(['format'])
         
-        dimValues = self._getDimValues(layerObj)
-        #now need to revert modified dim values (e.g. height_dim) back to dim values the layerMapper understands (e.g. height)
-        restoredDimValues={}
-        for dim in dimValues:
-            restoredDim=self._mapParamToDim(dim)
-            restoredDimValues[restoredDim]=dimValues[dim]
+        restoredDimValues = self._getRestoredDimValues(layerObj)
         
         layerObjects = self._getLayerParam()
         styles       = self._getStylesParam(len(layerObjects))        
@@ -599,13 +956,44 @@ class WMSController(ows_controller.OWSController):
         else:
             style = None
         
+        # A legend has no SRS, transparency or background colour
+        cacheable = isCacheable([(layerObj, None, style, restoredDimValues,
+                                  None, None, additionalParams)])
+        if cacheable:
+            legendCache = self._getLegendCache()
+            legendKey = self._getRequestCacheKey()
+
+            cached = legendCache.get(legendKey)
+            if cached is not None:
+                etag, data = cached
+                log.debug("legend cache hit")
+                self._writeImageData(data, format, etag)
+                return
+
         img = layerObj.getLegendImage(restoredDimValues, 
                                       renderOpts=additionalParams,
                                       style=style)
         
-        self._writeImageResponse(img, format)
+        data = self._encodeImage(img, format)
+        etag = sha1(data).hexdigest()
+        if cacheable:
+            legendCache.put(legendKey, (etag, data))
+
+        self._writeImageData(data, format, etag)
+
+
+
+    def GetCacheStats(self):
+        """
+        Return the slab, tile and legend cache counters as JSON.
 
+        """
+        stats = {'slab_cache': self._getSlabCache().getStats(),
+                 'tile_cache': self._getTileCache().getStats(),
+                 'legend_cache': self._getLegendCache().getStats()}
 
+        response.headers['Content-Type'] = 'application/json'
+        response.write(json.dumps(stats))
 
     def GetInfo(self):
         from pprint import pformat
@@ -647,7 +1035,13 @@ class WMSController(ows_controller.OWSController):
         return transparent.lower() == 'true'
     
     def _getBgcolorParam(self):
-        return self.getOwsParam('bgcolor', default='0xFFFFFF')
+        bgcolor = self.getOwsParam('bgcolor', default='0xFFFFFF')
+        try:
+            parseColour(bgcolor)
+        except ValueError:
+            raise InvalidParameterValue('Invalid BGCOLOR %s' % bgcolor, 'bgcolor')
+        
+        return bgcolor
 
     def _getVersionParam(self):
         version = self.getOwsParam('version', default=self.validVersions[0])
@@ -676,26 +1070,59 @@ class WMSController(ows_controller.OWSController):
         return int(self.getOwsParam('height'))
     
 
-    def _writeImageResponse(self, pilImage, format):
-        
-        buf = StringIO()
-        pilImage.save(buf, self._pilImageFormats[format])
+    def _isMsie6(self):
+        try:
+            ua = request.headers['User-Agent']
+            log.debug("ua = %s" % (ua,))
+        except:
+            return False
+        else:
+            return 'MSIE 6.0' in ua
 
-        response.headers['Content-Type'] = format
-        
+    @classmethod
+    def _getImageEncoder(cls):
+        """
+        Returns the cows.image_encoder.ImageEncoder configured by the
+        cows.wms.image.* options.
+        """
+        if cls._imageEncoder is None:
+            WMSController._imageEncoder = encoderFromConfig(config, 'cows.wms.image')
+        return cls._imageEncoder
+
+    @timed('encode')
+    def _encodeImage(self, pilImage, format, opaque=False, background=(255, 255, 255)):
+        """
+        Encode a PIL image in the given mime-type.
+
+        :return: The image as a string.
+        """
+        return self._getImageEncoder().encode(pilImage, format, opaque, background)
+
+    def _writeImageData(self, data, format, etag=None):
+        """
+        Write an encoded image to the response.  If etag is given it is
+        sent as the ETag header and a matching conditional GET receives
+        304 Not Modified.
+        """
         if config.get('cows.browser_caching_enabled','').lower() == 'true':
             response.headers["cache-control"] = "public, max-age=3600"
             response.headers["pragma"] = ""
-                    
-        response.write(buf.getvalue())
+
+        if etag is not None and self._checkETag(etag):
+            return
+
+        response.headers['Content-Type'] = format
+        response.write(data)
+
+    def _writeImageResponse(self, pilImage, format):
+        self._writeImageData(self._encodeImage(pilImage, format), format)
 
     def _convertBboxForCrs(self, bbox, version, crs):
         """Convert a bounding box to (min_lon, min_lat, max_lon, max_lat) if necessary depending on
         the WMS version and CRS.
         """
         if (config.get('cows.wms.handleLatLongCoords', 'false').lower() == 'true') and self._isLatLonOrderCrs(version, crs):
-            (xmin, ymin, xmax, ymax) = bbox
-            return (ymin, xmin, ymax, xmax)
+            return bbox_util.swapAxes(bbox)
         else:
             return bbox
 
@@ -712,5 +1139,9 @@ class WMSController(ows_controller.OWSController):
         """Determine whether coordinates are specified in (lat, lon) order depending on the WMS
         version and CRS.
         """
-        latLonCrss = ['EPSG:4326']
-        return ((version != '1.1.1') and (crs.upper() in latLonCrss))
+        return bbox_util.isLatLonOrderCrs(version, crs)
+
+metrics.registerCache('wms_slab', lambda: WMSController._layerSlabCache)
+metrics.registerCache('wms_tile', lambda: WMSController._tileCache)
+metrics.registerCache('wms_legend', lambda: WMSController._legendCache)
+metrics.registerCache('wms_layer_index', lambda: WMSController._layerIndexCache)
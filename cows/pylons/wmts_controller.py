@@ -0,0 +1,232 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+WMTS controller serving fixed grid tiles of WMS layers.
+
+Tiles are addressed by tile matrix set, zoom level, row and column so
+every client requests exactly the same tiles.  Tiles are rendered through
+the same IwmsLayer.getSlab()/IwmsLayerSlab.getImage() interface and caches
+as WMS GetMap.
+
+GetTile is available in KVP encoding and, with a route such as::
+
+    map.connect(':fileoruri/wmts/:layer/:style/:tilematrixset/:tilematrix/:tilerow/:tilecol',
+                controller='csmlwmts')
+
+in REST encoding, where tilecol has the format's file extension.
+
+"""
+
+from sets import Set
+from pylons import url
+from pylons import tmpl_context as c
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+import logging
+log = logging.getLogger(__name__)
+
+from cows.model import Contents
+from cows.pylons import ows_controller
+from cows.pylons.wms_controller import WMSController
+from cows.exceptions import *
+from cows.cache import isCacheable
+from cows.tile_grid import TILE_MATRIX_SETS
+
+class WMTSController(WMSController):
+    """
+    Subclass this controller in a pylons application and set the layerMapper
+    class attribute to implement a WMTS.
+
+    @cvar layerMapper: an cows.service.wms_iface.ILayerMapper object.
+    @cvar tileMatrixSets: The identifiers of the tile matrix sets served,
+        keys of cows.tile_grid.TILE_MATRIX_SETS.
+
+    """
+    service = 'WMTS'
+    owsOperations = ows_controller.OWSController.owsOperations + ['GetTile']
+    validVersions = ['1.0.0']
+
+    tileMatrixSets = ['WorldCRS84Quad', 'GoogleMapsCompatible']
+    tileFormats = ['image/png', 'image/jpeg']
+
+    # File extensions of REST requests
+    _tileExtensions = [('image/png', 'png'), ('image/jpeg', 'jpg')]
+
+    # Routes arguments of REST GetTile requests
+    _restParams = ['layer', 'style', 'tilematrixset', 'tilematrix',
+                   'tilerow', 'tilecol']
+
+    _tileParams = ['service', 'version', 'request', 'format'] + _restParams
+
+    #-------------------------------------------------------------------------
+
+    def __before__(self, **kwargs):
+        for k in self._restParams:
+            kwargs.pop(k, None)
+
+        super(WMTSController, self).__before__(**kwargs)
+
+    def _fixOwsAction(self, environ):
+        rdict = environ['pylons.routes_dict']
+
+        if rdict.get('tilecol') is None:
+            return super(WMTSController, self)._fixOwsAction(environ)
+
+        # A REST GetTile request
+        for k in self._restParams:
+            self._owsParams[k] = str(rdict[k])
+
+        tilecol = self._owsParams['tilecol']
+        if '.' in tilecol:
+            tilecol, ext = tilecol.rsplit('.', 1)
+            formats = dict((e, f) for f, e in self._tileExtensions)
+            try:
+                self._owsParams['format'] = formats[ext.lower()]
+            except KeyError:
+                raise InvalidParameterValue('Tile extension %s not supported' % ext,
+                                            'format')
+            self._owsParams['tilecol'] = tilecol
+
+        rdict['action'] = 'GetTile'
+
+    #-------------------------------------------------------------------------
+    # Methods implementing stubs in OWSController
+
+    def _renderCapabilities(self, version, format):
+        if format != 'text/xml':
+            raise InvalidParameterValue('Format %s not supported' % format, 'format')
+
+        t = ows_controller.templateLoader.load('wmts_capabilities_1_0_0.xml')
+
+        return t.generate(c=c).render()
+
+    def _loadCapabilities(self):
+        """
+        @note: Assumes self.layers has already been created by __before__().
+
+        """
+        ows_controller.addOperation('GetTile', formats=self.tileFormats)
+
+        log.debug('Loading capabilities contents')
+        c.capabilities.contents = Contents()
+
+        for layerName, layer in self.layers.items():
+            ds = self._buildWMSDatasetSummary(layer, Set())
+            c.capabilities.contents.datasetSummaries.append(ds)
+
+        self._setServiceTitle()
+
+        c.tileMatrixSets = [TILE_MATRIX_SETS[i] for i in self.tileMatrixSets]
+        c.tileFormats = self.tileFormats
+        c.tileExtensions = [(f, e) for f, e in self._tileExtensions
+                            if f in self.tileFormats]
+        c.restURL = url.current(qualified=True, action='index')
+
+    #-------------------------------------------------------------------------
+
+    def _getTileMatrixSetParam(self):
+        identifier = self.getOwsParam('tilematrixset')
+
+        if identifier not in self.tileMatrixSets:
+            raise InvalidParameterValue('TileMatrixSet %s not supported' % identifier,
+                                        'tilematrixset')
+
+        return TILE_MATRIX_SETS[identifier]
+
+    def _getTileParams(self, tileMatrixSet):
+        """
+        Returns the tile matrix, row and column of the request.
+        """
+        matrix = tileMatrixSet.getMatrix(self.getOwsParam('tilematrix'))
+        if matrix is None:
+            raise InvalidParameterValue('TileMatrix %s not found in %s'
+                                        % (self.getOwsParam('tilematrix'),
+                                           tileMatrixSet.identifier),
+                                        'tilematrix')
+
+        try:
+            row = int(self.getOwsParam('tilerow'))
+        except ValueError:
+            raise InvalidParameterValue('Invalid TileRow', 'tilerow')
+        try:
+            column = int(self.getOwsParam('tilecol'))
+        except ValueError:
+            raise InvalidParameterValue('Invalid TileCol', 'tilecol')
+
+        if not 0 <= row < matrix.matrixHeight:
+            raise TileOutOfRange('TileRow %d out of range' % row, 'tilerow')
+        if not 0 <= column < matrix.matrixWidth:
+            raise TileOutOfRange('TileCol %d out of range' % column, 'tilecol')
+
+        return matrix, row, column
+
+    #-------------------------------------------------------------------------
+    # OWS Operation methods
+
+    def GetTile(self):
+        """
+        Return a tile image.  Tiles are cached in the WMS tile cache.
+
+        """
+        layerName = self.getOwsParam('layer')
+        layerObj = self._getLayerFromMap(layerName)
+
+        style = self.getOwsParam('style', default='')
+        if style.lower() == 'default':
+            style = ''
+
+        format = self.getOwsParam('format', default='image/png')
+        if format not in self.tileFormats:
+            raise InvalidParameterValue('Format %s not supported' % format, 'format')
+
+        tileMatrixSet = self._getTileMatrixSetParam()
+        matrix, row, column = self._getTileParams(tileMatrixSet)
+
+        crs = tileMatrixSet.getLayerCRS(layerObj.crss)
+        if crs is None:
+            raise InvalidParameterValue('Layer %s does not support TileMatrixSet %s'
+                                        % (layerName, tileMatrixSet.identifier),
+                                        'tilematrixset')
+
+        dimValues = self._getRestoredDimValues(layerObj)
+
+        expectedParams = []
+        expectedParams.extend(self._tileParams)
+        expectedParams.extend(self._mapDimToParam(d) for d in layerObj.dimensions.keys())
+        additionalParams = self._getAdditionalParameters(expectedParams)
+
+        tileKey = repr(('wmts', self._getCacheContext(), layerName, style,
+                        tileMatrixSet.identifier, matrix.identifier, row, column,
+                        format, sorted(dimValues.items()),
+                        sorted(additionalParams.items())))
+
+        layerArgs = [(layerObj, crs, style, dimValues, True, '0xFFFFFF',
+                      additionalParams)]
+        cacheable = isCacheable(layerArgs)
+
+        tileCache = self._getTileCache()
+        cached = None
+        if cacheable:
+            cached = tileCache.get(tileKey)
+
+        if cached is not None:
+            etag, data = cached
+            log.debug("tile cache hit")
+        else:
+            bbox = matrix.getTileBBox(row, column)
+
+            img = self._renderMap(layerArgs, bbox, matrix.tileWidth, matrix.tileHeight)
+
+            data = self._encodeImage(img, format)
+            etag = sha1(data).hexdigest()
+            if cacheable:
+                tileCache.put(tileKey, (etag, data))
+
+        self._writeImageData(data, format, etag)
@@ -0,0 +1,340 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Command line tool to fill the WMS tile and slab caches before a dataset
+is published.
+
+The seeder loads the COWS application from its paste configuration file
+in each of a pool of worker processes and renders GetMap requests for a
+grid of tiles through it, so tiles are built by exactly the same
+WMSController and layer mapper code as live requests.  The caches must
+use a shared backend (cows.wms.tile_cache.backend = disk or memcached)
+for the seeded tiles to be visible to the server.
+
+Tile cache keys include every request parameter, so the seeder must send
+the same parameters as the tiling client, see the --version and --param
+options.  WMS 1.3.0 bounding boxes are sent in (lat, lon) order for
+EPSG:4326 if cows.wms.handleLatLongCoords is set, as the server expects.
+
+Usage::
+
+    cows-seed [options] CONFIG_FILE FILEORURI
+
+"""
+
+import sys
+import os
+import time
+import urllib
+import logging
+from optparse import OptionParser
+from multiprocessing import Pool
+
+from cows.tile_grid import DEFAULT_EXTENTS, getLevelTileSize, iterLevelTiles
+from cows.bbox_util import isLatLonOrderCrs, swapAxes
+
+log = logging.getLogger(__name__)
+
+# The application used by each worker process, see _initWorker()
+_app = None
+
+def _initWorker(configFile):
+    global _app
+
+    from paste.deploy import loadapp
+    import paste.fixture
+
+    _app = paste.fixture.TestApp(loadapp('config:%s' % configFile))
+
+def _seedTile(job):
+    """
+    Render one tile in a worker process.
+
+    :return: A tuple (tileId, error, seconds, size) where error is None if
+        the tile was rendered.
+    """
+    tileId, url = job
+    t0 = time.time()
+
+    try:
+        res = _app.get(url, status='*')
+    except Exception, e:
+        return tileId, 'exception: %s' % e, time.time() - t0, 0
+
+    contentType = res.header_dict.get('content-type', '')
+    if res.status != 200 or not contentType.startswith('image/'):
+        error = 'status %s, %s: %s' % (res.status, contentType, res.body[:200])
+        return tileId, error, time.time() - t0, 0
+
+    return tileId, None, time.time() - t0, len(res.body)
+
+class TileSeeder(object):
+    """
+    Enumerates the GetMap requests of a tile grid and renders them in a
+    pool of worker processes.
+
+    :ivar path: The URL path of the WMS, e.g. '/mydataset/wms'.
+    :ivar layers: A list of layer names.  Each layer is seeded separately.
+    :ivar styles: A list of style names to seed for every layer.
+    :ivar crs: The CRS of the tile grid.
+    :ivar extent: The extent of the tile grid in the CRS.
+    :ivar levels: A list of zoom levels.
+    :ivar bbox: Only tiles intersecting this bbox are seeded, or None.
+    :ivar tileSize: The width and height of a tile in pixels.
+    :ivar metaSize: Request one tile per metaSize x metaSize block.  Set it
+        to cows.wms.metatile.size when the server uses metatiles.
+    :ivar params: Other GetMap parameters, including dimension values,
+        as a list of (name, value) pairs.
+    :ivar handleLatLongCoords: The server's cows.wms.handleLatLongCoords.
+        If True bounding boxes are given in (lat, lon) order for CRSs
+        with that axis order in the WMS version.
+
+    """
+
+    def __init__(self, path, layers, styles=None, crs='EPSG:4326', extent=None,
+                 levels=(0,), bbox=None, tileSize=256, metaSize=1,
+                 version='1.1.1', format='image/png', transparent=True,
+                 params=(), handleLatLongCoords=False):
+        if extent is None:
+            try:
+                extent = DEFAULT_EXTENTS[crs.upper()]
+            except KeyError:
+                raise ValueError("No default extent for CRS %s" % crs)
+
+        self.path = path
+        self.layers = layers
+        self.styles = styles or ['']
+        self.crs = crs
+        self.extent = extent
+        self.levels = levels
+        self.bbox = bbox
+        self.tileSize = tileSize
+        self.metaSize = metaSize
+        self.version = version
+        self.format = format
+        self.transparent = transparent
+        self.params = list(params)
+        self.handleLatLongCoords = handleLatLongCoords
+
+    def _getUrl(self, layer, style, bbox):
+        if self.version == '1.3.0':
+            crsParam = 'CRS'
+        else:
+            crsParam = 'SRS'
+
+        if self.handleLatLongCoords and isLatLonOrderCrs(self.version, self.crs):
+            bbox = swapAxes(bbox)
+
+        params = [('SERVICE', 'WMS'),
+                  ('VERSION', self.version),
+                  ('REQUEST', 'GetMap'),
+                  ('LAYERS', layer),
+                  ('STYLES', style),
+                  (crsParam, self.crs),
+                  ('BBOX', ','.join(repr(x) for x in bbox)),
+                  ('WIDTH', self.tileSize),
+                  ('HEIGHT', self.tileSize),
+                  ('FORMAT', self.format),
+                  ('TRANSPARENT', str(self.transparent).upper())]
+        params.extend(self.params)
+
+        return '%s?%s' % (self.path, urllib.urlencode(params))
+
+    def iterJobs(self):
+        """
+        Iterate over the tiles to seed.
+
+        :return: An iterator of tuples (tileId, url).
+        """
+        for layer in self.layers:
+            for style in self.styles:
+                for level in self.levels:
+                    for column, row, bbox in iterLevelTiles(self.extent, level,
+                                                            self.bbox, self.metaSize):
+                        tileId = '%s/%s/%d/%d/%d' % (layer, style, level, column, row)
+                        yield tileId, self._getUrl(layer, style, bbox)
+
+    def seed(self, configFile, processes=1, resumeFile=None, out=sys.stdout,
+             reportInterval=10):
+        """
+        Render all the tiles.
+
+        @param configFile: The paste configuration file of the application.
+        @param resumeFile: A file recording the tiles that have been seeded.
+            Tiles listed in it are skipped so an interrupted run can be
+            resumed.
+        :return: The number of tiles that failed.
+        """
+        done = set()
+        if resumeFile is not None and os.path.exists(resumeFile):
+            done = set(line.strip() for line in open(resumeFile))
+
+        jobs = [job for job in self.iterJobs() if job[0] not in done]
+        out.write("%d tiles to seed, %d already seeded\n" % (len(jobs), len(done)))
+        if not jobs:
+            return 0
+
+        resume = None
+        if resumeFile is not None:
+            resume = open(resumeFile, 'a')
+
+        pool = Pool(processes, _initWorker, (os.path.abspath(configFile),))
+
+        t0 = lastReport = time.time()
+        count = failures = totalBytes = 0
+        try:
+            for tileId, error, seconds, size in pool.imap_unordered(_seedTile, jobs):
+                count += 1
+                if error is None:
+                    totalBytes += size
+                    if resume is not None:
+                        resume.write(tileId + '\n')
+                        resume.flush()
+                else:
+                    failures += 1
+                    log.error("Tile %s failed: %s" % (tileId, error))
+
+                now = time.time()
+                if now - lastReport >= reportInterval or count == len(jobs):
+                    lastReport = now
+                    rate = count / max(now - t0, 1e-6)
+                    out.write("%d/%d tiles (%.1f%%), %d failed, %.2f tiles/s, "
+                              "%.1f MB, about %ds left\n"
+                              % (count, len(jobs), 100.0 * count / len(jobs),
+                                 failures, rate, totalBytes / 1048576.0,
+                                 (len(jobs) - count) / rate))
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            out.write("Interrupted after %d tiles\n" % count)
+            raise
+        finally:
+            pool.join()
+            if resume is not None:
+                resume.close()
+
+        return failures
+
+def _getAppConfig(configFile):
+    from paste.deploy import appconfig
+
+    return appconfig('config:%s' % os.path.abspath(configFile))
+
+def _checkSharedCache(conf, out):
+    """
+    Warn if the tile cache of the application is only held in memory.
+    """
+    backend = conf.get('cows.wms.tile_cache.backend', 'memory') or 'memory'
+    if backend.lower() == 'memory':
+        out.write("Warning: cows.wms.tile_cache.backend is memory so seeded "
+                  "tiles will not be seen by the server\n")
+
+def _parseRange(value):
+    levels = []
+    for part in value.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            levels.extend(range(int(start), int(end) + 1))
+        else:
+            levels.append(int(part))
+    return levels
+
+def _parseBBox(value):
+    bbox = tuple(float(x) for x in value.split(','))
+    if len(bbox) != 4:
+        raise ValueError("A bbox needs 4 values")
+    return bbox
+
+def _parsePair(value):
+    if '=' not in value:
+        raise ValueError("Expected NAME=VALUE, got %s" % value)
+    return tuple(value.split('=', 1))
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options] CONFIG_FILE FILEORURI",
+                          description="Fill the WMS tile cache of a COWS server.")
+    parser.add_option('-l', '--layers', help="comma separated layer names (required)")
+    parser.add_option('-s', '--styles', default='',
+                      help="comma separated styles to seed for each layer")
+    parser.add_option('-d', '--dim', action='append', default=[], metavar='NAME=VALUE',
+                      help="a dimension value, may be repeated")
+    parser.add_option('--param', action='append', default=[], metavar='NAME=VALUE',
+                      help="another GetMap parameter sent by the clients, may be repeated")
+    parser.add_option('-z', '--levels', default='0',
+                      help="zoom levels, e.g. 0-3 or 0,2,4 (default %default)")
+    parser.add_option('-c', '--crs', default='EPSG:4326', help="CRS (default %default)")
+    parser.add_option('-e', '--extent',
+                      help="tile grid extent minx,miny,maxx,maxy (default for the CRS)")
+    parser.add_option('-b', '--bbox', help="only seed tiles intersecting minx,miny,maxx,maxy")
+    parser.add_option('-t', '--tile-size', type='int', default=256,
+                      help="tile width and height in pixels (default %default)")
+    parser.add_option('-m', '--metatile', type='int', default=1,
+                      help="the server's cows.wms.metatile.size (default %default)")
+    parser.add_option('-v', '--version', default='1.1.1',
+                      help="WMS version of the requests (default %default)")
+    parser.add_option('-f', '--format', default='image/png', help="(default %default)")
+    parser.add_option('--opaque', action='store_true', default=False,
+                      help="request TRANSPARENT=FALSE")
+    parser.add_option('--path', default='/%(fileoruri)s/wms',
+                      help="URL path of the WMS (default %default)")
+    parser.add_option('-p', '--processes', type='int', default=1,
+                      help="number of worker processes (default %default)")
+    parser.add_option('-r', '--resume', metavar='FILE',
+                      help="record seeded tiles in FILE and skip those already there")
+    parser.add_option('-n', '--dry-run', action='store_true', default=False,
+                      help="list the requests without rendering them")
+
+    options, args = parser.parse_args(argv)
+    if len(args) != 2 or not options.layers:
+        parser.error("CONFIG_FILE, FILEORURI and --layers are required")
+    configFile, fileoruri = args
+
+    logging.basicConfig(level=logging.WARNING)
+
+    conf = _getAppConfig(configFile)
+    handleLatLongCoords = conf.get('cows.wms.handleLatLongCoords', 'false').lower() == 'true'
+
+    try:
+        extent = bbox = None
+        if options.extent:
+            extent = _parseBBox(options.extent)
+        if options.bbox:
+            bbox = _parseBBox(options.bbox)
+        params = [_parsePair(x) for x in options.dim + options.param]
+        levels = _parseRange(options.levels)
+
+        seeder = TileSeeder(options.path % {'fileoruri': fileoruri},
+                            options.layers.split(','),
+                            styles=options.styles.split(','),
+                            crs=options.crs, extent=extent, levels=levels,
+                            bbox=bbox, tileSize=options.tile_size,
+                            metaSize=options.metatile, version=options.version,
+                            format=options.format,
+                            transparent=not options.opaque, params=params,
+                            handleLatLongCoords=handleLatLongCoords)
+    except ValueError, e:
+        parser.error(str(e))
+
+    if options.dry_run:
+        for level in levels:
+            sys.stdout.write("level %d: tile size %r\n" %
+                             (level, getLevelTileSize(seeder.extent, level)))
+        for tileId, url in seeder.iterJobs():
+            sys.stdout.write("%s %s\n" % (tileId, url))
+        return 0
+
+    _checkSharedCache(conf, sys.stdout)
+
+    failures = seeder.seed(configFile, options.processes, options.resume)
+
+    if failures:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
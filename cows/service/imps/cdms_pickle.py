@@ -0,0 +1,84 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+'''
+Functions to reduce a cdms variable to plain numpy arrays and rebuild it.
+
+cdms variables hold references to their source file, grid and axis objects
+and do not pickle reliably.  Layer slabs use these functions in
+__getstate__/__setstate__ so that they can be stored in shared caches.
+'''
+
+import numpy
+
+try:
+    import cdms2 as cdms
+except ImportError:
+    import cdms
+
+# Attribute types that are safe to pickle
+_simpleTypes = (basestring, int, long, float, bool, numpy.number, numpy.ndarray)
+
+def _simpleAttributes(attributes):
+    return dict((k, v) for k, v in attributes.items() if isinstance(v, _simpleTypes))
+
+def reduceVariable(var):
+    """
+    Return a pickleable dictionary describing a cdms variable, its mask and
+    its axes.
+    """
+    mask = numpy.ma.getmask(var)
+    if mask is not numpy.ma.nomask:
+        mask = numpy.array(mask, dtype=bool)
+    else:
+        mask = None
+
+    axes = []
+    for axis in var.getAxisList():
+        bounds = axis.getBounds()
+        if bounds is not None:
+            bounds = numpy.array(bounds)
+
+        axes.append(dict(id=axis.id,
+                         values=numpy.array(axis[:]),
+                         bounds=bounds,
+                         attributes=_simpleAttributes(axis.attributes),
+                         isLatitude=axis.isLatitude(),
+                         isLongitude=axis.isLongitude(),
+                         isTime=axis.isTime()))
+
+    return dict(id=var.id,
+                data=numpy.array(numpy.ma.getdata(var)),
+                mask=mask,
+                fill_value=var.fill_value,
+                attributes=_simpleAttributes(var.attributes),
+                axes=axes)
+
+def restoreVariable(state):
+    """
+    Rebuild a cdms TransientVariable from the output of reduceVariable.
+    """
+    axes = []
+
+    for a in state['axes']:
+        axis = cdms.createAxis(a['values'], bounds=a['bounds'], id=a['id'])
+
+        for k, v in a['attributes'].items():
+            setattr(axis, k, v)
+
+        if a['isLatitude']:
+            axis.designateLatitude()
+        elif a['isLongitude']:
+            axis.designateLongitude()
+        elif a['isTime']:
+            axis.designateTime()
+
+        axes.append(axis)
+
+    return cdms.createVariable(state['data'], mask=state['mask'],
+                               fill_value=state['fill_value'], axes=axes,
+                               attributes=state['attributes'], id=state['id'])
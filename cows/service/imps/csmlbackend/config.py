@@ -17,16 +17,26 @@ these values, see cows.pylons.config.py for details.
 config = dict(
     # Directory where GridSeries are temporarily extracted to.
     tmpdir = '/tmp',
+    # Directory WMS GridSeries subsets are extracted to before being read
+    # back.  Defaults to /dev/shm if writable, otherwise tmpdir.
+    extractdir = None,
     # Name of the matplotlib colourmap to use
     colourmap = 'jet',
+    # How grids are resampled onto WMS images: nearest, bilinear or resize
+    resampling = 'nearest',
     # Where to publish CSML documents to
     publish_dir = '/tmp',
     # Where CSML sources are stored
     csmlstore = None,
+    # Where plain CF-NetCDF files served without CSML documents are stored
+    netcdfstore = None,
     # Where the ndg configuration is, if required
     ndgconfig = None,
     # Location of WFS config file
     wfsconfig = None,
+    # Seconds between checks for changes to the CSML files behind cached
+    # layer maps
+    source_check_interval = 10,
     # Location of legend font
     legendfont = '/usr/share/fonts/truetype/msttcorefonts/arial.ttf',
     )
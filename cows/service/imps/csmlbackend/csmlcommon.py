@@ -159,6 +159,28 @@ class CSMLConnector(object):
         d.parse(f)                      
         return d
     
+    def getSourcePaths(self, fileoruri):
+        """
+        Returns the local files, and directories for a group, that the
+        layers of fileoruri are built from.  Returns None for documents
+        held in eXist.
+        """
+        if string.find(fileoruri,'__NDG-A0__') != -1:
+            return None
+        
+        path = os.path.join(self.csml_dir, fileoruri)
+        
+        if not os.path.isdir(path):
+            return [path + ext for ext in ('.csml', '.xml', '.ini')]
+        
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            paths.append(dirpath)
+            for filename in filenames:
+                if os.path.splitext(filename)[1] in ('.csml', '.xml', '.ini'):
+                    paths.append(os.path.join(dirpath, filename))
+        return paths
+    
     def getColourMapConfig(self, fileoruri):
         """ looks for a mydataset.ini file alongside the csml mydataset.xml file
         the config file contains entries for max min values of data e.g. for use in consistent colourmapping """
@@ -7,17 +7,151 @@
 
 
 import os
+import tempfile
+import threading
 
 import csml
 import cdms2 as cdms
 
 from cows.service.imps.csmlbackend.config import config
 from cows.service.imps.csmlbackend import getGlobalCSMLConnector
+from cows.cache import cacheFromConfig, LRUCache, SingleFlight, getLastModified
+from cows.service.imps.variable_stats import computeStats
+from cows.timing import timed
+from cows import metrics
 
 import numpy
 import logging
 
 log = logging.getLogger(__name__)
+
+# Memory backed filesystem used for extracts when config['extractdir'] is
+# not set.
+_SHM_DIR = '/dev/shm'
+
+_extractDir = None
+
+_globalLock = threading.Lock()
+
+_globalVarCache = None
+
+def getGlobalVarCache():
+    """
+    Returns the cache of extracted variables shared by all CSMLDataReader
+    instances.  It is configured by the varcache.* options (i.e.
+    cows.csml.varcache.* in the pylons config), see
+    cows.cache.cacheFromConfig.
+    """
+    global _globalVarCache
+    
+    if _globalVarCache is None:
+        _globalLock.acquire()
+        try:
+            if _globalVarCache is None:
+                _globalVarCache = cacheFromConfig(config, 'varcache', maxBytes='256M')
+        finally:
+            _globalLock.release()
+    
+    return _globalVarCache
+
+# Statistics are small so are kept for many more variables than the
+# variable cache holds.
+_globalStatsCache = LRUCache(maxEntries=10000)
+
+def getGlobalStatsCache():
+    """
+    Returns the cache of VariableStats shared by all CSMLDataReader instances.
+    """
+    return _globalStatsCache
+
+# Latitude/longitude axis arrays of each feature, used for point queries.
+_globalAxisCache = LRUCache(maxEntries=1000)
+
+metrics.registerCache('csml_variable', lambda: _globalVarCache)
+metrics.registerCache('csml_stats', lambda: _globalStatsCache)
+metrics.registerCache('csml_axis', lambda: _globalAxisCache)
+
+_varFlight = None
+
+def getVarFlight():
+    """
+    Returns the SingleFlight object that makes concurrent requests for the
+    same variable share one extraction.  Waiting requests give up after
+    config['varcache.wait_timeout'] seconds.
+    """
+    global _varFlight
+    
+    if _varFlight is None:
+        _globalLock.acquire()
+        try:
+            if _varFlight is None:
+                _varFlight = SingleFlight(timeout=float(config.get('varcache.wait_timeout', 120)))
+        finally:
+            _globalLock.release()
+    
+    return _varFlight
+
+def getExtractDir():
+    """
+    Returns the directory GridSeries subsets are extracted to.  This is
+    config['extractdir'] if set, otherwise /dev/shm when it is writable so
+    the extract never touches a disk, otherwise config['tmpdir'].
+    """
+    global _extractDir
+    
+    if _extractDir is None:
+        if config.get('extractdir'):
+            _extractDir = config['extractdir']
+        elif os.path.isdir(_SHM_DIR) and os.access(_SHM_DIR, os.W_OK):
+            _extractDir = _SHM_DIR
+        else:
+            _extractDir = config['tmpdir']
+        
+        log.info("Extracting CSML subsets to %s" % (_extractDir,))
+    
+    return _extractDir
+    
+def _stripZ(timeString):
+    #remove any trailing Zs from time string
+    if timeString[-1:] in ['Z', 'z']:
+        return timeString[:-1]
+    return timeString
+
+def _isoTime(comptime):
+    return '%04d-%02d-%02dT%02d:%02d:%02dZ' % (comptime.year, comptime.month, comptime.day,
+                                               comptime.hour, comptime.minute, int(comptime.second))
+
+def _nearestAxisValue(axis, x):
+    """
+    Returns the value in axis nearest x, or None if x is more than half a
+    grid spacing beyond the ends of the axis.
+    """
+    i = numpy.abs(axis - x).argmin()
+    
+    if len(axis) > 1:
+        halfSpacing = numpy.abs(numpy.diff(axis)).max() / 2.0
+    else:
+        halfSpacing = 0.0
+    
+    if abs(axis[i] - x) > halfSpacing:
+        return None
+    
+    return float(axis[i])
+
+def _nearestGridPoint(lonAxis, latAxis, lon, lat):
+    """
+    Returns the grid point (gridLon, gridLat) of the grid box containing
+    (lon, lat), either of which is None if the point is beyond the grid.
+    Longitudes are also matched 360 degrees either side so that points
+    are found on grids using 0 to 360 longitudes, including either side
+    of the 0/360 seam.
+    """
+    for x in (lon, lon + 360, lon - 360):
+        gridLon = _nearestAxisValue(lonAxis, x)
+        if gridLon is not None:
+            break
+    
+    return gridLon, _nearestAxisValue(latAxis, lat)
     
 class CSMLDataReader(object):
     """
@@ -34,84 +168,253 @@ class CSMLDataReader(object):
         self.connector = getGlobalCSMLConnector()
         self.fileoruri = fileoruri
         self.ds = self.connector.getCsmlDoc(fileoruri)
-        self.varcache = {} 
+        self.varcache = getGlobalVarCache()
+        self.statscache = getGlobalStatsCache()
+        self.lastModified = self._getSourcesLastModified()
 
     def getNetcdfVar(self, featureId,  dimValues):
         "Opens up the csml and retrieves the variable described by the dimensions"
         
         log.debug("featureId = %s, dimValues = %s" % (featureId, dimValues))
         
-        dimList = list(dimValues.items())
-        dimList.sort()
-        
-        cacheKey = "%s:%s" % (featureId, dimList)
+        cacheKey = self._getCacheKey(featureId, dimValues)
 
-        if cacheKey not in self.varcache:
+        variable = self.varcache.get(cacheKey)
+
+        if variable is None:
+            variable = getVarFlight().do(cacheKey, self._loadVariable, 
+                                         featureId, dimValues, cacheKey)
+
+        return variable
+    
+    def getVariableStats(self, featureId, dimValues):
+        """
+        Returns the VariableStats of the variable described by the 
+        dimensions.  These are computed when the variable is extracted and
+        cached separately, so usually no data needs to be read.
+        """
+        cacheKey = self._getCacheKey(featureId, dimValues)
+        
+        stats = self.statscache.get(cacheKey)
+        
+        if stats is None:
+            variable = self.getNetcdfVar(featureId, dimValues)
+            stats = computeStats(variable)
+            self.statscache.put(cacheKey, stats)
         
+        return stats
+    
+    def getPointValue(self, featureId, dimValues, lon, lat):
+        """
+        Returns the value of the grid box containing (lon, lat) as a tuple
+        (value, gridLon, gridLat) where gridLon/gridLat are the coordinates
+        of the grid point.  value is None if the point is outside the grid
+        or the value is missing.
+        
+        If the variable for dimValues is cached the value is read from it,
+        otherwise only the single grid point is extracted from the CSML 
+        storage rather than the whole lat/lon field.
+        """
+        lonAxis, latAxis = self._getLatLonAxes(featureId)
+        
+        gridLon, gridLat = _nearestGridPoint(lonAxis, latAxis, lon, lat)
+        
+        if gridLon is None or gridLat is None:
+            return None, gridLon, gridLat
+        
+        variable = self.varcache.get(self._getCacheKey(featureId, dimValues))
+        
+        if variable is not None:
+            point = variable(latitude=(gridLat, gridLat, 'cob'), 
+                             longitude=(gridLon, gridLon, 'cob'))
+        else:
             feature = self._getFeature(featureId)
             
-            convertedDimVals = self._convertDimValues(dimValues)
+            if type(feature) != csml.parser.GridSeriesFeature:
+                raise NotImplementedError
             
-            variable = None
+            convertedDimVals = self._convertDimValues(dimValues)
+            convertedDimVals['latitude'] = (gridLat, gridLat)
+            convertedDimVals['longitude'] = (gridLon, gridLon)
+            point = self._extractVariable(feature, convertedDimVals)
+        
+        value = numpy.ma.ravel(point)[0]
+        
+        if value is numpy.ma.masked or not numpy.isfinite(value):
+            value = None
+        else:
+            value = float(value)
+        
+        return value, gridLon, gridLat
+    
+    def getPointSeries(self, featureId, dimValues, lon, lat):
+        """
+        Returns the time series at the grid box containing (lon, lat) as a
+        tuple (times, values, gridLon, gridLat).  times are ISO 8601 
+        strings and values are floats, or None where the value is missing.
+        
+        dimValues['time'] may be a range "start/end" in which case every
+        time step in the range is extracted in a single subset of one grid
+        point.
+        """
+        lonAxis, latAxis = self._getLatLonAxes(featureId)
+        
+        gridLon, gridLat = _nearestGridPoint(lonAxis, latAxis, lon, lat)
+        
+        if gridLon is None or gridLat is None:
+            return [], [], gridLon, gridLat
+        
+        feature = self._getFeature(featureId)
+        
+        if type(feature) != csml.parser.GridSeriesFeature:
+            raise NotImplementedError
+        
+        convertedDimVals = self._convertDimValues(dimValues)
+        convertedDimVals['latitude'] = (gridLat, gridLat)
+        convertedDimVals['longitude'] = (gridLon, gridLon)
+        
+        variable = self._extractVariable(feature, convertedDimVals, squeeze=0)
+        
+        values = []
+        for value in numpy.ma.ravel(variable):
+            if value is numpy.ma.masked or not numpy.isfinite(value):
+                values.append(None)
+            else:
+                values.append(float(value))
+        
+        timeAxis = variable.getTime()
+        if timeAxis is not None:
+            times = [_isoTime(t) for t in timeAxis.asComponentTime()]
+        else:
+            times = [dimValues.get('time')] * len(values)
+        
+        return times, values, gridLon, gridLat
+    
+    def _getLatLonAxes(self, featureId):
+        """
+        Returns the longitude and latitude axis values of a feature as numpy
+        arrays.  These are read from the CSML domain once and cached.
+        """
+        cacheKey = (self.fileoruri, self.lastModified, featureId)
+        axes = _globalAxisCache.get(cacheKey)
+        
+        if axes is None:
+            domain = self._getFeature(featureId).getDomain()
+            axes = (numpy.asarray(domain['longitude'], dtype=numpy.float64),
+                    numpy.asarray(domain['latitude'], dtype=numpy.float64))
+            _globalAxisCache.put(cacheKey, axes)
+        
+        return axes
+    
+    def _getSourcesLastModified(self):
+        """
+        Returns the modification time of the CSML files of self.fileoruri,
+        or None if it is unknown.  Layer maps are rebuilt, with new data
+        readers, when this changes.
+        """
+        paths = self.connector.getSourcePaths(self.fileoruri)
+        if paths is None:
+            return None
+        
+        return getLastModified(paths)
+    
+    def _getCacheKey(self, featureId, dimValues):
+        dimList = list(dimValues.items())
+        dimList.sort()
+        
+        # The variable cache outlives the reader so include the time the
+        # sources were modified, otherwise variables extracted before a
+        # change would still be used.
+        return "%s:%s:%s:%s" % (self.fileoruri, self.lastModified, featureId, dimList)
+    
+    def _loadVariable(self, featureId, dimValues, cacheKey):
+        """
+        Reads the variable and adds it, and its statistics, to the caches.
+        """
+        # Another request may have loaded it between our cache miss and
+        # this call starting
+        variable = self.varcache.get(cacheKey)
+        if variable is not None:
+            return variable
+        
+        variable = self._readVariable(featureId, dimValues)
+        
+        self.statscache.put(cacheKey, computeStats(variable))
+        self.varcache.put(cacheKey, variable, group=self.fileoruri)
+
+        return variable
+
+    def _readVariable(self, featureId, dimValues):
+        """
+        Extracts the variable and masks any NaNs.
+        """
+        feature = self._getFeature(featureId)
+        
+        convertedDimVals = self._convertDimValues(dimValues)
+        
+        variable = None
+        
+        if type(feature) == csml.parser.GridSeriesFeature:
+            variable = self._extractVariable(feature, convertedDimVals)
             
-            if type(feature) == csml.parser.GridSeriesFeature:
-                
-                randomname= csml.csmllibs.csmlextra.getRandomID() + '.nc'
-                
-                log.debug("getting csml feature tmpdir = %s, ncname = %s, convertedDimVals = %s" \
-                          % (config['tmpdir'], randomname, convertedDimVals))
-                
-                result= feature.subsetToGridSeries(config['tmpdir'], 
-                                            ncname=randomname, **convertedDimVals)
-              
-                extract = result[2]
+        else:
+            raise NotImplementedError
+        
+        
+        #try to set any NAN variable to masked variables
+        try:
+            #replace any NaN's with masked values, masking them expands
+            #the mask in place if it is a single value
+            data = numpy.ma.getdata(variable)
+            are_nan = numpy.isnan(data)
 
-                variable_name = extract.variableName.CONTENT
-                
-                #for now have to read netcdf back from 
-                #disk (limitiation of CSML api)
-                netcdf=cdms.open(result[1])
-                try:                 
-                    variable =  netcdf(variable_name, squeeze=1)
-                finally:
-                    netcdf.close()
-                
-                #and then delete the temporary file
-                os.system('rm %s'%result[1])
-                
-                log.debug("removed temp file %s" % (result[1],))
-                
-            else:
-                raise NotImplementedError
+            if are_nan.any():
+                missing = variable.getMissing()
+                if missing is None:
+                    missing = variable.fill_value
+                    
+                data[are_nan] = missing
+                variable[are_nan] = numpy.ma.masked
+        
+        except:
+            log.exception("Exception occurred while trying to fix NAN numbers in variable.")
+            raise
+        
+        return variable
+
+    @timed('extract')
+    def _extractVariable(self, feature, convertedDimVals, squeeze=1):
+        """
+        Extracts a subset of a GridSeries feature and returns it as a cdms
+        variable, with axes of length 1 removed if squeeze is true.
+        
+        The CSML API can only write subsets to a NetCDF file so the file is
+        written to a memory backed directory (see getExtractDir), read back
+        and removed straight away.
+        """
+        (fd, filename) = tempfile.mkstemp('.nc', 'csml_wms_', getExtractDir())
+        os.close(fd)
+        
+        log.debug("getting csml feature extractdir = %s, ncname = %s, convertedDimVals = %s" \
+                  % (os.path.dirname(filename), os.path.basename(filename), convertedDimVals))
+        
+        try:
+            result = feature.subsetToGridSeries(os.path.dirname(filename), 
+                                   ncname=os.path.basename(filename), **convertedDimVals)
             
+            variable_name = result[2].variableName.CONTENT
             
-            #try to set any NAN variable to masked variables
+            netcdf = cdms.open(result[1])
             try:
-                #replace any NaN's with masked values
-                are_nan = numpy.isnan(variable)
-
-                if are_nan.any():
-                    # if the mask is just a single value we need to expand it
-                    if variable.mask.shape != variable.shape:
-                        
-                        if variable.mask:
-                            variable.mask = numpy.ones(variable.shape)
-                        else:
-                            variable.mask = numpy.zeros(variable.shape)
-                        
-                    variable[are_nan] = variable.getMissing()
-                    variable.mask[are_nan] = True
-            
-            except:
-                log.exception("Exception occurred while trying to fix NAN numbers in variable.")
-                raise
-            
-            self.varcache[cacheKey] = variable
-        else:
-            variable = self.varcache[cacheKey]
-
+                variable = netcdf(variable_name, squeeze=squeeze)
+            finally:
+                netcdf.close()
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+                log.debug("removed temp file %s" % (filename,))
+        
         return variable
-    
 
     def _getFeature(self, id):
         for feature in csml.csmllibs.csmlextra.listify(self.ds.featureCollection.featureMembers):
@@ -124,18 +427,19 @@ class CSMLDataReader(object):
     def _convertDimValues(self, dimValues):
         """
         Converts the string dimension values to floats (except for time values)
+        A time range "start/end" is converted to a tuple (start, end).
         """
         convertedVals = {}
         
         for dimval in dimValues:
             if dimval != 'time':
                 convertedVals[dimval]=float(dimValues[dimval])
+            elif '/' in dimValues[dimval]:
+                start, end = dimValues[dimval].split('/')[:2]
+                convertedVals[dimval] = (_stripZ(start), _stripZ(end))
             else:
                 #remove any trailing Zs from time string
-                if dimValues[dimval] [-1:] in ['Z', 'z']:
-                    convertedVals[dimval]=dimValues[dimval][:-1]
-                else:
-                    convertedVals[dimval] = dimValues[dimval]  
+                convertedVals[dimval] = _stripZ(dimValues[dimval])
 
         return convertedVals
     
@@ -16,19 +16,29 @@ Created on 9 Jun 2009
 @author: pnorton
 '''
 
+import time
 import logging
 from copy import copy
 
 from cows.service.wxs_iface import ILayerMapper
+from cows.service.imps.csmlbackend.config import config
+from cows.service.imps.csmlbackend import getGlobalCSMLConnector
+from cows.cache import getLastModified
+from cows import metrics
 
 from cows.service.imps.csmlbackend.wms.csml_layer_builder import CSMLLayerBuilder
 
 log = logging.getLogger(__name__)
 
+layerMapCounter = metrics.registry.counter(
+    'cows_layer_map_lookups_total',
+    'Layer map lookups by whether a cached layer map was used.', ['result'])
+
 class CSMLWmsLayerMapper(ILayerMapper):
     
     def __init__(self):
         self.layermapcache={}
+        self.connector = getGlobalCSMLConnector()
    
     def map(self, **kwargs):
         """
@@ -40,9 +50,10 @@ class CSMLWmsLayerMapper(ILayerMapper):
         """
         fileoruri=kwargs['fileoruri']
         
-        if fileoruri in self.layermapcache.keys():
+        if fileoruri in self.layermapcache.keys() and not self._sourcesChanged(fileoruri):
             
             log.debug("cached layermap used for fileoruri = %s" % (fileoruri,))
+            layerMapCounter.inc(('hit',))
             
             self.datasetName = self.layermapcache[fileoruri]['dsName'] 
             #we've accessed this layer map before, get it from the cache dictionary
@@ -50,8 +61,11 @@ class CSMLWmsLayerMapper(ILayerMapper):
         
 
         log.debug("loading layermap for fileoruri = %s" % (fileoruri,))
+        layerMapCounter.inc(('miss',))
         layermap={}
         
+        lastModified = self._getSourcesLastModified(fileoruri)
+        
         builder = self._getBuilder(fileoruri)
         
         self.datasetName = builder.getDSName(fileoruri)
@@ -60,10 +74,52 @@ class CSMLWmsLayerMapper(ILayerMapper):
             layermap[layer.title] = layer
         
         if len(layermap) > 0:
-            self.layermapcache[fileoruri]={'layermap':layermap, 'dsName':self.datasetName}
+            self.layermapcache[fileoruri]={'layermap':layermap, 'dsName':self.datasetName,
+                                           'lastModified':lastModified,
+                                           'checked':time.time()}
             return layermap
         else:
             raise ValueError
+    
+    def getLastModified(self, **kwargs):
+        """
+        Returns the modification time of the CSML files the layers last 
+        returned by map() were built from, or None if it is unknown.
+        Controllers use this to cache documents describing the layers.
+        """
+        entry = self.layermapcache.get(kwargs['fileoruri'])
+        if entry is None:
+            return None
+        
+        return entry['lastModified']
+    
+    def _getSourcesLastModified(self, fileoruri):
+        paths = self.connector.getSourcePaths(fileoruri)
+        if paths is None:
+            return None
+        
+        return getLastModified(paths)
+    
+    def _sourcesChanged(self, fileoruri):
+        """
+        Checks whether the CSML files behind a cached layer map have changed,
+        at most once every source_check_interval seconds.
+        """
+        entry = self.layermapcache[fileoruri]
+        
+        if entry['lastModified'] is None:
+            return False
+        
+        now = time.time()
+        if now - entry['checked'] < float(config['source_check_interval']):
+            return False
+        
+        entry['checked'] = now
+        if self._getSourcesLastModified(fileoruri) != entry['lastModified']:
+            log.info("CSML sources for %s have changed, reloading layers" % (fileoruri,))
+            return True
+        
+        return False
         
     def _getBuilder(self, fileoruri):
         """
@@ -10,6 +10,12 @@ implementation of ILayerMapper, IwmsLayer, IwmsDimension, ILayerSlab interfaces,
 
 """
 import os, string
+import csv
+from cStringIO import StringIO
+try:
+    import json
+except ImportError:
+    import simplejson as json
 import csml
 try:
     import cdms2 as cdms
@@ -22,6 +28,8 @@ except ImportError:
     import Image, ImageFont, ImageDraw
 from copy import copy
 from cows.service.imps.pywms.render_imp import RGBARenderer
+from cows.service.imps.cdms_pickle import reduceVariable, restoreVariable
+from cows.service.imps.variable_stats import computeStats
 from matplotlib import cm
 import cdtime
 import logging
@@ -39,6 +47,66 @@ from cows import bbox_util
 
 DEFAULT_STYLE=''
 
+_legendFonts = {}
+
+def getLegendFont(size):
+    """
+    Returns the legend TrueType font (config['legendfont']) at the given
+    size.  Fonts are loaded once per process.
+    """
+    key = (config['legendfont'], size)
+    font = _legendFonts.get(key)
+    
+    if font is None:
+        font = ImageFont.truetype(config['legendfont'], size)
+        _legendFonts[key] = font
+    
+    return font
+
+FEATURE_INFO_FORMATS = ['text/html', 'text/csv', 'application/json']
+
+def formatPointSeries(format, lon, lat, times, values, units):
+    """
+    Formats a time series at a point as a GetFeatureInfo response.
+
+    @param format: text/html, text/csv or application/json.
+    @param times: A list of ISO 8601 time strings.
+    @param values: A list of the values at each time, None for missing values.
+    :return: A string.
+
+    """
+    if format == 'application/json':
+        return json.dumps(dict(longitude=lon, latitude=lat, units=units,
+                               times=times, values=values))
+    
+    if format == 'text/csv':
+        buf = StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(['time', 'longitude', 'latitude', 'value'])
+        for t, v in zip(times, values):
+            if v is None:
+                v = ''
+            writer.writerow([t, lon, lat, v])
+        return buf.getvalue()
+    
+    rows = ''.join(["<tr><td>%s</td><td>%s</td></tr>" % (t, v) 
+                    for t, v in zip(times, values) if v is not None])
+    return "<table><tr><th>Time</th><th>Value (%s)</th></tr>%s</table>" % (units, rows)
+
+def getSubsetIntervals(bbox, dx, dy):
+    """
+    Returns the (latitude, longitude) intervals to subset a grid with
+    spacing dx, dy for the image of bbox.  Grid points are the centres of
+    grid boxes so a box may overlap the bbox while its point is outside
+    it.  The intervals are a grid box wider than bbox on each side to
+    include those boxes, but the longitude interval is never widened
+    beyond 360 degrees.
+    """
+    lonMargin = max(0.0, min(dx, (360.0 - (bbox[2] - bbox[0])) / 2.0))
+    
+    return ((bbox[1] - dy, bbox[3] + dy),
+            (bbox[0] - lonMargin, bbox[2] + lonMargin))
+
 class Old_CSMLwmsLayerMapper(CSMLLayerMapper):
     """
     Map keyword arguments to a collection of layers.
@@ -161,7 +229,7 @@ class CSMLwmsLayer(IwmsLayer):
                 raise ValueError("Layer must provide a bounding box in EPSG:4326 "
                                  "coordinates for compatibility with WMS-1.3.0")
                 
-        self.featureInfoFormats = ['text/html']
+        self.featureInfoFormats = list(FEATURE_INFO_FORMATS)
         self.featureinfofilecache={} #used for caching netcdf file in getFeatureInfo
         
     def getBBox(self, crs):
@@ -192,9 +260,11 @@ class CSMLwmsLayer(IwmsLayer):
         """
 
         var = self.dataReader.getNetcdfVar(self.title, dimValues)
+        stats = self.dataReader.getVariableStats(self.title, dimValues)
         
         bbox=self.getBBox(crs)
-        slab = CSMLwmsLayerSlab(var, self, crs, dimValues, additionalParams, bbox)
+        slab = CSMLwmsLayerSlab(var, self, crs, dimValues, additionalParams, bbox, 
+                                stats=stats)
         self._minval=slab.minval #needed for legend rendering.
         self._maxval=slab.maxval
         return slab
@@ -217,9 +287,17 @@ class CSMLwmsLayer(IwmsLayer):
 
         #set the default style if none provided
         s = self._getActualStyle(style)
+        
+        #cached slabs outlive the layer map, which is rebuilt when the 
+        #sources change, so include the file and the time it was modified
+        fileoruri = lastModified = None
+        if self.dataReader is not None:
+            fileoruri = self.dataReader.fileoruri
+            lastModified = self.dataReader.lastModified
             
-        return '%s:%s:%s:%s:%s:%s:%s' % (self.name, crs, s, dimList,
-                                      transparent, bgcolor, additionalParams)
+        return '%s:%s:%s:%s:%s:%s:%s:%s:%s' % (fileoruri, lastModified, self.name, 
+                                      crs, s, dimList, transparent, bgcolor, 
+                                      additionalParams)
 
     def _getActualStyle(self, style=None):
         actualStyle = None
@@ -237,7 +315,9 @@ class CSMLwmsLayer(IwmsLayer):
         Return a response string descibing the feature at a given
         point in a given CRS.
 
-        Currently only "html" is supported as output format
+        A time range "start/end" may be given to return the time series at
+        the point.  Series are returned as text/csv, application/json or an
+        HTML table.
 
         @param format: One of self.featureInfoFormats.  Defines which
             format the response will be in.
@@ -248,30 +328,16 @@ class CSMLwmsLayer(IwmsLayer):
         :return: A string containing the response.
 
         """
+        if self._isSeriesRequest(format, dimValues):
+            return self._getFeatureInfoSeries(format, point, dimValues)
         
-        netcdf = self.dataReader.getNetcdfVar(self.title, dimValues)
-       
-        #Now grab the netCDF object for the point specified.
-        #The reason for the 'cob' option is so that if the grid the data 
-        #is defined on does not have a grid point at the point specified, 
-        #we should  still get the nearest location
+        #Read the value of the grid box containing the point, without
+        #extracting the whole field if it isn't already cached
+        value, gridLon, gridLat = self.dataReader.getPointValue(self.title, dimValues,
+                                                                point[0], point[1])
+        log.debug('value at grid point (%s, %s) = %s' % (gridLon, gridLat, value))
         
-        t_point = netcdf(latitude=(point[1], point[1], 'cob'), longitude=(point[0], point[0], 'cob'))
-        #now get the value recorded at this location
-        value = t_point.getValue().tolist()
-        log.debug(value)
-        log.debug(t_point.fill_value())
-        #and the fill_value too
-        fill_value = t_point.fill_value()
-        #value is actually embedded in a multi dimensional list, 
-        #so we need to extract the actual value from the list
-        while type(value) is list:
-                value = value[0]
-
-        #now check if the value is actually the fill_value rather than 
-        #a value recorded at the point specified
-        log.debug('%s %s' % (value, fill_value))
-        if (2*fill_value) == value:
+        if value is None:
                 value = "No value found at position: "+str(point[1])+", "+str(point[0])
         else:
                 value = "Value found at position: "+str(point[1])+", "+str(point[0])+" is: "+str(value)
@@ -279,6 +345,19 @@ class CSMLwmsLayer(IwmsLayer):
         # finally return the value
         return value
 
+    def _isSeriesRequest(self, format, dimValues):
+        return format != 'text/html' or '/' in dimValues.get('time', '')
+    
+    def _getFeatureInfoSeries(self, format, point, dimValues):
+        """
+        Returns the time series at a point read with a single subset of the
+        data, formatted by formatPointSeries.
+        """
+        times, values, gridLon, gridLat = self.dataReader.getPointSeries(
+                                  self.title, dimValues, point[0], point[1])
+        
+        return formatPointSeries(format, gridLon, gridLat, times, values, self.units)
+
     def getLegendImage(self, dimValues, orientation='horizontal', renderOpts={}
                        , style=None):
         """
@@ -296,8 +375,14 @@ class CSMLwmsLayer(IwmsLayer):
         if 'height' in renderOpts:
                 height = renderOpts['height']
                 
+        minval, maxval = self._minval, self._maxval
+        if self.dataReader is not None:
+            stats = self.dataReader.getVariableStats(self.title, dimValues)
+            if stats.count:
+                minval, maxval = stats.minval, stats.maxval
+        
         cmap = cm.get_cmap(config['colourmap'])
-        renderer=RGBARenderer(self._minval, self._maxval)
+        renderer=RGBARenderer(minval, maxval)
         
         log.debug("dimValues = %s" % (dimValues,))
 
@@ -308,15 +393,15 @@ class CSMLwmsLayer(IwmsLayer):
         imageWithLabels=Image.new('RGBA', (630, 80), "white")
         imageWithLabels.paste(legendImage, (0,0))
         #add minvalue label
-        minvalueImg=self._simpletxt2image(str(self._minval), (49,25))
+        minvalueImg=self._simpletxt2image(str(minval), (49,25))
         imageWithLabels.paste(minvalueImg,(0,40))
         #add midvalue  label
-        midvalue=self._minval+(self._maxval-self._minval)/2
+        midvalue=minval+(maxval-minval)/2
         #add maxvalue label
         midvalueImg=self._simpletxt2image(str(midvalue),(49,25))
         imageWithLabels.paste(midvalueImg,(280,40))
         #add maxvalue label
-        maxvalueImg=self._simpletxt2image(str(self._maxval), (49,25))
+        maxvalueImg=self._simpletxt2image(str(maxval), (49,25))
         imageWithLabels.paste(maxvalueImg,(575,40))
         #add units:
         unitsImg=self._simpletxt2image('Units of measure: %s'%str(self.units), (200,25))
@@ -326,8 +411,7 @@ class CSMLwmsLayer(IwmsLayer):
     
     def _simpletxt2image(self, text, size):
         image = Image.new('RGBA',size,"white")
-        fontfullpath = config['legendfont']
-        ifo = ImageFont.truetype(fontfullpath,16)
+        ifo = getLegendFont(16)
         draw = ImageDraw.Draw(image)
         draw.text((0, 0), text, font=ifo,fill=(100, 123, 165))
         return image
@@ -368,8 +452,9 @@ class CSMLwmsLayerSlab(IwmsLayerSlab):
     Implements LayerSlab
     Represents a particular horizontal slice of a WMS layer.
 
-    ILayerSlab objects are designed to be convenient to cache.
-    They should be pickleable to enable memcached support in the future.
+    ILayerSlab objects are designed to be convenient to cache.  When
+    pickled the variable is reduced to plain arrays and the layer is
+    dropped, so an unpickled slab has layer = None.
 
     :ivar layer: The source ILayer instance.
     :ivar crs: The coordinate reference system.
@@ -378,7 +463,7 @@ class CSMLwmsLayerSlab(IwmsLayerSlab):
     :ivar bbox: The bounding box as a 4-tuple.
     """
 
-    def __init__(self, var, layer, crs, dimValues, renderOpts, bbox):
+    def __init__(self, var, layer, crs, dimValues, renderOpts, bbox, stats=None):
         self._var=var
         self.layer = layer
         self.crs = crs
@@ -386,17 +471,28 @@ class CSMLwmsLayerSlab(IwmsLayerSlab):
         self.renderOpts=renderOpts
         self.bbox=bbox
         
-        #set colour map for ALL images from this slab
-        tvar=var(squeeze=1)
-        
-        #get the min and max values to use for the colourmapping.
-        #change the fill values to ensure they aren't picked up as false max/mins.
-        tvar.missing_value=999999999
-        value=tvar.getValue()
-        self.minval=min(min(l) for l in value)
-        tvar.missing_value=-0.000000001
-        value=tvar.getValue()
-        self.maxval=max(max(l) for l in value)
+        #get the min and max values to use for the colourmapping for ALL
+        #images from this slab. Masked and non-finite values are ignored.
+        if stats is None:
+            stats = computeStats(var)
+        if stats.count:
+            self.minval=stats.minval
+            self.maxval=stats.maxval
+        else:
+            #every value is missing so any range will do
+            self.minval=0
+            self.maxval=10.0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_var'] = reduceVariable(self._var)
+        # The layer holds the data reader and parsed CSML document.
+        state['layer'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._var = restoreVariable(state['_var'])
 
     def getImage(self, bbox, width, height):
         """
@@ -410,7 +506,7 @@ class CSMLwmsLayerSlab(IwmsLayerSlab):
         """
 
 
-        lbbox = self.layer.getBBox(self.crs)
+        lbbox = self.bbox
         ibbox = bbox_util.intersection(bbox, lbbox)
     
         log.debug('bbox = %s' % (bbox,))
@@ -446,7 +542,10 @@ class CSMLwmsLayerSlab(IwmsLayerSlab):
         
         cmap = cm.get_cmap(config['colourmap'])
 
-        grid=Grid(self.layer, self._var, bbox, width, height)
+        #grids resampled onto the image need the grid boxes overlapping the
+        #edges of the bbox, 'resize' stretches the subset to the image
+        grid=Grid(self.layer, self._var, bbox, width, height,
+                  padded=(config['resampling'] != 'resize'))
         #If there is no data for the requested area, return a blank image:
         #TODO this should be included in the overhauled rendering code
         if grid.ok ==False:
@@ -462,7 +561,7 @@ class CSMLwmsLayerSlab(IwmsLayerSlab):
         #maxval=max(max(l) for l in grid.value)
         minval=self.minval
         maxval=self.maxval
-        renderer=RGBARenderer(minval, maxval)         
+        renderer=RGBARenderer(minval, maxval, resampling=config['resampling'])
         return renderer.renderGrid(grid, bbox, width, height, cmap)
     
     
@@ -486,7 +585,11 @@ class Grid(object):
     :ivar long_name: The name of the field.
     :ivar units: The units of the field.
     """
-    def __init__(self, layer, var, bbox, width, height):
+    def __init__(self, layer, var, bbox, width, height, padded=False):
+        """
+        @param padded: If True the subset extends a grid box beyond the
+            bbox, see getSubsetIntervals.
+        """
         #we know the axes are called latitude and longitude as the CSML code has written it:
         v=var  
         
@@ -498,8 +601,12 @@ class Grid(object):
         self.long_name=v.id
         self.units=v.units
         #now do the subset.
+        if padded:
+            latInterval, lonInterval = getSubsetIntervals(bbox, self.dx, self.dy)
+        else:
+            latInterval, lonInterval = (bbox[1], bbox[3]), (bbox[0], bbox[2])
         try:
-            tvar=v(latitude=(bbox[1], bbox[3]), longitude=(bbox[0],bbox[2]),squeeze=1)     
+            tvar=v(latitude=latInterval, longitude=lonInterval, squeeze=1)
             if type(tvar) == numpy.float32:
                 order ='xy'
                 self.value=numpy.ndarray(tvar)
@@ -171,35 +171,21 @@ class GeoplotWmsLayer(CSMLwmsLayer):
         @return: A string containing the response.
 
         """
-        netcdf = self.dataReader.getNetcdfVar(self.title, dimValues)
-       
-        #Now grab the netCDF object for the point specified.
-        #The reason for the 'cob' option is so that if the grid the data 
-        #is defined on does not have a grid point at the point specified, 
-        #we should  still get the nearest location
+        if self._isSeriesRequest(format, dimValues):
+            return self._getFeatureInfoSeries(format, point, dimValues)
         
+        #Read the value of the grid box containing the point, without
+        #extracting the whole field if it isn't already cached
         try:
-            t_point = netcdf(latitude=(point[1], point[1], 'cob'), longitude=(point[0], point[0], 'cob'))
+            value, gridLon, gridLat = self.dataReader.getPointValue(self.title, dimValues,
+                                                                    point[0], point[1])
         except Exception, exc:
             value = "Value not available for the requested position"
             log.debug(value + ": " + str(point[1]) + ", " + str(point[0]) + ": " + exc.__str__())
             return value
 
-        #now get the value recorded at this location
-        value = t_point.getValue().tolist()
-        log.debug(value)
-        log.debug(t_point.fill_value)
-        #and the fill_value too
-        fill_value = t_point.fill_value
-        #value is actually embedded in a multi dimensional list, 
-        #so we need to extract the actual value from the list
-        while type(value) is list:
-                value = value[0]
-
-        #now check if the value is actually the fill_value rather than 
-        #a value recorded at the point specified
-        log.debug('%s %s' % (value, fill_value))
-        if (2*fill_value) == value:
+        if value is None:
+            value = "Value not available for the requested position"
             log.debug("No value found at position: "+str(point[1])+", "+str(point[0]))
         else:
             value = str(value)
@@ -224,7 +210,6 @@ class GeoplotWmsLayer(CSMLwmsLayer):
             
         if height == None:
             height = self.legendSize[1]
-        variable = self.dataReader.getNetcdfVar(self.title, dimValues)
         klass = self._getSlabClass(style)
 
         # Merge in configured options for the layer.
@@ -236,7 +221,13 @@ class GeoplotWmsLayer(CSMLwmsLayer):
         parser=SlabOptionsParser(klass.renderingOptions, renderOpts)
         log.debug("parser.getOption('cmap') %s" % parser.getOption('cmap'))
         
-        return klass.makeColourBar(width , height, orientation, self.units, renderOpts, variable)
+        # The data is only needed if the colour bar range isn't configured
+        if parser.getOption('cmap_min') is None or parser.getOption('cmap_max') is None:
+            stats = self.dataReader.getVariableStats(self.title, dimValues)
+        else:
+            stats = None
+        
+        return klass.makeColourBar(width , height, orientation, self.units, renderOpts, stats)
     
         #none of the below code is run anymore?
 #        parser = SlabOptionsParser(klass.renderingOptions, renderOpts)
@@ -15,6 +15,7 @@ import geoplot.colour_scheme as colour_scheme
 
 from cows.service.wms_iface import IwmsLayerSlab
 from cows.service.imps.image_import import Image
+from cows.service.imps.cdms_pickle import reduceVariable, restoreVariable
 from cows.service.imps.geoplot_wms_backend.slab_options_parser import SlabOptionsParser
 from cows.service.imps.geoplot_wms_backend.rendering_option import RenderingOption
     
@@ -65,6 +66,25 @@ class SlabBase(IwmsLayerSlab):
         self.parser = SlabOptionsParser(self.renderingOptions, renderOpts)
         self.ld = self._setupLayerDrawer()
     
+    def __getstate__(self):
+        """
+        The layer drawer and the cdms variable graph are not pickled, the
+        variable is reduced to plain arrays and the drawer is rebuilt when
+        unpickling.
+        """
+        state = self.__dict__.copy()
+        state['variable'] = reduceVariable(self.variable)
+        del state['ld']
+        del state['parser']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.variable = restoreVariable(state['variable'])
+        self._setUpColourMap(self.renderOpts.get('cmap', None))
+        self.parser = SlabOptionsParser(self.renderingOptions, self.renderOpts)
+        self.ld = self._setupLayerDrawer()
+
     @classmethod
     def _setUpColourMap(cls, cmapName):
         """Adds a colour map to those defined in the rendering options if it is valid and not
@@ -80,6 +100,35 @@ class SlabBase(IwmsLayerSlab):
                 cmapOptions.options.append(cmapName)
         log.debug("All known cmaps %s" % cmapOptions)
 
+    @classmethod
+    def _getColourBarRange(cls, parser, stats):
+        """
+        Returns the (min, max) of the colour bar, the cmap_min and cmap_max
+        options if given, otherwise the range of the variable.  A field
+        with no valid values has no range so a unit range is used.
+
+        @param stats: The VariableStats of the variable, may be None if
+            both options are given.
+        """
+        minval = parser.getOption('cmap_min')
+        if minval is None and stats is not None:
+            minval = stats.minval
+
+        maxval = parser.getOption('cmap_max')
+        if maxval is None and stats is not None:
+            maxval = stats.maxval
+
+        if minval is None and maxval is None:
+            minval, maxval = 0.0, 1.0
+        elif minval is None:
+            minval = maxval - 1.0
+        elif maxval is None:
+            maxval = minval + 1.0
+
+        log.debug('colour bar range %s to %s' % (minval, maxval))
+
+        return minval, maxval
+
     """
     Creates the layer drawer object so that it can be used in getImage
     """
@@ -7,7 +7,6 @@
 
 import logging
 import time
-import numpy
 
 import geoplot.colour_bar
 from geoplot.layer_drawer_contour import LayerDrawerContour
@@ -48,25 +47,10 @@ class SlabContour(SlabBase):
 
 
     @classmethod
-    def makeColourBar(cls, width , height, orientation, units, renderOpts, variable):
+    def makeColourBar(cls, width , height, orientation, units, renderOpts, stats):
         
         parser = SlabOptionsParser(SlabContour.renderingOptions, renderOpts)
-        minval = parser.getOption('cmap_min')
-        log.debug('setting minval as %s'%minval)
-        if minval == None:
-            minval = variable.min()
-            log.debug('setting minval as variable min%s'%minval)
-            
-        maxval = parser.getOption('cmap_max')
-        log.debug('setting maxval as %s'%maxval)
-        if maxval == None:
-            maxval = variable.max()
-            log.debug('setting maxval as variable max%s'%maxval)    
-            # can't have a colourbar with an infinite maximum, take the highest 
-            # non-inf value.
-            if maxval == numpy.inf:
-                log.debug(' maxval equals numpy infinite')
-                maxval = numpy.ma.masked_equal(variable, numpy.inf).max()
+        minval, maxval = cls._getColourBarRange(parser, stats)
         log.debug('intervals %s'%repr(parser.getOption('intervals')))
 
         # Check for non-default, but valid, colour map.
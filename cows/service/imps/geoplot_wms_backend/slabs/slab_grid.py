@@ -6,7 +6,6 @@
 # the full license text.
 
 import time
-import numpy
 import logging
 
 import geoplot.colour_bar
@@ -51,21 +50,11 @@ class SlabGrid(SlabBase):
         return ld
     
     @classmethod
-    def makeColourBar(cls, width , height, orientation, units, renderOpts, variable):
+    def makeColourBar(cls, width , height, orientation, units, renderOpts, stats):
         parser = SlabOptionsParser(SlabGrid.renderingOptions, renderOpts)
         log.debug('makeColourBar renderopts %s'%renderOpts)
-        minval = parser.getOption('cmap_min')
-        if minval == None:
-            minval = variable.min()
-            
-        maxval = parser.getOption('cmap_max')
-        if maxval == None:
-            maxval = variable.max()
-            
-            # can't have a colourbar with an infinite maximum, take the highest 
-            # non-inf value.
-            if maxval == numpy.inf:
-                maxval = numpy.ma.masked_equal(variable, numpy.inf).max()
+        minval, maxval = cls._getColourBarRange(parser, stats)
+
 
         # Check for non-default, but valid, colour map.
         cls._setUpColourMap(renderOpts.get('cmap', None))
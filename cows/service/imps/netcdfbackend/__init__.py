@@ -0,0 +1,28 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+A WMS and WCS backend serving CF-NetCDF files directly, without CSML
+documents.
+
+Files are read from the cows.csml.netcdfstore directory and every variable
+with latitude and longitude axes becomes a layer.  Only the hyperslab of a
+request (one time step and level, or a single grid point for
+GetFeatureInfo) is read from the file.
+
+"""
+
+_globalNetcdfConnector = None
+
+def getGlobalNetcdfConnector():
+    global _globalNetcdfConnector
+
+    if _globalNetcdfConnector is None:
+        from cows.service.imps.netcdfbackend.netcdfcommon import NetcdfConnector
+        _globalNetcdfConnector = NetcdfConnector()
+
+    return _globalNetcdfConnector
@@ -0,0 +1,270 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Reads variables straight from a CF-NetCDF file for GeoplotWmsLayer, in
+place of CSMLDataReader.
+
+cdms only reads the hyperslab selected from a file variable, so a GetMap
+reads the lat/lon field of one time step and level and a GetFeatureInfo
+reads one grid point.  Variables share the CSML backend's variable and
+statistics caches.
+
+"""
+
+import os
+
+import numpy
+import cdms2 as cdms
+
+from cows.service.imps.netcdfbackend import getGlobalNetcdfConnector
+from cows.service.imps.netcdfbackend.netcdfcommon import isoTime, getTimeSlice
+from cows.service.imps.csmlbackend.wms.csml_data_reader import getGlobalVarCache, \
+    getGlobalStatsCache, getVarFlight, _nearestGridPoint
+from cows.service.imps.variable_stats import computeStats
+from cows.cache import LRUCache
+from cows.timing import timed
+from cows import metrics
+
+import logging
+log = logging.getLogger(__name__)
+
+# The axes of each variable, read once per file.
+_globalAxisCache = LRUCache(maxEntries=1000)
+
+metrics.registerCache('netcdf_axis', lambda: _globalAxisCache)
+
+class VariableAxes(object):
+    """
+    The axes of a NetCDF variable needed to select from it.
+
+    :ivar lon: The longitude values as a numpy array.
+    :ivar lat: The latitude values as a numpy array.
+    :ivar lonId: The id of the longitude axis.
+    :ivar latId: The id of the latitude axis.
+    :ivar timeId: The id of the time axis or None.
+    :ivar times: The isoTime strings of the time axis.
+
+    """
+
+    def __init__(self, variable):
+        lonAxis = variable.getLongitude()
+        latAxis = variable.getLatitude()
+        timeAxis = variable.getTime()
+
+        self.lon = numpy.asarray(lonAxis[:], dtype=numpy.float64)
+        self.lat = numpy.asarray(latAxis[:], dtype=numpy.float64)
+        self.lonId = lonAxis.id
+        self.latId = latAxis.id
+
+        if timeAxis is None:
+            self.timeId = None
+            self.times = []
+        else:
+            self.timeId = timeAxis.id
+            self.times = [isoTime(t) for t in timeAxis.asComponentTime()]
+
+class NetcdfDataReader(object):
+    """
+    Creates an object that can read cdms variables and other data from a
+    NetCDF file.  It has the methods of CSMLDataReader used by
+    GeoplotWmsLayer, which passes the variable id as the featureId.
+    """
+
+    def __init__(self, fileoruri):
+        self.connector = getGlobalNetcdfConnector()
+        self.fileoruri = fileoruri
+        self.path = self.connector.getFilePath(fileoruri)
+        self.lastModified = os.path.getmtime(self.path)
+        self.varcache = getGlobalVarCache()
+        self.statscache = getGlobalStatsCache()
+
+    def getNetcdfVar(self, varId, dimValues):
+        "Reads the lat/lon field of the variable at the given dimensions"
+
+        log.debug("varId = %s, dimValues = %s" % (varId, dimValues))
+
+        cacheKey = self._getCacheKey(varId, dimValues)
+
+        variable = self.varcache.get(cacheKey)
+
+        if variable is None:
+            variable = getVarFlight().do(cacheKey, self._loadVariable,
+                                         varId, dimValues, cacheKey)
+
+        return variable
+
+    def getVariableStats(self, varId, dimValues):
+        """
+        Returns the VariableStats of the field at the given dimensions,
+        computed when the field is read.
+        """
+        cacheKey = self._getCacheKey(varId, dimValues)
+
+        stats = self.statscache.get(cacheKey)
+
+        if stats is None:
+            variable = self.getNetcdfVar(varId, dimValues)
+            stats = computeStats(variable)
+            self.statscache.put(cacheKey, stats)
+
+        return stats
+
+    def getPointValue(self, varId, dimValues, lon, lat):
+        """
+        Returns the value of the grid box containing (lon, lat) as a tuple
+        (value, gridLon, gridLat), see CSMLDataReader.getPointValue.  Only
+        the grid point is read unless the field is already cached.
+        """
+        axes = self.getAxes(varId)
+
+        gridLon, gridLat = self._getGridPoint(axes, lon, lat)
+
+        if gridLon is None or gridLat is None:
+            return None, gridLon, gridLat
+
+        variable = self.varcache.get(self._getCacheKey(varId, dimValues))
+
+        if variable is not None:
+            point = variable(latitude=(gridLat, gridLat, 'cob'),
+                             longitude=(gridLon, gridLon, 'cob'))
+        else:
+            selection = self._getSelection(axes, dimValues)
+            selection[axes.latId] = (gridLat, gridLat, 'cob')
+            selection[axes.lonId] = (gridLon, gridLon, 'cob')
+            point = self._readVariable(varId, selection)
+
+        value = numpy.ma.ravel(point)[0]
+
+        if value is numpy.ma.masked or not numpy.isfinite(value):
+            value = None
+        else:
+            value = float(value)
+
+        return value, gridLon, gridLat
+
+    def getPointSeries(self, varId, dimValues, lon, lat):
+        """
+        Returns the time series at the grid box containing (lon, lat) as a
+        tuple (times, values, gridLon, gridLat), see
+        CSMLDataReader.getPointSeries.  dimValues['time'] may be a range
+        "start/end", read as one hyperslab of a single grid point.
+        """
+        axes = self.getAxes(varId)
+
+        gridLon, gridLat = self._getGridPoint(axes, lon, lat)
+
+        if gridLon is None or gridLat is None:
+            return [], [], gridLon, gridLat
+
+        selection = self._getSelection(axes, dimValues)
+        selection[axes.latId] = (gridLat, gridLat, 'cob')
+        selection[axes.lonId] = (gridLon, gridLon, 'cob')
+
+        variable = self._readVariable(varId, selection, squeeze=0)
+
+        values = []
+        for value in numpy.ma.ravel(variable):
+            if value is numpy.ma.masked or not numpy.isfinite(value):
+                values.append(None)
+            else:
+                values.append(float(value))
+
+        if axes.timeId in selection:
+            times = axes.times[selection[axes.timeId]]
+        else:
+            times = [dimValues.get('time')] * len(values)
+
+        return times, values, gridLon, gridLat
+
+    def getAxes(self, varId):
+        """
+        Returns the VariableAxes of a variable, read from the file once and
+        cached.
+        """
+        cacheKey = (self.path, self.lastModified, varId)
+        axes = _globalAxisCache.get(cacheKey)
+
+        if axes is None:
+            f = cdms.open(self.path)
+            try:
+                axes = VariableAxes(f[varId])
+            finally:
+                f.close()
+            _globalAxisCache.put(cacheKey, axes)
+
+        return axes
+
+    def _getGridPoint(self, axes, lon, lat):
+        return _nearestGridPoint(axes.lon, axes.lat, lon, lat)
+
+    def _getCacheKey(self, varId, dimValues):
+        dimList = list(dimValues.items())
+        dimList.sort()
+
+        # Variables are shared with the CSML backend's cache, which
+        # outlives the reader, so the key includes the backend and the time
+        # the file was modified.
+        return "netcdf:%s:%s:%s:%s" % (self.fileoruri, self.lastModified, varId, dimList)
+
+    def _getSelection(self, axes, dimValues):
+        """
+        Converts the dimension values to cdms selectors keyed by axis id.
+        The time is selected by index, other dimensions by the nearest
+        coordinate value.
+        """
+        selection = {}
+
+        for dimName, value in dimValues.items():
+            if dimName == 'time' and axes.timeId is not None:
+                selection[axes.timeId] = getTimeSlice(axes.times, value)
+            elif dimName != 'time':
+                value = float(value)
+                selection[dimName] = (value, value, 'cob')
+
+        return selection
+
+    def _loadVariable(self, varId, dimValues, cacheKey):
+        """
+        Reads the field, masks any NaNs and adds it to the cache.
+        """
+        # Another request may have loaded it between our cache miss and
+        # this call starting
+        variable = self.varcache.get(cacheKey)
+        if variable is not None:
+            return variable
+
+        selection = self._getSelection(self.getAxes(varId), dimValues)
+
+        variable = self._readVariable(varId, selection)
+
+        data = numpy.ma.getdata(variable)
+        are_nan = numpy.isnan(data)
+
+        if are_nan.any():
+            variable[are_nan] = numpy.ma.masked
+
+        self.statscache.put(cacheKey, computeStats(variable))
+        self.varcache.put(cacheKey, variable, group=self.fileoruri)
+
+        return variable
+
+    @timed('extract')
+    def _readVariable(self, varId, selection, squeeze=1):
+        """
+        Reads the hyperslab of a variable given by a mapping of axis ids to
+        cdms selectors.
+        """
+        log.debug("reading %s from %s, selection = %s" % (varId, self.path, selection))
+
+        f = cdms.open(self.path)
+        try:
+            variable = f[varId](squeeze=squeeze, **selection)
+        finally:
+            f.close()
+
+        return variable
@@ -0,0 +1,166 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Builds GeoplotWmsLayers from the variables of CF-NetCDF files.
+"""
+
+import cdms2 as cdms
+
+from cows.service.wms_iface import IwmsDimension
+from cows.service.imps.netcdfbackend import getGlobalNetcdfConnector
+from cows.service.imps.netcdfbackend.netcdfcommon import isoTime
+from cows.service.imps.netcdfbackend.netcdf_data_reader import NetcdfDataReader
+from cows.service.imps.geoplot_wms_backend.geoplot_layer_builder import GeoplotLayerBuilder
+from cows.service.imps.geoplot_wms_backend.geoplot_wms_layer import GeoplotWmsLayer
+
+import logging
+log = logging.getLogger(__name__)
+
+NETCDF_CRSS = ['EPSG:4326', 'CRS:84', 'WGS84']
+
+def getGridVariables(f):
+    """
+    Returns the variables of an open cdms file that have latitude and
+    longitude axes, sorted by id.
+    """
+    variables = []
+
+    for varId in sorted(f.variables.keys()):
+        var = f[varId]
+        if var.getLatitude() is not None and var.getLongitude() is not None:
+            variables.append(var)
+
+    return variables
+
+def getBBox(var):
+    """
+    Returns the lon/lat bounding box of a variable's grid boxes.  Global
+    grids are given as -180 to 180 as per common WXS convention.
+    """
+    bounds = []
+    for axis in (var.getLongitude(), var.getLatitude()):
+        axisBounds = axis.getBounds()
+        if axisBounds is None:
+            axisBounds = axis[:]
+        bounds.append((float(axisBounds.min()), float(axisBounds.max())))
+
+    (west, east), (south, north) = bounds
+
+    if east - west >= 359 or east > 180:
+        west, east = -180.0, 180.0
+
+    return [west, max(south, -90.0), east, min(north, 90.0)]
+
+class NetcdfDimension(IwmsDimension):
+    """
+    implements IDimension
+    :ivar units: The units string.
+    :ivar extent: Sequence of extent values.
+
+    """
+
+    def __init__(self, axis):
+        if axis.isTime():
+            self.units = 'ISO8601'
+            self.extent = [isoTime(t) for t in axis.asComponentTime()]
+        else:
+            self.units = getattr(axis, 'units', '')
+            self.extent = [str(v) for v in axis[:]]
+
+class NetcdfWmsLayer(GeoplotWmsLayer):
+    """
+    A GeoplotWmsLayer of a NetCDF variable.  A CSML layer of the same file
+    may have the same name, so slab keys are given a 'netcdf' prefix.
+    """
+
+    def getCacheKey(self, crs, style, dimValues, transparent, bgcolor,
+                    additionalParams={}):
+        key = GeoplotWmsLayer.getCacheKey(self, crs, style, dimValues,
+                                          transparent, bgcolor, additionalParams)
+
+        return 'netcdf:%s' % (key,)
+
+class NetcdfLayerBuilder(GeoplotLayerBuilder):
+    """
+    Builds a layer for each grid variable of a NetCDF file and a grouping
+    layer for each folder, in the same way as for CSML documents.
+    """
+
+    def __init__(self):
+        self.connector = getGlobalNetcdfConnector()
+
+    def getDSName(self, fileoruri):
+        "Returns the dataset name of a given fileoruri"
+
+        if self.connector.isGroup(fileoruri):
+            return fileoruri
+
+        return self._getGlobalTitle(fileoruri) or 'NetCDF/Geoplot WMS Service'
+
+    def getAbstract(self, fileoruri):
+
+        if self.connector.isGroup(fileoruri):
+            return self.getTitle(fileoruri)
+
+        return self._getGlobalTitle(fileoruri) or self.getTitle(fileoruri)
+
+    def _getGlobalTitle(self, fileoruri):
+        f = cdms.open(self.connector.getFilePath(fileoruri))
+        try:
+            return getattr(f, 'title', None)
+        finally:
+            f.close()
+
+    def _buildDataLayers(self, fileoruri):
+        """
+        Builds a list of data layer objects that correspond to the grid
+        variables of the NetCDF file of the fileoruri given.
+        """
+
+        # build a data reader to be used by all the layers
+        dataReader = NetcdfDataReader(fileoruri)
+
+        f = cdms.open(dataReader.path)
+        try:
+            dataLayers = [self._buildDataLayer(var, fileoruri, dataReader)
+                          for var in getGridVariables(f)]
+        finally:
+            f.close()
+
+        return dataLayers
+
+    def _buildDataLayer(self, var, fileoruri, dataReader):
+        """
+        builds a data layer object corresponding to a NetCDF variable.  The
+        title is the variable id, which the data reader is given to find
+        the variable.
+        """
+
+        dimensions = {}
+        for axis in var.getAxisList():
+            if axis.isLatitude() or axis.isLongitude():
+                continue
+
+            if axis.isTime():
+                dimensions['time'] = NetcdfDimension(axis)
+            else:
+                dimensions[axis.id] = NetcdfDimension(axis)
+
+        abstract = getattr(var, 'long_name', None) or \
+                   getattr(var, 'standard_name', None) or var.id
+
+        units = getattr(var, 'units', 'unknown units')
+
+        name = fileoruri.replace('/','_') + '_' + var.id
+
+        layer = NetcdfWmsLayer(name=name, title=var.id, abstract=abstract,
+                               dimensions=dimensions, units=units,
+                               crss=list(NETCDF_CRSS), boundingBox=getBBox(var),
+                               dataReader=dataReader)
+
+        return layer
@@ -0,0 +1,37 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Maps a fileoruri under the NetCDF store to its layers.
+"""
+
+import logging
+
+from cows.service.imps.netcdfbackend import getGlobalNetcdfConnector
+from cows.service.imps.netcdfbackend.netcdf_layer_builder import NetcdfLayerBuilder
+from cows.service.imps.geoplot_wms_backend.geoplot_layer_mapper import GeoplotLayerMapper
+
+log = logging.getLogger(__name__)
+
+class NetcdfLayerMapper(GeoplotLayerMapper):
+    """
+    The GeoplotLayerMapper for NetCDF files.  Layer maps are cached and
+    rebuilt when the files change as for CSML documents.
+    """
+
+    def __init__(self):
+        self.layermapcache = {}
+        self.connector = getGlobalNetcdfConnector()
+
+    def _getBuilder(self, fileoruri):
+        """
+        Creates a layer builder object to be used to generate the layers
+        """
+
+        builder = NetcdfLayerBuilder()
+
+        return builder
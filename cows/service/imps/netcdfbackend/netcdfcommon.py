@@ -0,0 +1,171 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Locating NetCDF files and matching requested times to time axes.
+
+This module doesn't import cdms so it can be used without the data stack.
+
+"""
+
+import os
+import re
+import ConfigParser
+
+from cows.service.imps.csmlbackend.config import config
+
+import logging
+log = logging.getLogger(__name__)
+
+# Extensions tried, in order, when looking for the file of a fileoruri
+NETCDF_EXTENSIONS = ['.nc', '.nc4', '.cdf']
+
+_isoPattern = re.compile(r'^\s*(\d{1,4})-(\d{1,2})-(\d{1,2})'
+                         r'(?:[T ](\d{1,2})(?::(\d{1,2})(?::(\d{1,2})(?:\.\d*)?)?)?)?'
+                         r'\s*[Zz]?\s*$')
+
+def isoTime(comptime):
+    """
+    Returns the ISO 8601 string of a cdtime component time, the form used
+    for the extent of time dimensions.
+    """
+    return '%04d-%02d-%02dT%02d:%02d:%02dZ' % (comptime.year, comptime.month, comptime.day,
+                                               comptime.hour, comptime.minute, int(comptime.second))
+
+def normaliseTime(timeString):
+    """
+    Converts a requested time such as 2000-01-01, 2000-01-01T12:00 or a
+    CSML style 2000-01-01T12:00:00.0 to the form returned by isoTime.
+
+    @raise ValueError: If timeString isn't an ISO 8601 date or date time.
+    """
+    m = _isoPattern.match(timeString)
+    if m is None:
+        raise ValueError("Invalid time %s" % (timeString,))
+
+    fields = [int(x or 0) for x in m.groups()]
+    return '%04d-%02d-%02dT%02d:%02d:%02dZ' % tuple(fields)
+
+def getTimeSlice(times, timeValue):
+    """
+    Returns the slice of a time axis selected by a requested time.
+
+    @param times: The isoTime strings of the time axis, in increasing order.
+    @param timeValue: A single time or a range "start/end".
+    :return: A slice object.
+    @raise ValueError: If no time step is selected.
+    """
+    if '/' in timeValue:
+        start, end = [normaliseTime(x) for x in timeValue.split('/')[:2]]
+        indices = [i for i, t in enumerate(times) if start <= t <= end]
+        if not indices:
+            raise ValueError("No times between %s and %s" % (start, end))
+        return slice(indices[0], indices[-1] + 1)
+
+    t = normaliseTime(timeValue)
+    if t not in times:
+        raise ValueError("Time %s is not available" % (timeValue,))
+
+    i = times.index(t)
+    return slice(i, i + 1)
+
+class NetcdfConnector(object):
+    """
+    Finds the NetCDF files, and folders of files, under
+    config['netcdfstore'].  A fileoruri names a file without its
+    extension, or a folder.
+    """
+
+    def __init__(self):
+        self.netcdf_dir = config.get('netcdfstore')
+
+    def _getPath(self, fileoruri):
+        if self.netcdf_dir is None:
+            raise ValueError("No NetCDF store is configured")
+
+        root = os.path.abspath(self.netcdf_dir)
+        path = os.path.abspath(os.path.join(root, fileoruri))
+
+        if path != root and not path.startswith(root + os.sep):
+            raise ValueError("Cannot find NetCDF file %s" % (fileoruri,))
+
+        return path
+
+    def getFilePath(self, fileoruri):
+        """
+        Returns the path of the NetCDF file of a fileoruri.
+        """
+        path = self._getPath(fileoruri)
+
+        for ext in NETCDF_EXTENSIONS:
+            if os.path.isfile(path + ext):
+                return path + ext
+
+        raise ValueError("Cannot find NetCDF file %s" % (fileoruri,))
+
+    def getSourcePaths(self, fileoruri):
+        """
+        Returns the files, and directories for a group, that the layers of
+        fileoruri are built from.
+        """
+        path = self._getPath(fileoruri)
+
+        if not os.path.isdir(path):
+            return [path + ext for ext in NETCDF_EXTENSIONS + ['.ini']]
+
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            paths.append(dirpath)
+            for filename in filenames:
+                if os.path.splitext(filename)[1] in NETCDF_EXTENSIONS + ['.ini']:
+                    paths.append(os.path.join(dirpath, filename))
+        return paths
+
+    def getColourMapConfig(self, fileoruri):
+        """
+        Reads the mydataset.ini file alongside mydataset.nc, if there is
+        one, see CSMLConnector.getColourMapConfig.
+        """
+        path = self._getPath(fileoruri) + '.ini'
+
+        if not os.path.exists(path):
+            return None
+
+        configfile = ConfigParser.ConfigParser()
+        configfile.read(path)
+        return configfile
+
+    def list(self, folder=None):
+        """
+        Generator that lists the NetCDF files, without their extension, and
+        folders in the store or one of its folders.
+        """
+        if folder is None:
+            path = self._getPath('')
+        else:
+            path = self._getPath(folder)
+
+        names = []
+        for fp in sorted(os.listdir(path)):
+            if os.path.isdir(os.path.join(path, fp)):
+                name = fp
+            elif os.path.splitext(fp)[1] in NETCDF_EXTENSIONS:
+                name = os.path.splitext(fp)[0]
+            else:
+                continue
+
+            if name in names:
+                continue
+            names.append(name)
+
+            if folder is not None:
+                yield os.path.join(folder, name)
+            else:
+                yield name
+
+    def isGroup(self, fc):
+        return os.path.isdir(self._getPath(fc))
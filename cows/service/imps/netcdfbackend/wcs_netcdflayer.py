@@ -0,0 +1,186 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+WCS coverages of the grid variables of CF-NetCDF files, the NetCDF
+counterpart of wcs_csmllayer.
+
+"""
+
+import os
+import tempfile
+
+import cdms2 as cdms
+
+from cows.model.common import WGS84BoundingBox
+from cows.service.wxs_iface import ILayerMapper
+from cows.service.imps.csmlbackend.config import config
+from cows.service.imps.csmlbackend.wcs_csmllayer import AxisDescription
+from cows.service.imps.netcdfbackend import getGlobalNetcdfConnector
+from cows.service.imps.netcdfbackend.netcdfcommon import isoTime, getTimeSlice
+from cows.service.imps.netcdfbackend.netcdf_layer_builder import getGridVariables, \
+    getBBox, NETCDF_CRSS
+
+import logging
+log = logging.getLogger(__name__)
+
+class NetcdfCoverageMapper(ILayerMapper):
+    """
+    Map keyword arguments to a collection of coverages, one for each grid
+    variable of the NetCDF files of a fileoruri.
+    """
+
+    def __init__(self):
+        self.layermapcache = {}
+        self.connector = getGlobalNetcdfConnector()
+
+    def map(self, **kwargs):
+        """
+        @return: A mapping of coverage names to NetcdfCoverage objects.
+        @raise ValueError: If no layers are available for these keywords.
+        """
+        fileoruri = kwargs['fileoruri']
+        if fileoruri in self.layermapcache.keys():
+            #we've accessed this layer map before, get it from the cache dictionary
+            self.datasetName = self.layermapcache[fileoruri]['dsName']
+            return self.layermapcache[fileoruri]['layermap']
+
+        if self.connector.isGroup(fileoruri):
+            self.datasetName = fileoruri
+            coverages = self._getCoveragesFromFolder(folderPath=fileoruri)
+        else:
+            self.datasetName = 'NetCDF WCS Service'
+            coverages = self._getCoveragesFromFile(fileoruri)
+
+        layermap = {}
+        for c in coverages:
+            layermap[c.name] = c
+
+        if len(layermap) > 0:
+            self.layermapcache[fileoruri] = {'layermap': layermap,
+                                             'dsName': self.datasetName}
+            return layermap
+        else:
+            raise ValueError
+
+    def _getCoveragesFromFolder(self, folderPath=None):
+        l = []
+
+        for fc in self.connector.list(folder=folderPath):
+
+            if self.connector.isGroup(fc):
+                l += self._getCoveragesFromFolder(folderPath=fc)
+            else:
+                l += self._getCoveragesFromFile(fc)
+
+        return l
+
+    def _getCoveragesFromFile(self, fileoruri):
+        path = self.connector.getFilePath(fileoruri)
+
+        f = cdms.open(path)
+        try:
+            if not self.connector.isGroup(fileoruri) and getattr(f, 'title', None):
+                self.datasetName = f.title
+
+            l = []
+            for var in getGridVariables(f):
+                name = fileoruri.replace('/','_') + '_' + var.id
+                l.append(NetcdfCoverage(name, path, var))
+        finally:
+            f.close()
+
+        return l
+
+class NetcdfCoverage(object):
+    """
+    Represents a WCS Coverage of a NetCDF variable, with the attributes of
+    CSMLCoverage.
+    """
+
+    def __init__(self, name, path, var):
+        self.name = name
+        self.id = var.id
+        self.title = [getattr(var, 'long_name', None) or var.id]
+        self.abstract = [getattr(var, 'standard_name', None) or self.title[0]]
+        self.description = self.abstract[0]
+        self.units = getattr(var, 'units', 'unknown units')
+        self.crss = list(NETCDF_CRSS)
+        self.bboxes = []
+        self.featureInfoFormats = ['text/html']
+        self._path = path
+
+        bb = getBBox(var)
+        self.wgs84BBox = WGS84BoundingBox(bb[:2], bb[2:])
+
+        self.timePositions = ['']
+        self.timeLimits = ['', '']
+        self.axisDescriptions = []
+
+        for axis in var.getAxisList():
+            if axis.isLatitude() or axis.isLongitude():
+                continue
+
+            if axis.isTime():
+                self.timePositions = [isoTime(t) for t in axis.asComponentTime()]
+                self.timeLimits = [self.timePositions[0], self.timePositions[-1]]
+            else:
+                self.axisDescriptions.append(AxisDescription(axis.id, axis.id,
+                                                             axis[:].tolist()))
+
+    def getBBox(self, crs):
+        """
+        @return: A 4-typle of the bounding box in the given coordinate
+            reference system.
+        """
+        return self.wgs84BBox
+
+    def getCvg(self, bbox, time=None, crs=None, response_crs=None, **kwargs):
+        """
+        Writes the hyperslab of the variable within bbox, and the requested
+        times and axis ranges, to a NetCDF file in config['tmpdir'].
+
+        @param time: A time, a tuple (start, end) or None for all times.
+        @param kwargs: Tuples (min, max) keyed by the names of the
+            axisDescriptions.
+        @return: The name of the file.
+        """
+        log.debug('WCS: getCvg(%s, %s, %s)' % (bbox, time, crs))
+
+        f = cdms.open(self._path)
+        try:
+            var = f[self.id]
+
+            sel = {}
+            sel[var.getLatitude().id] = (bbox[1], bbox[3])
+            sel[var.getLongitude().id] = (bbox[0], bbox[2])
+
+            timeAxis = var.getTime()
+            if time is not None and timeAxis is not None:
+                if type(time) is tuple:
+                    time = '%s/%s' % time[:2]
+                sel[timeAxis.id] = getTimeSlice(self.timePositions, str(time))
+
+            for axis in self.axisDescriptions:
+                if axis.name in kwargs:
+                    sel[axis.name] = kwargs[axis.name]
+
+            log.debug('Final selection being made to the variable %s' % (sel,))
+            subset = var(**sel)
+        finally:
+            f.close()
+
+        (fd, filename) = tempfile.mkstemp('.nc', 'netcdf_wcs_', config['tmpdir'])
+        os.close(fd)
+
+        out = cdms.open(filename, 'w')
+        try:
+            out.write(subset)
+        finally:
+            out.close()
+
+        return filename
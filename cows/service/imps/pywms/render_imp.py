@@ -19,19 +19,102 @@ except ImportError:
 
 import numpy as N
 import logging
+import threading
 from matplotlib import cm, colors
 
+from cows.cache import LRUCache
+
 logger = logging.getLogger(__name__)
 
+# RGBA lookup tables shared by all renderers, keyed by colour map and size.
+_lutCache = {}
+_lutLock = threading.Lock()
+
+def getColourLUT(cmap, lutSize):
+    """
+    Return a (lutSize, 4) uint8 array of the colours of cmap sampled at the
+    centre of lutSize equal bins of [0, 1], and the uint8 RGBA colour used
+    for bad values.  Tables are built once and shared between requests.
+    """
+    bad = tuple((cmap(N.ma.array([0.0], mask=[True])) * 255).astype(N.uint8)[0])
+    key = (cmap.name, cmap.N, lutSize, bad)
+
+    lut = _lutCache.get(key)
+    if lut is None:
+        lut = (cmap((N.arange(lutSize) + 0.5) / lutSize) * 255).astype(N.uint8)
+        _lutLock.acquire()
+        try:
+            lut = _lutCache.setdefault(key, lut)
+        finally:
+            _lutLock.release()
+
+    return lut, N.array(bad, dtype=N.uint8)
+
+# Index maps are small 1D arrays shared between tiles of the same zoom level.
+_indexMapCache = LRUCache(maxEntries=4096)
+
+def getAxisIndexMap(c0, step, n, start, end, npix, method='nearest'):
+    """
+    Return the source grid indices for the centre of each of npix pixels
+    spanning start to end along one axis of a grid with n points at
+    c0 + i * step.
+
+    For method 'nearest' returns (index, valid).  For 'bilinear' returns
+    (index0, index1, weight1, valid) where the value at each pixel is
+    grid[index0] * (1 - weight1) + grid[index1] * weight1.  valid is False
+    for pixels more than half a grid box beyond the grid.  The arrays are
+    cached and must not be modified.
+    """
+    key = (c0, step, n, start, end, npix, method)
+    indexMap = _indexMapCache.get(key)
+    if indexMap is not None:
+        return indexMap
+    
+    coords = start + (N.arange(npix) + 0.5) * ((end - start) / float(npix))
+    if step:
+        f = (coords - c0) / float(step)
+    else:
+        f = N.zeros(npix)
+    valid = (f >= -0.5) & (f <= n - 0.5)
+    
+    if method == 'nearest':
+        index = N.clip(N.floor(f + 0.5), 0, n - 1).astype(N.intp)
+        indexMap = (index, valid)
+    elif method == 'bilinear':
+        f = N.clip(f, 0, n - 1)
+        index0 = N.floor(f).astype(N.intp)
+        index1 = N.minimum(index0 + 1, n - 1)
+        indexMap = (index0, index1, f - index0, valid)
+    else:
+        raise ValueError("Unknown resampling method %r" % method)
+    
+    for a in indexMap:
+        a.setflags(write=False)
+    _indexMapCache.put(key, indexMap)
+    
+    return indexMap
+
 class RGBARenderer(GridRenderer):
     """Creates an RGBA PNG with a selectable matplotlib colour scale.
     """
 
     mimeType = 'image/png'
 
-    def __init__(self, varmin, varmax):
+    #: Number of entries in the colour lookup table used to colour grids.
+    #: Values up to 256 quantise to uint8 indices, larger to uint16. Set
+    #: to None to colour every value through the colour map directly.
+    lutSize = 256
+
+    #: How grids are mapped onto the image pixels.  'nearest' or 'bilinear'
+    #: sample the grid at the centre of each pixel of the bbox, 'resize'
+    #: stretches the image of the whole grid to the image size.
+    resampling = 'nearest'
+
+    def __init__(self, varmin, varmax, resampling=None):
         self.varmin = varmin
         self.varmax = varmax
+        if resampling is not None:
+            self.resampling = resampling
         self._norm = colors.normalize(varmin, varmax)
 
     def renderColourbar(self, width, height, cmap, isVertical=True):
@@ -56,6 +139,15 @@ class RGBARenderer(GridRenderer):
 #        logger.debug('width %s'%width)
 #        logger.debug('height %s'%height)
 
+        if self.resampling != 'resize':
+            value = self._resample(grid, bbox, width, height)
+            if self.lutSize is not None:
+                img_buf = self._colourLUT(value, cmap)
+            else:
+                img_buf = (cmap(self._norm(value)) * 255).astype(N.uint8)
+            return Image.frombuffer("RGBA", (width, height), img_buf.tostring(),
+                                    "raw", "RGBA", 0, 1)
+
         # Get a pixel = grid-box image for the grid
         img = self._grid2Img(grid, cmap)
 
@@ -119,6 +211,9 @@ class RGBARenderer(GridRenderer):
     def _grid2Img(self, grid, cmap):
         """Returns the grid as an image where each pixel is one grid box.
         """
+        if self.lutSize is not None:
+            return self._grid2ImgLUT(grid, cmap)
+        
         a = self._norm(grid.value)
         
         img_buf = (cmap(a) * 255).astype('b')
@@ -151,3 +246,135 @@ class RGBARenderer(GridRenderer):
             img = img.transpose(Image.FLIP_LEFT_RIGHT)
         return img
 
+    def _grid2ImgLUT(self, grid, cmap):
+        """Returns the grid as an image where each pixel is one grid box,
+        colouring it through a cached lookup table.
+
+        The rotation and flips are applied as views of the grid so that the
+        table lookup writes the final image in one pass.
+        """
+        value = self._gridValue(grid)
+        
+        # Flip if x or y are ordered the wrong way
+        if grid.dy > 0:
+            logger.debug('Flipping y')
+            value = value[::-1]
+        if grid.dx < 0:
+            logger.debug('Flipping x')
+            value = value[:, ::-1]
+        
+        img_buf = self._colourLUT(value, cmap)
+        
+        height, width = value.shape
+        return Image.frombuffer("RGBA", (width, height), img_buf.tostring(),
+                                "raw", "RGBA", 0, 1)
+
+    def _gridValue(self, grid):
+        """Returns grid.value as a 2D masked array view ordered (y, x).
+        Non-finite values are masked.
+        """
+        # This code assumes the axis ordering is either (y, x, time) or (x, y, time)
+        if min(grid.iy, grid.ix) != 0 and max(grid.iy, grid.ix) != 1:
+            raise ValueError("X and Y must be the first 2 dimensions!")
+        
+        data = N.ma.getdata(grid.value)
+        mask = N.ma.getmaskarray(grid.value) | ~N.isfinite(data)
+        
+        # One of the axes may have been squeezed out
+        if data.ndim == 1:
+            if grid.nx * grid.ny != data.size:
+                shape = (1, data.size)
+            elif grid.iy < grid.ix:
+                shape = (grid.ny, grid.nx)
+            else:
+                shape = (grid.nx, grid.ny)
+            data = data.reshape(shape)
+            mask = mask.reshape(shape)
+        
+        # Rotate if axis order is x, y
+        if grid.iy > grid.ix:
+            data = data.swapaxes(0, 1)
+            mask = mask.swapaxes(0, 1)
+        
+        return N.ma.array(data, mask=mask, copy=False)
+
+    def _colourLUT(self, value, cmap):
+        """Returns a (height, width, 4) uint8 RGBA array of a 2D masked
+        array coloured through the lookup table for cmap.
+        """
+        lut, bad = getColourLUT(cmap, self.lutSize)
+        index, mask = self._quantise(value, self.lutSize)
+        
+        img_buf = N.empty(index.shape + (4,), dtype=N.uint8)
+        N.take(lut, index, axis=0, out=img_buf)
+        if mask.any():
+            img_buf[mask] = bad
+        
+        return img_buf
+
+    def _quantise(self, value, lutSize):
+        """Returns an array of lookup table indices for the values and a
+        boolean array marking the masked or non-finite values.
+        """
+        data = N.ma.getdata(value)
+        mask = N.ma.getmaskarray(value) | ~N.isfinite(data)
+        
+        vmin = float(self.varmin)
+        vmax = float(self.varmax)
+        if vmax > vmin:
+            scaled = (data - vmin) * (lutSize / (vmax - vmin))
+        else:
+            scaled = N.zeros(data.shape)
+        
+        scaled[mask] = 0
+        N.clip(scaled, 0, lutSize - 1, out=scaled)
+        
+        if lutSize <= 256:
+            dtype = N.uint8
+        else:
+            dtype = N.uint16
+        
+        return scaled.astype(dtype), mask
+
+    def _resample(self, grid, bbox, width, height):
+        """Returns a (height, width) masked array of the grid values at the
+        centre of each pixel of the bbox.  Pixels outside the grid are
+        masked.
+
+        The grid points are taken as the centres of the grid boxes, the
+        coordinate of point i along an axis being x0 + i * dx.
+        """
+        value = self._gridValue(grid)
+        data = N.ma.getdata(value)
+        mask = N.ma.getmaskarray(value)
+        ny, nx = data.shape
+        
+        xmap = getAxisIndexMap(grid.x0, grid.dx, nx, bbox[0], bbox[2], width,
+                               self.resampling)
+        ymap = getAxisIndexMap(grid.y0, grid.dy, ny, bbox[3], bbox[1], height,
+                               self.resampling)
+        outside = ~(ymap[-1][:, N.newaxis] & xmap[-1][N.newaxis, :])
+        
+        if self.resampling == 'nearest':
+            yi, xi = ymap[0], xmap[0]
+            values = data.take(yi, axis=0).take(xi, axis=1)
+            outMask = mask.take(yi, axis=0).take(xi, axis=1) | outside
+        else:
+            # Weight the 4 surrounding points, ignoring any that are masked
+            valid = ~mask
+            filled = N.where(valid, data, 0).astype(N.float64)
+            acc = N.zeros((height, width), dtype=N.float64)
+            weights = N.zeros((height, width), dtype=N.float64)
+            
+            for yi, wy in ((ymap[0], 1 - ymap[2]), (ymap[1], ymap[2])):
+                for xi, wx in ((xmap[0], 1 - xmap[2]), (xmap[1], xmap[2])):
+                    w = wy[:, N.newaxis] * wx[N.newaxis, :]
+                    w = w * valid.take(yi, axis=0).take(xi, axis=1)
+                    acc += w * filled.take(yi, axis=0).take(xi, axis=1)
+                    weights += w
+            
+            outMask = (weights == 0) | outside
+            weights[outMask] = 1
+            values = acc / weights
+        
+        return N.ma.array(values, mask=outMask, copy=False)
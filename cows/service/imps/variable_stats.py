@@ -0,0 +1,55 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+'''
+Summary statistics of the valid values in a variable.
+
+Statistics are computed once when a variable is extracted and cached with
+it so that slabs and legends don't need to scan the data again.
+'''
+
+import numpy
+
+class VariableStats(object):
+    """
+    Statistics of the unmasked, finite values of a variable.
+
+    :ivar minval: The minimum value or None if there are no valid values.
+    :ivar maxval: The maximum value or None if there are no valid values.
+    :ivar mean: The mean value or None if there are no valid values.
+    :ivar count: The number of valid values.
+    """
+
+    def __init__(self, minval, maxval, mean, count):
+        self.minval = minval
+        self.maxval = maxval
+        self.mean = mean
+        self.count = count
+
+    def __repr__(self):
+        return 'VariableStats(minval=%r, maxval=%r, mean=%r, count=%r)' % \
+               (self.minval, self.maxval, self.mean, self.count)
+
+def computeStats(variable):
+    """
+    Compute VariableStats for a numpy masked array or cdms variable in a
+    single vectorised pass.  Masked values, NaNs and +/-inf are ignored.
+    """
+    data = numpy.ma.getdata(variable)
+
+    valid = numpy.isfinite(data)
+    mask = numpy.ma.getmask(variable)
+    if mask is not numpy.ma.nomask:
+        valid &= ~mask
+
+    values = data[valid]
+
+    if values.size == 0:
+        return VariableStats(None, None, None, 0)
+
+    return VariableStats(float(values.min()), float(values.max()),
+                         float(values.mean(dtype=numpy.float64)), int(values.size))
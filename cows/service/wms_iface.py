@@ -125,8 +125,8 @@ class IwmsLayerSlab(object):
     An interface representing a particular horizontal slice of a WMS layer.
 
     IwmsLayerSlab objects are designed to be convenient to cache.
-    Ideally they should be pickleable to enable memcached support in
-    the future.
+    They should be pickleable so that they can be stored in the shared
+    disk or memcached slab cache backends (see :mod:`cows.cache`).
 
     :ivar layer: The source IwmsLayer instance.
     :ivar crs: The coordinate reference system.
@@ -0,0 +1,16 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Tools for measuring the performance of the COWS server stack.
+
+ - synthetic_backend: an ILayerMapper serving numpy generated fields, so
+   load can be generated without a CSML store.
+ - replay: replays WMS requests against the WSGI application and reports
+   latency percentiles, throughput and cache hit ratios.
+
+"""
@@ -0,0 +1,395 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Micro-benchmarks of tile rendering and encoding.
+
+Each benchmark renders synthetic grids over a matrix of cases: grid
+resolution, tile size, colour map and the fraction of masked values.  The
+benchmarks cover RGBARenderer.renderGrid() and _grid2Img(), the geoplot
+SlabGrid, SlabContour and SlabInterval slabs and the image encoding done
+by WMSController._writeImageResponse().
+
+Results hold the minimum and median time of several repeats and the peak
+resident memory of each case.  They can be saved as a JSON baseline and a
+later run compared with it::
+
+    python -m cows.test.perf.render_bench --output baseline.json
+    python -m cows.test.perf.render_bench --baseline baseline.json --tolerance 0.15
+
+The comparison exits with status 1 if any case got slower, or used more
+memory, by more than the tolerance.  Benchmarks whose dependencies, such
+as geoplot, are not installed are skipped.
+
+"""
+
+import sys
+import time
+import fnmatch
+import platform
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import numpy
+
+from cows.test.perf.synthetic_backend import makeField, SyntheticGrid, GLOBAL_BBOX
+
+import logging
+log = logging.getLogger(__name__)
+
+# (nx, ny) of the synthetic grids
+GRID_SIZES = [(360, 180), (720, 360), (1440, 720)]
+TILE_SIZES = [256, 512]
+COLOUR_MAPS = ['jet', 'gray']
+MASKED_FRACTIONS = [0.0, 0.3]
+
+# The tile is the north west quarter of the globe so it is resampled
+TILE_BBOX = (-180.0, 0.0, 0.0, 90.0)
+
+class BenchCase(object):
+    """
+    One combination of benchmark parameters.
+    """
+
+    def __init__(self, gridSize, tileSize, cmap, maskedFraction):
+        self.gridSize = gridSize
+        self.tileSize = tileSize
+        self.cmap = cmap
+        self.maskedFraction = maskedFraction
+
+    def getId(self):
+        return 'grid%dx%d-tile%d-%s-mask%02d' % (self.gridSize + (self.tileSize, self.cmap,
+                                                                   int(100 * self.maskedFraction)))
+
+    def makeField(self):
+        """
+        :return: A tuple (field, x0, y0, dx, dy), see
+            cows.test.perf.synthetic_backend.makeField.
+        """
+        field, x0, y0, dx, dy = makeField(self.gridSize[0], self.gridSize[1], 0)
+        if self.maskedFraction:
+            # Always mask the same points for repeatable timings
+            random = numpy.random.RandomState(0)
+            mask = random.random_sample(field.shape) < self.maskedFraction
+            field = numpy.ma.array(field, mask=numpy.ma.getmaskarray(field) | mask)
+        return field, x0, y0, dx, dy
+
+def iterCases(gridSizes=GRID_SIZES, tileSizes=TILE_SIZES, cmaps=COLOUR_MAPS,
+              maskedFractions=MASKED_FRACTIONS):
+    for gridSize in gridSizes:
+        for tileSize in tileSizes:
+            for cmap in cmaps:
+                for maskedFraction in maskedFractions:
+                    yield BenchCase(gridSize, tileSize, cmap, maskedFraction)
+
+#-----------------------------------------------------------------------------
+# Benchmarks
+#
+# Each benchmark function takes a BenchCase and returns the function to
+# time, so that setting up the data isn't timed.
+
+def _makeGrid(case):
+    field, x0, y0, dx, dy = case.makeField()
+    return SyntheticGrid(field, x0, y0, dx, dy, 'bench', 'K')
+
+def _makeRenderer(case, resampling='nearest'):
+    from cows.service.imps.pywms.render_imp import RGBARenderer
+    from cows.service.imps.variable_stats import computeStats
+
+    stats = computeStats(case.makeField()[0])
+    return RGBARenderer(stats.minval, stats.maxval, resampling=resampling)
+
+def benchRenderGrid(case, resampling='nearest'):
+    from matplotlib import cm
+
+    grid = _makeGrid(case)
+    renderer = _makeRenderer(case, resampling)
+    cmap = cm.get_cmap(case.cmap)
+    size = case.tileSize
+
+    return lambda: renderer.renderGrid(grid, TILE_BBOX, size, size, cmap)
+
+def benchRenderGridBilinear(case):
+    return benchRenderGrid(case, 'bilinear')
+
+def benchGrid2Img(case):
+    from matplotlib import cm
+
+    grid = _makeGrid(case)
+    renderer = _makeRenderer(case)
+    cmap = cm.get_cmap(case.cmap)
+
+    return lambda: renderer._grid2Img(grid, cmap)
+
+def _makeCdmsVariable(case):
+    try:
+        import cdms2 as cdms
+    except ImportError:
+        import cdms
+
+    field, x0, y0, dx, dy = case.makeField()
+    ny, nx = field.shape
+
+    lat = cdms.createAxis(y0 + dy * numpy.arange(ny), id='latitude')
+    lat.designateLatitude()
+    lat.setBounds(numpy.array([lat[:] - dy / 2, lat[:] + dy / 2]).T)
+    lon = cdms.createAxis(x0 + dx * numpy.arange(nx), id='longitude')
+    lon.designateLongitude()
+    lon.setBounds(numpy.array([lon[:] - dx / 2, lon[:] + dx / 2]).T)
+
+    return cdms.createVariable(field, axes=[lat, lon], id='bench',
+                               attributes={'units': 'K'})
+
+def _benchSlab(slabClass, case):
+    variable = _makeCdmsVariable(case)
+    slab = slabClass(variable, 'bench', 'EPSG:4326', {}, True, '0xFFFFFF',
+                     GLOBAL_BBOX, {'cmap': case.cmap})
+    size = case.tileSize
+
+    return lambda: slab.getImage(TILE_BBOX, size, size)
+
+def benchSlabGrid(case):
+    from cows.service.imps.geoplot_wms_backend.slabs.slab_grid import SlabGrid
+    return _benchSlab(SlabGrid, case)
+
+def benchSlabContour(case):
+    from cows.service.imps.geoplot_wms_backend.slabs.slab_contour import SlabContour
+    return _benchSlab(SlabContour, case)
+
+def benchSlabInterval(case):
+    from cows.service.imps.geoplot_wms_backend.slabs.slab_interval import SlabInterval
+    return _benchSlab(SlabInterval, case)
+
+def _benchEncode(case, format, palette=False):
+    from cows.image_encoder import ImageEncoder
+
+    img = benchRenderGrid(case)()
+    encoder = ImageEncoder(palette=palette)
+
+    return lambda: encoder.encode(img, format)
+
+def benchEncodePng(case):
+    return _benchEncode(case, 'image/png')
+
+def benchEncodePngPaletted(case):
+    return _benchEncode(case, 'image/png', palette=True)
+
+def benchEncodeJpeg(case):
+    return _benchEncode(case, 'image/jpeg')
+
+BENCHMARKS = [
+    ('render_grid', benchRenderGrid),
+    ('render_grid_bilinear', benchRenderGridBilinear),
+    ('grid2img', benchGrid2Img),
+    ('slab_grid', benchSlabGrid),
+    ('slab_contour', benchSlabContour),
+    ('slab_interval', benchSlabInterval),
+    ('encode_png', benchEncodePng),
+    ('encode_png_paletted', benchEncodePngPaletted),
+    ('encode_jpeg', benchEncodeJpeg),
+    ]
+
+#-----------------------------------------------------------------------------
+# Measuring
+
+def _readStatusKb(field):
+    try:
+        f = open('/proc/self/status')
+    except IOError:
+        return None
+    try:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    finally:
+        f.close()
+    return None
+
+def _resetPeakMemory():
+    """
+    Reset the peak resident set size of this process.  Returns False where
+    this isn't supported (Linux before 4.0 or not Linux).
+    """
+    try:
+        f = open('/proc/self/clear_refs', 'w')
+        try:
+            f.write('5')
+        finally:
+            f.close()
+    except IOError:
+        return False
+    return True
+
+def measure(func, repeat=5):
+    """
+    Time func and measure the memory it allocates.
+
+    :return: A dictionary with the min and median seconds of repeat calls
+        and peak_kb, the growth of the peak resident set size during the
+        calls or None if it can't be measured.
+    """
+    # Warm up caches such as colour lookup tables
+    func()
+
+    peak = rss = None
+    if _resetPeakMemory():
+        rss = _readStatusKb('VmRSS')
+
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        func()
+        times.append(time.time() - t0)
+
+    if rss is not None:
+        hwm = _readStatusKb('VmHWM')
+        if hwm is not None:
+            peak = max(hwm - rss, 0)
+
+    times.sort()
+    return {'min': times[0], 'median': times[len(times) // 2], 'peak_kb': peak}
+
+def runBenchmarks(cases, pattern=None, repeat=5, out=sys.stdout):
+    """
+    Run every benchmark whose name matches pattern on every case.
+
+    :return: A dictionary mapping 'benchmark/caseId' to the result of
+        measure().
+    """
+    results = {}
+    for name, bench in BENCHMARKS:
+        if pattern is not None and not fnmatch.fnmatch(name, pattern):
+            continue
+
+        for case in cases:
+            key = '%s/%s' % (name, case.getId())
+            try:
+                func = bench(case)
+            except ImportError, e:
+                out.write("%s skipped: %s\n" % (name, e))
+                break
+
+            results[key] = measure(func, repeat)
+            out.write("%-60s %8.2f ms %8.2f ms %8s kB\n" %
+                      (key, 1000 * results[key]['min'],
+                       1000 * results[key]['median'], results[key]['peak_kb']))
+
+    return results
+
+#-----------------------------------------------------------------------------
+# Baselines
+
+def makeBaseline(results):
+    """
+    Return a JSON serialisable baseline of results and the environment
+    they were measured in.
+    """
+    return {'environment': {'python': platform.python_version(),
+                            'numpy': numpy.__version__,
+                            'platform': platform.platform(),
+                            'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'results': results}
+
+def compareResults(baseline, results, tolerance=0.1, memoryTolerance=0.25,
+                   minMemoryKb=1024):
+    """
+    Compare results with a baseline.  Times are compared by their minimum,
+    which is the least affected by other load on the machine.
+
+    @param tolerance: The fraction a time may grow by before it is a
+        regression.
+    @param memoryTolerance: The fraction peak memory may grow by.
+    @param minMemoryKb: Memory growth smaller than this is ignored.
+    :return: A tuple (regressions, improvements), lists of tuples
+        (key, metric, baselineValue, value).
+    """
+    regressions = []
+    improvements = []
+
+    for key, new in sorted(results.items()):
+        old = baseline['results'].get(key)
+        if old is None:
+            continue
+
+        if new['min'] > old['min'] * (1 + tolerance):
+            regressions.append((key, 'min', old['min'], new['min']))
+        elif new['min'] < old['min'] * (1 - tolerance):
+            improvements.append((key, 'min', old['min'], new['min']))
+
+        if old.get('peak_kb') is not None and new.get('peak_kb') is not None:
+            growth = new['peak_kb'] - old['peak_kb']
+            if growth > minMemoryKb and growth > old['peak_kb'] * memoryTolerance:
+                regressions.append((key, 'peak_kb', old['peak_kb'], new['peak_kb']))
+
+    return regressions, improvements
+
+def _formatChange(change):
+    key, metric, old, new = change
+    if metric == 'peak_kb':
+        return '%s %s %d kB -> %d kB' % (key, metric, old, new)
+    return '%s %s %.2f ms -> %.2f ms (%+.0f%%)' % (key, metric, 1000 * old, 1000 * new,
+                                                   100.0 * (new - old) / old)
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]",
+                          description="Benchmark tile rendering and compare with a baseline.")
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help="write the results to FILE as a JSON baseline")
+    parser.add_option('-b', '--baseline', metavar='FILE',
+                      help="compare the results with a JSON baseline")
+    parser.add_option('-t', '--tolerance', type='float', default=0.1,
+                      help="fractional slow down allowed (default %default)")
+    parser.add_option('--memory-tolerance', type='float', default=0.25,
+                      help="fractional peak memory growth allowed (default %default)")
+    parser.add_option('-k', '--benchmarks', metavar='PATTERN',
+                      help="only run benchmarks matching a glob pattern, e.g. 'slab_*'")
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help="timed calls per case (default %default)")
+    parser.add_option('--quick', action='store_true', default=False,
+                      help="only the smallest grid with one colour map")
+
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error("Unexpected arguments %s" % args)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if options.quick:
+        cases = list(iterCases(GRID_SIZES[:1], TILE_SIZES, COLOUR_MAPS[:1]))
+    else:
+        cases = list(iterCases())
+
+    results = runBenchmarks(cases, options.benchmarks, options.repeat)
+
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            json.dump(makeBaseline(results), f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    if options.baseline:
+        baseline = json.load(open(options.baseline))
+        regressions, improvements = compareResults(baseline, results,
+                                                   options.tolerance,
+                                                   options.memory_tolerance)
+        for change in improvements:
+            sys.stdout.write("improved:  %s\n" % _formatChange(change))
+        for change in regressions:
+            sys.stdout.write("REGRESSED: %s\n" % _formatChange(change))
+
+        if regressions:
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,408 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Replays WMS requests against a COWS application and measures it.
+
+Requests come from an access log (Common or Combined Log Format) or from
+a pyramid of GetMap tiles.  They are sent by a number of worker threads
+either directly to the WSGI application or over a local socket to a
+paste.httpserver serving it, so the cost of the HTTP layer can be seen.
+Both run in this process so the application's caches can be inspected:
+each run reports latency percentiles, throughput and the hit ratio of
+every cache registered with cows.metrics.
+
+By default the cows testapp is loaded, whose synthwms controller serves
+the numpy generated layers of cows.test.perf.synthetic_backend, e.g.::
+
+    python -m cows.test.perf.replay --layers temp,precip --levels 0-3 \\
+        --workers 1,2,4,8 --mode both
+
+"""
+
+import sys
+import os
+import re
+import math
+import time
+import urllib
+import urllib2
+import threading
+from Queue import Queue, Empty
+from optparse import OptionParser
+
+from cows.seeder import TileSeeder, _parseRange
+from cows.cache import DiskCache, MemcachedCache, TieredCache
+from cows import metrics
+
+import logging
+log = logging.getLogger(__name__)
+
+# Operations replayed from access logs
+REPLAY_OPERATIONS = ['getmap', 'getfeatureinfo', 'getlegend', 'getlegendgraphic']
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              'testapp', 'test.ini')
+DEFAULT_PATH = '/synthetic/data/wms'
+
+_requestLine = re.compile(r'"GET (\S+) HTTP/[0-9.]+"')
+
+def parseAccessLog(lines, operations=REPLAY_OPERATIONS, pathPrefix=None):
+    """
+    Extract the URLs of OWS requests from access log lines.
+
+    @param operations: Only return requests whose REQUEST parameter is one
+        of these lower case operation names.
+    @param pathPrefix: Only return requests whose path starts with this.
+    :return: A list of URLs without the scheme and host.
+    """
+    urls = []
+    for line in lines:
+        m = _requestLine.search(line)
+        if m is None:
+            continue
+        url = m.group(1)
+
+        path, _, query = url.partition('?')
+        if pathPrefix is not None and not path.startswith(pathPrefix):
+            continue
+
+        params = dict((k.lower(), v) for k, v in
+                      (p.split('=', 1) for p in query.split('&') if '=' in p))
+        if urllib.unquote(params.get('request', '')).lower() not in operations:
+            continue
+
+        urls.append(url)
+
+    return urls
+
+def makePyramidUrls(path, layers, levels, **seederOptions):
+    """
+    Return the GetMap URLs of every tile of levels of a tile pyramid.
+
+    @param seederOptions: Other cows.seeder.TileSeeder arguments.
+    """
+    seeder = TileSeeder(path, layers, levels=levels, **seederOptions)
+    return [url for tileId, url in seeder.iterJobs()]
+
+def percentile(values, p):
+    """
+    Return the p'th percentile of values by the nearest rank method.
+    """
+    if not values:
+        return None
+
+    values = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+#-----------------------------------------------------------------------------
+# Clients
+
+class InProcessClient(object):
+    """
+    Calls the WSGI application directly.  Each worker thread has its own.
+    """
+
+    def __init__(self, app):
+        import paste.fixture
+        self._app = paste.fixture.TestApp(app)
+
+    def get(self, url):
+        """
+        :return: A tuple (status, size).
+        """
+        res = self._app.get(url, status='*', expect_errors=True)
+        return res.status, len(res.body)
+
+class SocketClient(object):
+    """
+    Sends requests over HTTP to baseUrl.
+    """
+
+    def __init__(self, baseUrl):
+        self._baseUrl = baseUrl
+
+    def get(self, url):
+        try:
+            f = urllib2.urlopen(self._baseUrl + url)
+        except urllib2.HTTPError, e:
+            return e.code, len(e.read())
+
+        try:
+            return f.getcode(), len(f.read())
+        finally:
+            f.close()
+
+def startServer(app, threads):
+    """
+    Serve app on a free local port from a background thread.
+
+    :return: A tuple (server, baseUrl).  Stop the server with
+        server.shutdown() then server.server_close().
+    """
+    from paste import httpserver
+
+    server = httpserver.serve(app, host='127.0.0.1', port=0, start_loop=False,
+                              use_threadpool=True, threadpool_workers=threads)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+#-----------------------------------------------------------------------------
+# Running load
+
+class LoadResult(object):
+    """
+    The measurements of one run.
+
+    :ivar mode: 'inproc' or 'socket'.
+    :ivar workers: The number of worker threads.
+    :ivar latencies: The seconds taken by each request.
+    :ivar statuses: A dictionary of the number of responses by status.
+    :ivar errors: The number of requests that raised an exception.
+    :ivar bytes: The total size of the response bodies.
+    :ivar elapsed: The wall clock time of the run.
+    :ivar cacheStats: A dictionary mapping cache names to tuples
+        (hits, misses) counted during the run.
+
+    """
+
+    def __init__(self, mode, workers):
+        self.mode = mode
+        self.workers = workers
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.cacheStats = {}
+
+    def getThroughput(self):
+        return len(self.latencies) / max(self.elapsed, 1e-9)
+
+    def format(self):
+        lines = ['%s, %d workers: %d requests in %.2fs, %.1f req/s, %.1f MB' %
+                 (self.mode, self.workers, len(self.latencies), self.elapsed,
+                  self.getThroughput(), self.bytes / 1048576.0)]
+
+        if self.latencies:
+            lines.append('  latency ms: p50 %.1f  p95 %.1f  p99 %.1f  max %.1f' %
+                         tuple(1000 * x for x in
+                               (percentile(self.latencies, 50),
+                                percentile(self.latencies, 95),
+                                percentile(self.latencies, 99),
+                                max(self.latencies))))
+
+        lines.append('  status: %s' % ', '.join('%s=%d' % item for item in
+                                                 sorted(self.statuses.items())))
+
+        for name, (hits, misses) in sorted(self.cacheStats.items()):
+            if hits + misses:
+                lines.append('  cache %-16s %6d hits %6d misses %5.1f%%' %
+                             (name, hits, misses, 100.0 * hits / (hits + misses)))
+
+        return '\n'.join(lines)
+
+def _getCacheCounts():
+    return dict((name, (s.get('hits', 0), s.get('misses', 0)))
+                for name, s in metrics.getCacheStats().items())
+
+def runLoad(makeClient, urls, workers, mode='inproc'):
+    """
+    Send every URL once, spread over a number of worker threads.
+
+    @param makeClient: A function returning a client for a worker thread.
+    :return: A LoadResult.
+    """
+    queue = Queue()
+    for url in urls:
+        queue.put(url)
+
+    result = LoadResult(mode, workers)
+    lock = threading.Lock()
+
+    def work():
+        client = makeClient()
+        latencies = []
+        statuses = {}
+        errors = size = 0
+        while True:
+            try:
+                url = queue.get_nowait()
+            except Empty:
+                break
+
+            t0 = time.time()
+            try:
+                status, n = client.get(url)
+            except Exception, e:
+                log.warning("%s failed: %s" % (url, e))
+                status, n = 'exception', 0
+                errors += 1
+            latencies.append(time.time() - t0)
+            statuses[status] = statuses.get(status, 0) + 1
+            size += n
+
+        lock.acquire()
+        try:
+            result.latencies.extend(latencies)
+            for status, count in statuses.items():
+                result.statuses[status] = result.statuses.get(status, 0) + count
+            result.errors += errors
+            result.bytes += size
+        finally:
+            lock.release()
+
+    before = _getCacheCounts()
+    threads = [threading.Thread(target=work) for i in range(workers)]
+
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    result.elapsed = time.time() - t0
+
+    for name, (hits, misses) in _getCacheCounts().items():
+        h0, m0 = before.get(name, (0, 0))
+        result.cacheStats[name] = (hits - h0, misses - m0)
+
+    return result
+
+def clearCaches(shared=False):
+    """
+    Empty every cache registered with cows.metrics.
+
+    @param shared: Also empty disk and memcached caches.  These may be in
+        use by other servers, so by default only the local caches of
+        tiered caches and the in-memory caches are emptied.
+    """
+    for name, cache in metrics.getCaches().items():
+        if shared:
+            cache.clear()
+        elif isinstance(cache, TieredCache):
+            cache.local.clear()
+        elif isinstance(cache, (DiskCache, MemcachedCache)):
+            log.info("Not clearing shared cache %s" % name)
+        else:
+            cache.clear()
+
+def loadApp(configFile):
+    from paste.deploy import loadapp
+
+    return loadapp('config:%s' % os.path.abspath(configFile))
+
+def replay(app, urls, workerCounts, modes=('inproc',), cold=True, out=sys.stdout,
+           clearShared=False):
+    """
+    Replay urls for each mode and number of workers.
+
+    @param cold: Clear the caches before each run.  Otherwise each run sees
+        the caches left by the one before.
+    @param clearShared: Clear shared disk and memcached caches as well, see
+        clearCaches().
+    :return: A list of LoadResult.
+    """
+    results = []
+    for mode in modes:
+        for workers in workerCounts:
+            if cold:
+                clearCaches(clearShared)
+
+            if mode == 'socket':
+                server, baseUrl = startServer(app, workers)
+                try:
+                    result = runLoad(lambda: SocketClient(baseUrl), urls,
+                                     workers, mode)
+                finally:
+                    server.shutdown()
+                    server.server_close()
+            else:
+                result = runLoad(lambda: InProcessClient(app), urls, workers, mode)
+
+            out.write(result.format() + '\n')
+            results.append(result)
+
+    return results
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]",
+                          description="Replay WMS requests against a COWS "
+                          "application and report latency, throughput and "
+                          "cache hit ratios.")
+    parser.add_option('-c', '--config', default=DEFAULT_CONFIG,
+                      help="paste configuration file of the application "
+                      "(default the testapp with synthetic layers)")
+    parser.add_option('--log', metavar='FILE',
+                      help="replay GetMap, GetFeatureInfo and GetLegend requests "
+                      "from an access log instead of a tile pyramid")
+    parser.add_option('--path', default=DEFAULT_PATH,
+                      help="URL path of the WMS for tile pyramids, or only replay "
+                      "log requests under it (default %default)")
+    parser.add_option('-l', '--layers', default='temp',
+                      help="comma separated layers of the pyramid (default %default)")
+    parser.add_option('-z', '--levels', default='0-2',
+                      help="zoom levels of the pyramid (default %default)")
+    parser.add_option('-t', '--tile-size', type='int', default=256,
+                      help="tile width and height in pixels (default %default)")
+    parser.add_option('--param', action='append', default=[], metavar='NAME=VALUE',
+                      help="another GetMap parameter, may be repeated")
+    parser.add_option('-n', '--limit', type='int',
+                      help="replay at most this many requests")
+    parser.add_option('-r', '--repeat', type='int', default=1,
+                      help="replay the requests this many times (default %default)")
+    parser.add_option('-w', '--workers', default='1,2,4',
+                      help="worker thread counts, e.g. 1,2,4,8 (default %default)")
+    parser.add_option('-m', '--mode', default='inproc',
+                      choices=['inproc', 'socket', 'both'],
+                      help="inproc, socket or both (default %default)")
+    parser.add_option('--warm', action='store_true', default=False,
+                      help="keep the caches between runs")
+    parser.add_option('--clear-shared', action='store_true', default=False,
+                      help="also empty shared disk and memcached caches between "
+                      "runs, which may be in use by other servers")
+
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error("Unexpected arguments %s" % args)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    try:
+        if options.log:
+            urls = parseAccessLog(open(options.log), pathPrefix=options.path)
+        else:
+            params = [tuple(p.split('=', 1)) for p in options.param]
+            urls = makePyramidUrls(options.path, options.layers.split(','),
+                                   _parseRange(options.levels),
+                                   tileSize=options.tile_size, params=params)
+        workerCounts = _parseRange(options.workers)
+    except ValueError, e:
+        parser.error(str(e))
+
+    urls = urls[:options.limit] * options.repeat
+    if not urls:
+        sys.stderr.write("No requests to replay\n")
+        return 1
+
+    if options.mode == 'both':
+        modes = ['inproc', 'socket']
+    else:
+        modes = [options.mode]
+
+    sys.stdout.write("Replaying %d requests\n" % len(urls))
+    app = loadApp(options.config)
+    replay(app, urls, workerCounts, modes, cold=not options.warm,
+           clearShared=options.clear_shared)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+A WMS backend serving fields generated with numpy.
+
+SyntheticLayerMapper implements the cows.service.wms_iface interfaces
+with global lat/lon grids computed from a formula, so WMSController can
+be driven under load without a CSML store or network access.  Slabs are
+rendered with the same RGBARenderer as the CSML backend and may be given
+an artificial extraction delay to stand in for reading data.
+
+"""
+
+import time
+import math
+
+import numpy
+from matplotlib import cm
+
+from cows.service.wxs_iface import ILayerMapper
+from cows.service.wms_iface import IwmsLayer, IwmsDimension, IwmsLayerSlab
+from cows.service.imps.pywms.render_imp import RGBARenderer
+from cows.service.imps.variable_stats import computeStats
+
+import logging
+log = logging.getLogger(__name__)
+
+GLOBAL_BBOX = (-180.0, -90.0, 180.0, 90.0)
+
+def makeField(nx, ny, step, seed=0):
+    """
+    Return a (ny, nx) masked array of a smooth global field for time step
+    number step.  Values poleward of 80 degrees north are masked.
+
+    :return: A tuple (field, x0, y0, dx, dy) where (x0, y0) is the centre
+        of the first grid box.
+    """
+    dx = 360.0 / nx
+    dy = 180.0 / ny
+    x0 = -180.0 + dx / 2
+    y0 = -90.0 + dy / 2
+
+    lon = numpy.radians(x0 + dx * numpy.arange(nx))
+    lat = numpy.radians(y0 + dy * numpy.arange(ny))
+
+    phase = 0.3 * step + seed
+    field = (20.0 * numpy.cos(lat)[:, numpy.newaxis] +
+             5.0 * numpy.sin(3 * lon[numpy.newaxis, :] + phase) *
+             numpy.cos(2 * lat[:, numpy.newaxis] - phase))
+    field = field.astype(numpy.float32)
+
+    mask = numpy.zeros(field.shape, dtype=bool)
+    mask[lat > math.radians(80), :] = True
+
+    return numpy.ma.array(field, mask=mask), x0, y0, dx, dy
+
+class SyntheticGrid(object):
+    """
+    The grid attributes read by RGBARenderer.renderGrid(), see
+    cows.service.imps.csmlbackend.wms.wms_csmllayer.Grid.
+    """
+
+    def __init__(self, value, x0, y0, dx, dy, long_name, units):
+        self.value = value
+        self.x0 = x0
+        self.y0 = y0
+        self.dx = dx
+        self.dy = dy
+        self.ny, self.nx = value.shape
+        self.iy = 0
+        self.ix = 1
+        self.long_name = long_name
+        self.units = units
+        self.ok = True
+
+class SyntheticDimension(IwmsDimension):
+
+    def __init__(self, units, extent):
+        self.units = units
+        self.extent = extent
+
+class SyntheticLayer(IwmsLayer):
+    """
+    A layer with a time dimension whose slabs are generated fields.
+
+    :ivar gridSize: The number of (x, y) grid points of the field.
+    :ivar slabDelay: Seconds to sleep when creating a slab, standing in
+        for extracting the data.
+
+    """
+
+    def __init__(self, name, gridSize=(720, 360), times=4, slabDelay=0.0,
+                 seed=0):
+        self.name = name
+        self.title = name
+        self.abstract = 'Synthetic field %s' % name
+        self.units = 'K'
+        self.crss = ['EPSG:4326', 'CRS:84']
+        self.wgs84BBox = GLOBAL_BBOX
+        self.legendSize = (630, 80)
+        self.featureInfoFormats = ['text/html', 'text/plain']
+        self.styles = ['']
+        self.childLayers = []
+
+        self.timeValues = ['2000-%02d-01T00:00:00Z' % (i + 1) for i in range(times)]
+        self.dimensions = {'time': SyntheticDimension('ISO8601', self.timeValues)}
+
+        self.gridSize = gridSize
+        self.slabDelay = slabDelay
+        self.seed = seed
+
+    def getBBox(self, crs):
+        return GLOBAL_BBOX
+
+    def _getField(self, dimValues):
+        timeValue = (dimValues or {}).get('time', self.timeValues[0])
+        try:
+            step = self.timeValues.index(timeValue)
+        except ValueError:
+            step = 0
+
+        return makeField(self.gridSize[0], self.gridSize[1], step, self.seed)
+
+    def getSlab(self, crs, style, dimValues, transparent, bgcolor,
+                additionalParams={}):
+        if self.slabDelay:
+            time.sleep(self.slabDelay)
+
+        field, x0, y0, dx, dy = self._getField(dimValues)
+        grid = SyntheticGrid(field, x0, y0, dx, dy, self.name, self.units)
+
+        return SyntheticLayerSlab(grid, self, crs, dimValues, additionalParams,
+                                  self.getBBox(crs))
+
+    def getCacheKey(self, crs, style, dimValues, transparent, bgcolor,
+                    additionalParams={}):
+        return '%s:%s:%s:%s:%s:%s:%s' % (self.name, crs, style,
+                                         sorted((dimValues or {}).items()),
+                                         transparent, bgcolor,
+                                         sorted(additionalParams.items()))
+
+    def getLegendImage(self, dimValues, orientation='horizontal',
+                       renderOpts={}, style=None):
+        stats = computeStats(self._getField(dimValues)[0])
+        renderer = RGBARenderer(stats.minval, stats.maxval)
+
+        width, height = self.legendSize
+        return renderer.renderColourbar(int(renderOpts.get('width', width)),
+                                        int(renderOpts.get('height', height)),
+                                        cm.get_cmap('jet'),
+                                        isVertical=(orientation == 'vertical'))
+
+    def getFeatureInfo(self, format, crs, point, dimValues):
+        field, x0, y0, dx, dy = self._getField(dimValues)
+        i = int(round((point[0] - x0) / dx)) % field.shape[1]
+        j = min(max(int(round((point[1] - y0) / dy)), 0), field.shape[0] - 1)
+
+        value = field[j, i]
+        if value is numpy.ma.masked:
+            return 'missing'
+        return str(float(value))
+
+class SyntheticLayerSlab(IwmsLayerSlab):
+    """
+    A slab holding a generated grid, pickleable for the shared slab cache
+    backends.
+    """
+
+    def __init__(self, grid, layer, crs, dimValues, renderOpts, bbox):
+        self._grid = grid
+        self.layer = layer
+        self.crs = crs
+        self.dimValues = dimValues
+        self.renderOpts = renderOpts
+        self.bbox = bbox
+
+        stats = computeStats(grid.value)
+        self.minval = stats.minval
+        self.maxval = stats.maxval
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['layer'] = None
+        return state
+
+    def getImage(self, bbox, width, height):
+        renderer = RGBARenderer(self.minval, self.maxval)
+        return renderer.renderGrid(self._grid, bbox, width, height,
+                                   cm.get_cmap('jet'))
+
+class SyntheticLayerMapper(ILayerMapper):
+    """
+    Maps any fileoruri to the same set of synthetic layers.
+
+    @param layerNames: The names of the layers.
+    @param layerOptions: Keyword arguments of SyntheticLayer.
+    """
+
+    def __init__(self, layerNames=('temp', 'precip', 'wind'), **layerOptions):
+        self.datasetName = 'Synthetic data'
+        self._layers = {}
+        for i, name in enumerate(layerNames):
+            self._layers[name] = SyntheticLayer(name, seed=i, **layerOptions)
+
+    def map(self, **kwargs):
+        return self._layers
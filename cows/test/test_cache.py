@@ -0,0 +1,248 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test the caches in cows.cache
+
+"""
+
+import tempfile
+import shutil
+import threading
+import time
+
+from cows.cache import LRUCache, DiskCache, TieredCache, SingleFlight, \
+    SingleFlightTimeout, cacheFromConfig, parseSize, requestCacheKey, \
+    isCacheable
+
+def _size(value):
+    return len(value)
+
+def test_parseSize():
+    assert parseSize('512') == 512
+    assert parseSize('2k') == 2048
+    assert parseSize('1.5M') == 1572864
+    assert parseSize('1GB') == 1024**3
+    assert parseSize('') is None
+
+def test_lru_eviction():
+    cache = LRUCache(maxBytes=10, sizeFunc=_size)
+    cache.put('a', 'xxxx')
+    cache.put('b', 'xxxx')
+    cache.get('a')
+    cache.put('c', 'xxxx')
+
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert 'c' in cache
+    assert cache.getStats()['evictions'] == 1
+    assert cache.getStats()['bytes'] == 8
+
+def test_lfu_eviction():
+    cache = LRUCache(maxEntries=2, policy='lfu', sizeFunc=_size)
+    cache.put('a', 'x')
+    cache.put('b', 'x')
+    cache.get('b')
+    cache.get('b')
+    cache.get('a')
+    cache.put('c', 'x')
+
+    assert 'a' not in cache
+    assert 'b' in cache
+
+def test_group_quota():
+    cache = LRUCache(maxBytes=100, groupMaxBytes=6, sizeFunc=_size)
+    cache.put('a1', 'xxx', group='a')
+    cache.put('b1', 'xxx', group='b')
+    cache.put('a2', 'xxx', group='a')
+    cache.put('a3', 'xxx', group='a')
+
+    assert 'a1' not in cache
+    assert 'b1' in cache
+    assert 'a3' in cache
+
+def test_oversized_value_rejected():
+    cache = LRUCache(maxBytes=3, sizeFunc=_size)
+    assert not cache.put('a', 'xxxx')
+    assert 'a' not in cache
+    assert cache.getStats()['rejections'] == 1
+
+def test_counters():
+    cache = LRUCache(sizeFunc=_size)
+    cache.put('a', 'x')
+    cache.get('a')
+    cache.get('b')
+    stats = cache.getStats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['hitRatio'] == 0.5
+
+def test_cacheFromConfig():
+    cache = cacheFromConfig({'x.max_bytes': '1M', 'x.policy': 'LFU'}, 'x',
+                            maxEntries=10)
+    assert cache.maxBytes == 1024**2
+    assert cache.maxEntries == 10
+    assert cache.policy == 'lfu'
+
+def test_requestCacheKey():
+    context = ('csmlwms', 'data', 100.0, False)
+    params = {'layers': 'temp', 'bbox': '0,0,10.000000000001,10', 'width': '256'}
+    key = requestCacheKey(context, params)
+
+    # The bbox is normalised and the parameter order doesn't matter
+    assert key == requestCacheKey(context, {'width': '256', 'layers': 'temp',
+                                            'bbox': '0.0,0,10,10.0'})
+    assert key == requestCacheKey(context, dict(params, bbox='1,1,2,2'),
+                                  bbox=(0, 0, 10, 10))
+    assert key != requestCacheKey(context, dict(params, bbox='0,0,10.001,10'))
+    assert key != requestCacheKey(context, dict(params, width='512'))
+
+    # Other controllers, and the same layers after a reload, differ
+    assert key != requestCacheKey(('netcdfwms', 'data', 100.0, False), params)
+    assert key != requestCacheKey(('csmlwms', 'data', 200.0, False), params)
+
+    # An invalid bbox is left as it is
+    assert "'x,y'" in requestCacheKey(context, {'bbox': 'x,y'})
+
+class _Layer(object):
+    def __init__(self, name, cacheable=True):
+        self.name = name
+        self.cacheable = cacheable
+        self.calls = []
+
+    def getCacheKey(self, crs, style, dimValues, transparent, bgcolor,
+                    additionalParams):
+        self.calls.append((crs, style))
+        if self.cacheable:
+            return '%s:%s:%s' % (self.name, crs, style)
+        return None
+
+def test_isCacheable():
+    temp = _Layer('temp')
+    wind = _Layer('wind')
+    live = _Layer('live', cacheable=False)
+
+    assert isCacheable([(temp, 'EPSG:4326', '', {}, True, None, {}),
+                        (wind, 'EPSG:4326', 'arrows', {}, True, None, {})])
+    assert wind.calls == [('EPSG:4326', 'arrows')]
+
+    # One layer without a cache key makes the whole image uncacheable
+    assert not isCacheable([(temp, 'EPSG:4326', '', {}, True, None, {}),
+                            (live, 'EPSG:4326', '', {}, True, None, {})])
+    assert live.calls == [('EPSG:4326', '')]
+    assert isCacheable([])
+
+def test_diskCache():
+    directory = tempfile.mkdtemp()
+    try:
+        shared = DiskCache(directory)
+        shared.put('a', {'x': [1, 2, 3]})
+        assert shared.get('a') == {'x': [1, 2, 3]}
+        assert shared.get('b') is None
+
+        # A second process sees the same entries
+        other = TieredCache(LRUCache(), DiskCache(directory))
+        assert other.get('a') == {'x': [1, 2, 3]}
+        assert 'a' in other.local
+    finally:
+        shutil.rmtree(directory)
+
+def test_tieredCache_group():
+    directory = tempfile.mkdtemp()
+    try:
+        writer = TieredCache(LRUCache(sizeFunc=_size), DiskCache(directory))
+        for key in ['a1', 'a2', 'a3']:
+            writer.put(key, 'xxx', group='a')
+
+        # Entries copied from the shared cache keep their group quota
+        reader = TieredCache(LRUCache(groupMaxBytes=6, sizeFunc=_size),
+                             DiskCache(directory))
+        for key in ['a1', 'a2', 'a3']:
+            assert reader.get(key) == 'xxx'
+
+        assert 'a1' not in reader.local
+        assert 'a2' in reader.local and 'a3' in reader.local
+        assert reader.local._groupBytes == {'a': 6}
+    finally:
+        shutil.rmtree(directory)
+
+def test_ttl():
+    cache = LRUCache(ttl=60, sizeFunc=_size)
+    cache.put('a', 'x')
+    assert cache.get('a') == 'x'
+
+    cache._entries['a'].expires = 0
+    assert cache.get('a') is None
+    assert 'a' not in cache
+    assert cache.getStats()['expirations'] == 1
+
+def test_singleFlight():
+    flight = SingleFlight(timeout=5)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'value'
+
+    def request():
+        results.append(flight.do('key', work))
+
+    threads = [threading.Thread(target=request)]
+    threads[0].start()
+    started.wait(5)
+    for i in range(4):
+        t = threading.Thread(target=request)
+        t.start()
+        threads.append(t)
+
+    while flight.getStats()['shared'] < 4:
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == ['value'] * 5
+
+def test_singleFlight_error():
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError('broken')
+
+    try:
+        flight.do('key', fail)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("ValueError not raised")
+
+    # The failed call must not be remembered
+    assert flight.do('key', lambda: 1) == 1
+
+def test_singleFlight_timeout():
+    flight = SingleFlight(timeout=0.01)
+    release = threading.Event()
+    t = threading.Thread(target=flight.do, args=('key', release.wait, 5))
+    t.start()
+    while flight.getStats()['calls'] < 1:
+        time.sleep(0.01)
+
+    try:
+        flight.do('key', lambda: 1)
+    except SingleFlightTimeout:
+        pass
+    else:
+        raise AssertionError("SingleFlightTimeout not raised")
+
+    release.set()
+    t.join()
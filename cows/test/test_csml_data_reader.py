@@ -0,0 +1,128 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test the caching and point reads of
+cows.service.imps.csmlbackend.wms.csml_data_reader
+
+"""
+
+import os
+import tempfile
+
+import numpy
+
+from cows.cache import cacheFromConfig, LRUCache
+from cows.service.imps.csmlbackend.wms.csml_data_reader import CSMLDataReader, \
+     getVarFlight, _nearestAxisValue, _nearestGridPoint
+
+class _Connector(object):
+    def __init__(self, path):
+        self.path = path
+
+    def getSourcePaths(self, fileoruri):
+        return [self.path]
+
+class _Reader(CSMLDataReader):
+    """
+    A CSMLDataReader whose variables are made up rather than extracted
+    from a CSML document.
+    """
+
+    def __init__(self, connector, varcache, statscache):
+        self.connector = connector
+        self.fileoruri = 'data'
+        self.varcache = varcache
+        self.statscache = statscache
+        self.lastModified = self._getSourcesLastModified()
+        self.reads = 0
+
+    def _readVariable(self, featureId, dimValues):
+        self.reads += 1
+        return numpy.ma.array([1.0, 2.0]) * self.reads
+
+def test_varcache_refreshed_after_source_change():
+    fd, path = tempfile.mkstemp('.csml')
+    os.close(fd)
+    try:
+        os.utime(path, (1000, 1000))
+        connector = _Connector(path)
+        varcache = cacheFromConfig({}, 'varcache', maxBytes='1M')
+        statscache = LRUCache()
+
+        reader = _Reader(connector, varcache, statscache)
+        assert reader.getNetcdfVar('temp', {'time': 't0'}).max() == 2.0
+        assert reader.getNetcdfVar('temp', {'time': 't0'}).max() == 2.0
+        assert reader.reads == 1
+
+        # The layer map is rebuilt with a new reader when the sources change
+        os.utime(path, (2000, 2000))
+        reader = _Reader(connector, varcache, statscache)
+        reader.reads = 1
+        assert reader.getNetcdfVar('temp', {'time': 't0'}).max() == 4.0
+        assert reader.getVariableStats('temp', {'time': 't0'}).maxval == 4.0
+        assert reader.reads == 2
+    finally:
+        os.remove(path)
+
+def test_loadVariable_rechecks_cache():
+    fd, path = tempfile.mkstemp('.csml')
+    os.close(fd)
+    try:
+        reader = _Reader(_Connector(path), LRUCache(), LRUCache())
+        reader.getNetcdfVar('temp', {'time': 't0'})
+
+        # A request that missed the cache just before the variable was
+        # loaded doesn't read it again
+        cacheKey = reader._getCacheKey('temp', {'time': 't0'})
+        variable = getVarFlight().do(cacheKey, reader._loadVariable,
+                                     'temp', {'time': 't0'}, cacheKey)
+        assert variable.max() == 2.0
+        assert reader.reads == 1
+    finally:
+        os.remove(path)
+
+def test_nearestAxisValue():
+    axis = numpy.array([10.0, 12.0, 14.0, 16.0])
+
+    assert _nearestAxisValue(axis, 12.9) == 12.0
+    assert _nearestAxisValue(axis, 13.1) == 14.0
+    assert _nearestAxisValue(axis, 9.0) == 10.0
+    assert _nearestAxisValue(axis, 17.0) == 16.0
+    assert _nearestAxisValue(axis, 8.9) is None
+    assert _nearestAxisValue(axis, 17.1) is None
+
+    # Descending axes as used for latitudes
+    assert _nearestAxisValue(axis[::-1], 15.2) == 16.0
+
+    assert _nearestAxisValue(numpy.array([5.0]), 5.0) == 5.0
+    assert _nearestAxisValue(numpy.array([5.0]), 5.1) is None
+
+def test_nearestGridPoint():
+    lat = numpy.arange(-89.5, 90.0, 1.0)
+
+    # A grid using 0 to 360 longitudes
+    lon = numpy.arange(0.0, 360.0, 1.0)
+    assert _nearestGridPoint(lon, lat, 10.2, 0.2) == (10.0, 0.5)
+    assert _nearestGridPoint(lon, lat, -10.2, 0.2) == (350.0, 0.5)
+    assert _nearestGridPoint(lon, lat, -0.2, 0.2) == (0.0, 0.5)
+    assert _nearestGridPoint(lon, lat, -0.7, 0.2) == (359.0, 0.5)
+    assert _nearestGridPoint(lon, lat, 180.0, 0.2) == (180.0, 0.5)
+
+    # A grid using -180 to 180 longitudes
+    lon = numpy.arange(-180.0, 180.0, 1.0)
+    assert _nearestGridPoint(lon, lat, -10.2, 0.2) == (-10.0, 0.5)
+    assert _nearestGridPoint(lon, lat, 350.2, 0.2) == (-10.0, 0.5)
+
+def test_nearestGridPoint_outsideGrid():
+    lon = numpy.arange(0.0, 20.0, 2.0)
+    lat = numpy.arange(40.0, 60.0, 2.0)
+
+    assert _nearestGridPoint(lon, lat, 25.0, 50.0) == (None, 50.0)
+    assert _nearestGridPoint(lon, lat, -5.0, 50.0) == (None, 50.0)
+    assert _nearestGridPoint(lon, lat, 10.0, 70.0) == (10.0, None)
+    assert _nearestGridPoint(lon, lat, -0.9, 39.1) == (0.0, 40.0)
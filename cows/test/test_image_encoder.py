@@ -0,0 +1,124 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test cows.image_encoder
+
+"""
+
+from cStringIO import StringIO
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+from cows.image_encoder import ImageEncoder, encoderFromConfig, parseColour, \
+     composeImages
+
+def _tile():
+    img = Image.new('RGBA', (16, 16), (0, 0, 0, 0))
+    img.paste((255, 0, 0, 255), (0, 0, 8, 8))
+    img.paste((0, 0, 255, 255), (8, 8, 16, 16))
+    return img
+
+def test_parseColour():
+    assert parseColour('0xFF8000') == (255, 128, 0)
+    assert parseColour('#000010') == (0, 0, 16)
+
+def test_palette_png():
+    img = _tile()
+    data = ImageEncoder().encode(img, 'image/png')
+    decoded = Image.open(StringIO(data))
+
+    assert decoded.mode == 'P'
+    assert decoded.convert('RGBA').getpixel((0, 0)) == (255, 0, 0, 255)
+    assert decoded.convert('RGBA').getpixel((15, 0))[3] == 0
+
+def test_too_many_colours():
+    img = _tile()
+    img.putpixel((0, 15), (1, 2, 3, 128))
+    data = ImageEncoder().encode(img, 'image/png')
+    assert Image.open(StringIO(data)).mode == 'RGBA'
+
+def test_jpeg_flattened():
+    data = ImageEncoder().encode(_tile(), 'image/jpeg', background=(0, 255, 0))
+    decoded = Image.open(StringIO(data))
+    assert decoded.mode == 'RGB'
+    r, g, b = decoded.getpixel((15, 0))
+    assert g > 200 and r < 50
+
+def test_opaque_png():
+    data = ImageEncoder().encode(_tile(), 'image/png', opaque=True,
+                                 background=(0, 255, 0))
+    decoded = Image.open(StringIO(data)).convert('RGBA')
+
+    assert decoded.getpixel((0, 0)) == (255, 0, 0, 255)
+    assert decoded.getpixel((15, 0)) == (0, 255, 0, 255)
+
+def test_opaque_partly_transparent():
+    img = Image.new('RGBA', (4, 4), (255, 0, 0, 128))
+    data = ImageEncoder(palette=False).encode(img, 'image/png', opaque=True,
+                                              background=(0, 0, 255))
+    decoded = Image.open(StringIO(data))
+
+    assert decoded.mode == 'RGB'
+    r, g, b = decoded.getpixel((0, 0))
+    assert abs(r - 128) <= 1 and g == 0 and abs(b - 127) <= 1
+
+def test_opaque_jpeg():
+    data = ImageEncoder().encode(_tile(), 'image/jpeg', opaque=True,
+                                 background=(0, 255, 0))
+    r, g, b = Image.open(StringIO(data)).getpixel((15, 0))
+    assert g > 200 and r < 50
+
+def test_encoderFromConfig():
+    encoder = encoderFromConfig({'x.png_palette': 'False',
+                                 'x.png_strategy': 'RLE'}, 'x')
+    assert not encoder.palette
+    assert encoder.strategy == 'rle'
+    assert encoder.maxColours == 256
+
+def _composite(images):
+    # How GetMap blended the layers before composeImages
+    width, height = images[0].size
+    finalImg = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    for img in images:
+        finalImg = Image.composite(finalImg, img.convert('RGBA'), finalImg)
+    return finalImg
+
+def test_composeImages_order():
+    top = Image.new('RGBA', (4, 4), (0, 0, 0, 0))
+    top.paste((255, 0, 0, 255), (0, 0, 2, 4))
+    bottom = Image.new('RGBA', (4, 4), (0, 0, 255, 255))
+
+    composed = composeImages([top, bottom])
+
+    assert composed.mode == 'RGBA'
+    assert composed.getpixel((0, 0)) == (255, 0, 0, 255)
+    assert composed.getpixel((3, 0)) == (0, 0, 255, 255)
+    assert composeImages([bottom, top]).getpixel((0, 0)) == (0, 0, 255, 255)
+    assert list(composed.getdata()) == list(_composite([top, bottom]).getdata())
+
+def test_composeImages_alpha():
+    images = [Image.new('RGBA', (4, 1), (0, 0, 0, 0)) for i in range(3)]
+    images[0].putdata([(255, 0, 0, 128), (0, 0, 0, 0), (10, 20, 30, 64), (0, 0, 0, 0)])
+    images[1].putdata([(0, 255, 0, 255), (0, 255, 0, 100), (40, 50, 60, 200), (0, 0, 0, 0)])
+    images[2].putdata([(0, 0, 255, 255), (0, 0, 255, 255), (70, 80, 90, 255), (0, 0, 0, 0)])
+
+    composed = list(composeImages(images).getdata())
+    expected = list(_composite(images).getdata())
+
+    for pixel, expectedPixel in zip(composed, expected):
+        for band, expectedBand in zip(pixel, expectedPixel):
+            assert abs(band - expectedBand) <= 1
+
+    assert composed[3] == (0, 0, 0, 0)
+
+def test_composeImages_single():
+    img = _tile()
+    assert list(composeImages([img]).getdata()) == list(img.getdata())
@@ -0,0 +1,77 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test cows.metrics
+
+"""
+
+import threading
+
+from cows.metrics import MetricsRegistry, registerCache, registry
+from cows.cache import LRUCache
+
+def test_counter_threads():
+    reg = MetricsRegistry()
+    counter = reg.counter('test_total', 'Test.', ['op'])
+
+    def work():
+        for i in range(1000):
+            counter.inc(('GetMap',))
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    counter.inc(('GetLegendGraphic',), 2)
+
+    text = reg.exposition()
+    assert '# TYPE test_total counter' in text
+    assert 'test_total{op="GetMap"} 4000\n' in text
+    assert 'test_total{op="GetLegendGraphic"} 2\n' in text
+
+def test_same_counter():
+    reg = MetricsRegistry()
+    assert reg.counter('a_total', 'A.') is reg.counter('a_total', 'A.')
+    try:
+        reg.histogram('a_total', 'A.')
+    except ValueError:
+        pass
+    else:
+        assert False
+
+def test_histogram():
+    reg = MetricsRegistry()
+    hist = reg.histogram('test_seconds', 'Test.', ['op'], buckets=(0.1, 1.0))
+    for x in (0.05, 0.5, 0.5, 3.0):
+        hist.observe(('GetMap',), x)
+
+    lines = reg.exposition().splitlines()
+    assert 'test_seconds_bucket{op="GetMap",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{op="GetMap",le="1.0"} 3' in lines
+    assert 'test_seconds_bucket{op="GetMap",le="+Inf"} 4' in lines
+    assert 'test_seconds_sum{op="GetMap"} 4.05' in lines
+    assert 'test_seconds_count{op="GetMap"} 4' in lines
+
+def test_label_escaping():
+    reg = MetricsRegistry()
+    reg.counter('b_total', 'B.', ['x']).inc(('a"b\\c',))
+    assert 'b_total{x="a\\"b\\\\c"} 1' in reg.exposition()
+
+def test_cache_stats():
+    cache = LRUCache(maxEntries=10)
+    cache.put('k', 'v')
+    cache.get('k')
+    cache.get('missing')
+    registerCache('test_cache', lambda: cache)
+    registerCache('test_uncreated', lambda: None)
+
+    text = registry.exposition()
+    assert 'cows_cache_hits_total{cache="test_cache"} 1\n' in text
+    assert 'cows_cache_misses_total{cache="test_cache"} 1\n' in text
+    assert 'cows_cache_entries{cache="test_cache"} 1\n' in text
+    assert 'test_uncreated' not in text
@@ -0,0 +1,33 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test the cache keys of cows.service.imps.netcdfbackend.netcdf_data_reader
+
+"""
+
+from cows.service.imps.netcdfbackend.netcdf_data_reader import NetcdfDataReader
+from cows.service.imps.csmlbackend.wms.csml_data_reader import CSMLDataReader
+
+def _reader(cls, fileoruri, lastModified):
+    reader = cls.__new__(cls)
+    reader.fileoruri = fileoruri
+    reader.lastModified = lastModified
+    return reader
+
+def test_getCacheKey():
+    dimValues = {'time': '2000-01-01T00:00:00Z', 'level': '850'}
+    key = _reader(NetcdfDataReader, 'ocean/sst', 1000.0)._getCacheKey('sst', dimValues)
+
+    assert key == _reader(NetcdfDataReader, 'ocean/sst', 1000.0)._getCacheKey(
+        'sst', dict(dimValues))
+
+    # Variables read before the file changed aren't used
+    assert key != _reader(NetcdfDataReader, 'ocean/sst', 2000.0)._getCacheKey('sst', dimValues)
+
+    # The variable caches are shared with CSML readers
+    assert key != _reader(CSMLDataReader, 'ocean/sst', 1000.0)._getCacheKey('sst', dimValues)
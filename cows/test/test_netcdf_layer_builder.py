@@ -0,0 +1,43 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test the slab cache keys of cows.service.imps.netcdfbackend.netcdf_layer_builder
+
+"""
+
+from cows.service.imps.netcdfbackend.netcdf_layer_builder import NetcdfWmsLayer
+from cows.service.imps.geoplot_wms_backend.geoplot_wms_layer import GeoplotWmsLayer
+
+class _Reader(object):
+    def __init__(self, fileoruri, lastModified):
+        self.fileoruri = fileoruri
+        self.lastModified = lastModified
+
+def _layer(cls, fileoruri, varId, lastModified=1000.0):
+    layer = cls.__new__(cls)
+    layer.name = fileoruri.replace('/', '_') + '_' + varId
+    layer.title = varId
+    layer.dataReader = _Reader(fileoruri, lastModified)
+    return layer
+
+def _key(layer):
+    return layer.getCacheKey('CRS:84', '', {'time': '2000-01-01T00:00:00Z'},
+                             True, '0xFFFFFF')
+
+def test_getCacheKey():
+    key = _key(_layer(NetcdfWmsLayer, 'a/b', 'c'))
+
+    assert key == _key(_layer(NetcdfWmsLayer, 'a/b', 'c'))
+
+    # Layers with the same name
+    assert key != _key(_layer(NetcdfWmsLayer, 'a_b', 'c'))
+    assert key != _key(_layer(NetcdfWmsLayer, 'a', 'b_c'))
+    assert key != _key(_layer(GeoplotWmsLayer, 'a/b', 'c'))
+
+    # Slabs made before the file changed aren't used
+    assert key != _key(_layer(NetcdfWmsLayer, 'a/b', 'c', 2000.0))
@@ -0,0 +1,78 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test cows.service.imps.netcdfbackend.netcdfcommon
+
+"""
+
+import os
+import shutil
+import tempfile
+
+from cows.service.imps.csmlbackend.config import config
+from cows.service.imps.netcdfbackend.netcdfcommon import normaliseTime, \
+     getTimeSlice, NetcdfConnector
+
+TIMES = ['2000-01-01T00:00:00Z', '2000-02-01T00:00:00Z', '2000-03-01T00:00:00Z']
+
+def test_normaliseTime():
+    assert normaliseTime('2000-01-01') == '2000-01-01T00:00:00Z'
+    assert normaliseTime('2000-1-1T12:30') == '2000-01-01T12:30:00Z'
+    assert normaliseTime('2000-01-01T12:30:15.0') == '2000-01-01T12:30:15Z'
+    assert normaliseTime('2000-01-01T12:30:15Z') == '2000-01-01T12:30:15Z'
+
+    try:
+        normaliseTime('yesterday')
+    except ValueError:
+        pass
+    else:
+        assert False
+
+def test_getTimeSlice():
+    assert getTimeSlice(TIMES, '2000-02-01T00:00:00.0') == slice(1, 2)
+    assert getTimeSlice(TIMES, '2000-01-15/2000-12-31') == slice(1, 3)
+    assert getTimeSlice(TIMES, '2000-01-01/2000-03-01') == slice(0, 3)
+
+    for timeValue in ['2000-01-02', '2001-01-01/2001-12-31']:
+        try:
+            getTimeSlice(TIMES, timeValue)
+        except ValueError:
+            pass
+        else:
+            assert False
+
+def test_NetcdfConnector():
+    store = tempfile.mkdtemp()
+    oldStore = config.get('netcdfstore')
+    config['netcdfstore'] = store
+    try:
+        os.mkdir(os.path.join(store, 'ocean'))
+        for name in ['a.nc', 'a.ini', 'b.txt', 'ocean/sst.nc4']:
+            open(os.path.join(store, name), 'w').close()
+
+        connector = NetcdfConnector()
+
+        assert list(connector.list()) == ['a', 'ocean']
+        assert list(connector.list('ocean')) == ['ocean/sst']
+        assert connector.isGroup('ocean')
+        assert not connector.isGroup('a')
+        assert connector.getFilePath('ocean/sst') == os.path.join(store, 'ocean', 'sst.nc4')
+        assert connector.getColourMapConfig('a') is not None
+        assert connector.getColourMapConfig('ocean/sst') is None
+        assert os.path.join(store, 'ocean', 'sst.nc4') in connector.getSourcePaths('ocean')
+
+        for fileoruri in ['b', '../a']:
+            try:
+                connector.getFilePath(fileoruri)
+            except ValueError:
+                pass
+            else:
+                assert False
+    finally:
+        config['netcdfstore'] = oldStore
+        shutil.rmtree(store)
@@ -0,0 +1,61 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test cows.profiling
+
+"""
+
+import os
+import shutil
+import tempfile
+
+from cows.profiling import Profile, isProfileRequested, getProfileFileName, \
+     saveProfile, findProfiles, mergeProfiles, getTopFunctions
+
+def _hot(n):
+    return sum(i * i for i in range(n))
+
+def test_isProfileRequested():
+    conf = {'cows.profile.dir': '/tmp', 'cows.profile.secret': 's3cret'}
+    assert isProfileRequested(conf, 's3cret')
+    assert not isProfileRequested(conf, 'wrong')
+    assert not isProfileRequested(conf, None)
+
+    conf['cows.profile.sample_rate'] = '1'
+    assert isProfileRequested(conf, None)
+
+    del conf['cows.profile.dir']
+    assert not isProfileRequested(conf, 's3cret')
+
+def test_getProfileFileName():
+    path = getProfileFileName('/tmp/p', 'WMS.GetMap', 'temp,precip', 'data/a b')
+    name = os.path.basename(path)
+    assert os.path.dirname(path) == '/tmp/p'
+    assert name.startswith('WMS.GetMap--temp_precip--data_a_b--')
+    assert name.endswith('.pstats')
+
+def test_merge():
+    d = tempfile.mkdtemp()
+    try:
+        for layer in ('a', 'b'):
+            profiler = Profile()
+            profiler.runcall(_hot, 10000)
+            saveProfile(profiler, getProfileFileName(os.path.join(d, 'new'),
+                                                     'WMS.GetMap', layer))
+
+        files = findProfiles([os.path.join(d, 'new')])
+        assert len(files) == 2
+        assert len(findProfiles([os.path.join(d, 'new')], 'WMS.GetMap--b--*')) == 1
+
+        stats = mergeProfiles(files)
+        names = [row[0] for row in getTopFunctions(stats, 50)]
+        hot = [row for row in getTopFunctions(stats, 50) if row[0].endswith('(_hot)')]
+        assert len(hot) == 1, names
+        assert hot[0][1] == 2
+    finally:
+        shutil.rmtree(d)
@@ -0,0 +1,37 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test the baseline comparison of cows.test.perf.render_bench
+
+"""
+
+from cows.test.perf.render_bench import BenchCase, compareResults, measure
+
+def test_caseId():
+    case = BenchCase((720, 360), 256, 'jet', 0.3)
+    assert case.getId() == 'grid720x360-tile256-jet-mask30'
+
+def test_compareResults():
+    baseline = {'results': {'a': {'min': 0.010, 'median': 0.011, 'peak_kb': 1000},
+                            'b': {'min': 0.010, 'median': 0.011, 'peak_kb': 1000},
+                            'c': {'min': 0.010, 'median': 0.011, 'peak_kb': None}}}
+    results = {'a': {'min': 0.0105, 'median': 0.2, 'peak_kb': 1500},
+               'b': {'min': 0.020, 'median': 0.021, 'peak_kb': 5000},
+               'c': {'min': 0.005, 'median': 0.006, 'peak_kb': 9000},
+               'new': {'min': 1.0, 'median': 1.0, 'peak_kb': 1}}
+
+    regressions, improvements = compareResults(baseline, results, tolerance=0.1)
+    assert regressions == [('b', 'min', 0.010, 0.020),
+                           ('b', 'peak_kb', 1000, 5000)]
+    assert improvements == [('c', 'min', 0.010, 0.005)]
+
+def test_measure():
+    calls = []
+    result = measure(lambda: calls.append(1), repeat=3)
+    assert len(calls) == 4
+    assert 0 <= result['min'] <= result['median']
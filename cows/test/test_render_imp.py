@@ -0,0 +1,156 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test the colour lookup tables and resampling of
+cows.service.imps.pywms.render_imp
+
+"""
+
+import numpy as N
+from matplotlib import cm
+
+from cows.service.imps.pywms.render_imp import RGBARenderer, getColourLUT, \
+     getAxisIndexMap
+from cows.test.perf.synthetic_backend import SyntheticGrid
+
+def _grid():
+    # A 4x4 grid with points at the centres of boxes 1 unit wide from 0 to 4
+    value = N.ma.array(N.arange(16, dtype=N.float32).reshape((4, 4)))
+    return SyntheticGrid(value, 0.5, 0.5, 1.0, 1.0, 'test', 'K')
+
+def test_getColourLUT():
+    lut, bad = getColourLUT(cm.jet, 16)
+
+    assert lut.shape == (16, 4) and lut.dtype == N.uint8
+    assert getColourLUT(cm.jet, 16)[0] is lut
+
+    cmap = cm.get_cmap('jet')
+    cmap.set_bad('#ffffff', 0.0)
+    assert tuple(getColourLUT(cmap, 16)[1]) == (255, 255, 255, 0)
+
+def test_quantise_bins():
+    renderer = RGBARenderer(0.0, 1.0)
+    value = N.ma.array([0.0, 0.2499, 0.25, 0.5, 0.7499, 0.75, 1.0])
+
+    index, mask = renderer._quantise(value, 4)
+
+    assert index.dtype == N.uint8
+    assert index.tolist() == [0, 0, 1, 2, 2, 3, 3]
+    assert not mask.any()
+
+def test_quantise_outOfRange():
+    renderer = RGBARenderer(10.0, 20.0)
+
+    index, mask = renderer._quantise(N.ma.array([-5.0, 9.9, 20.1, 1e30]), 256)
+
+    assert index.tolist() == [0, 0, 255, 255]
+    assert not mask.any()
+
+    index, mask = renderer._quantise(N.ma.array([0.0, 1000.0]), 1024)
+    assert index.dtype == N.uint16
+    assert index.tolist() == [0, 1023]
+
+def test_quantise_masked():
+    renderer = RGBARenderer(0.0, 1.0)
+    value = N.ma.array([0.5, 0.6, N.nan, N.inf, -N.inf],
+                       mask=[False, True, False, False, False])
+
+    index, mask = renderer._quantise(value, 256)
+
+    assert mask.tolist() == [False, True, True, True, True]
+    assert index.tolist() == [128, 0, 0, 0, 0]
+
+def test_quantise_constantField():
+    index, mask = RGBARenderer(3.0, 3.0)._quantise(N.ma.array([3.0, 3.0]), 256)
+
+    assert index.tolist() == [0, 0]
+
+def test_colourLUT_matches_colour_map():
+    # With one table entry per colour the table gives the same colours as
+    # colouring through the colour map
+    renderer = RGBARenderer(0.0, 1.0)
+    cmap = cm.get_cmap('jet')
+    cmap.set_bad('#ffffff', 0.0)
+    renderer.lutSize = cmap.N
+
+    value = N.ma.array([(N.arange(cmap.N) + 0.5) / cmap.N])
+    expected = (cmap(renderer._norm(value)) * 255).astype(N.uint8)
+
+    assert (renderer._colourLUT(value, cmap) == expected).all()
+
+    value[0, 0] = N.ma.masked
+    assert tuple(renderer._colourLUT(value, cmap)[0, 0]) == (255, 255, 255, 0)
+
+def test_getAxisIndexMap_nearest():
+    index, valid = getAxisIndexMap(0.5, 1.0, 4, 0.0, 4.0, 8)
+
+    assert index.tolist() == [0, 0, 1, 1, 2, 2, 3, 3]
+    assert valid.all()
+
+    # Descending, as the image rows are from north to south
+    index, valid = getAxisIndexMap(0.5, 1.0, 4, 4.0, 0.0, 4)
+    assert index.tolist() == [3, 2, 1, 0]
+    assert valid.all()
+
+def test_getAxisIndexMap_edges():
+    # Pixels within half a grid box of the outer points are covered
+    index, valid = getAxisIndexMap(0.5, 1.0, 4, -0.4, 4.4, 4)
+    assert valid.all()
+
+    # Pixels centred more than half a box beyond them are not
+    index, valid = getAxisIndexMap(0.5, 1.0, 4, -1.0, 5.0, 6)
+    assert index.tolist() == [0, 0, 1, 2, 3, 3]
+    assert valid.tolist() == [False, True, True, True, True, False]
+
+def test_getAxisIndexMap_bilinear():
+    index0, index1, weight1, valid = getAxisIndexMap(0.5, 1.0, 4, 0.0, 4.0, 4,
+                                                     'bilinear')
+
+    assert index0.tolist() == [0, 1, 2, 3]
+    assert index1.tolist() == [1, 2, 3, 3]
+    assert weight1.tolist() == [0.0, 0.0, 0.0, 0.0]
+    assert valid.all()
+
+    index0, index1, weight1, valid = getAxisIndexMap(0.5, 1.0, 4, 0.0, 4.0, 8,
+                                                     'bilinear')
+    assert index0.tolist() == [0, 0, 0, 1, 1, 2, 2, 3]
+    assert weight1.tolist() == [0.0, 0.25, 0.75, 0.25, 0.75, 0.25, 0.75, 0.0]
+
+def test_resample_nearest():
+    renderer = RGBARenderer(0.0, 15.0, resampling='nearest')
+
+    value = renderer._resample(_grid(), (0.0, 0.0, 4.0, 4.0), 8, 8)
+
+    assert value.shape == (8, 8)
+    assert not N.ma.getmaskarray(value).any()
+    # The first row is the north edge of the grid
+    assert value[0].tolist() == [12, 12, 13, 13, 14, 14, 15, 15]
+    assert value[-1].tolist() == [0, 0, 1, 1, 2, 2, 3, 3]
+
+def test_resample_edges():
+    for resampling in ['nearest', 'bilinear']:
+        renderer = RGBARenderer(0.0, 15.0, resampling=resampling)
+
+        # The edge pixels fall in the outer grid boxes
+        value = renderer._resample(_grid(), (0.1, 0.1, 3.9, 3.9), 19, 19)
+        assert not N.ma.getmaskarray(value).any()
+        assert value[-1, 0] == 0.0 and value[0, -1] == 15.0
+
+        # Pixels beyond the grid are masked
+        value = renderer._resample(_grid(), (-2.0, 0.0, 4.0, 4.0), 6, 4)
+        mask = N.ma.getmaskarray(value)
+        assert mask[:, :2].all()
+        assert not mask[:, 2:].any()
+
+def test_resample_masked():
+    grid = _grid()
+    grid.value[0, 0] = N.ma.masked
+
+    for resampling in ['nearest', 'bilinear']:
+        value = RGBARenderer(0.0, 15.0, resampling)._resample(grid, (0.0, 0.0, 4.0, 4.0), 4, 4)
+        assert N.ma.getmaskarray(value).tolist()[-1] == [True, False, False, False]
@@ -0,0 +1,84 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test the request replay functions of cows.test.perf.replay
+
+"""
+
+import shutil
+import tempfile
+
+from cows.cache import LRUCache, DiskCache, TieredCache
+from cows.metrics import registerCache
+from cows.test.perf.replay import parseAccessLog, makePyramidUrls, percentile, \
+     runLoad, clearCaches
+
+_log = [
+    '127.0.0.1 - - [10/Oct/2010:13:55:36 +0100] "GET /a/wms?SERVICE=WMS&REQUEST=GetMap&LAYERS=t HTTP/1.1" 200 2326',
+    '127.0.0.1 - - [10/Oct/2010:13:55:37 +0100] "GET /a/wms?request=GetCapabilities HTTP/1.1" 200 9000',
+    '127.0.0.1 - - [10/Oct/2010:13:55:38 +0100] "GET /b/wms?request=getfeatureinfo&x=1 HTTP/1.0" 200 100 "-" "Mozilla"',
+    '127.0.0.1 - - [10/Oct/2010:13:55:39 +0100] "POST /a/wms HTTP/1.1" 200 10',
+    'garbage',
+    ]
+
+def test_parseAccessLog():
+    assert parseAccessLog(_log) == [
+        '/a/wms?SERVICE=WMS&REQUEST=GetMap&LAYERS=t',
+        '/b/wms?request=getfeatureinfo&x=1']
+    assert parseAccessLog(_log, pathPrefix='/b/') == ['/b/wms?request=getfeatureinfo&x=1']
+
+def test_makePyramidUrls():
+    urls = makePyramidUrls('/d/wms', ['t'], [0, 1])
+    assert len(urls) == 2 + 8
+    assert urls[0].startswith('/d/wms?SERVICE=WMS')
+
+def test_percentile():
+    values = range(1, 101)
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 100) == 100
+    assert percentile([3], 99) == 3
+    assert percentile([], 50) is None
+
+class _Client(object):
+    def get(self, url):
+        if url == 'bad':
+            raise IOError(url)
+        return 200, len(url)
+
+def test_runLoad():
+    result = runLoad(_Client, ['a', 'bb', 'bad'] * 10, 3)
+    assert len(result.latencies) == 30
+    assert result.statuses == {200: 20, 'exception': 10}
+    assert result.errors == 10
+    assert result.bytes == 30
+    assert 'p95' in result.format()
+
+def test_clearCaches():
+    directory = tempfile.mkdtemp()
+    caches = {'replay_memory': LRUCache(),
+              'replay_disk': DiskCache(directory),
+              'replay_tiered': TieredCache(LRUCache(), DiskCache(directory))}
+    for name in caches:
+        registerCache(name, lambda name=name: caches.get(name))
+    try:
+        for name, cache in caches.items():
+            cache.put(name, 1)
+
+        clearCaches()
+        assert caches['replay_memory'].get('replay_memory') is None
+        assert caches['replay_disk'].get('replay_disk') == 1
+        assert 'replay_tiered' not in caches['replay_tiered'].local
+        assert caches['replay_tiered'].shared.get('replay_tiered') is not None
+
+        clearCaches(shared=True)
+        assert caches['replay_disk'].get('replay_disk') is None
+        assert caches['replay_tiered'].get('replay_tiered') is None
+    finally:
+        caches.clear()
+        shutil.rmtree(directory)
@@ -0,0 +1,49 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test the request enumeration of cows.seeder
+
+"""
+
+import cgi
+
+from cows.seeder import TileSeeder
+
+def test_iterJobs():
+    seeder = TileSeeder('/test/wms', ['a', 'b'], levels=[0, 1], metaSize=2,
+                        params=[('time', '2000-01-01T00:00:00Z')])
+    jobs = list(seeder.iterJobs())
+
+    # Level 0 has 2 tiles in one metatile, level 1 has 8 in 2
+    assert len(jobs) == 6
+    assert jobs[0][0] == 'a//0/0/0'
+
+    path, query = jobs[0][1].split('?')
+    params = dict(cgi.parse_qsl(query, keep_blank_values=True))
+    assert path == '/test/wms'
+    assert params['BBOX'] == '-180.0,-90.0,0.0,90.0'
+    assert params['SRS'] == 'EPSG:4326'
+    assert params['time'] == '2000-01-01T00:00:00Z'
+
+def _getBBoxParam(url):
+    path, query = url.split('?')
+    return dict(cgi.parse_qsl(query, keep_blank_values=True))['BBOX']
+
+def test_latLonOrder():
+    seeder = TileSeeder('/test/wms', ['a'], version='1.3.0',
+                        handleLatLongCoords=True)
+    jobs = list(seeder.iterJobs())
+    assert _getBBoxParam(jobs[0][1]) == '-90.0,-180.0,90.0,0.0'
+
+    # Only 1.3.0 EPSG:4326 requests are in (lat, lon) order, and only if
+    # the server handles them
+    for kwargs in [dict(version='1.1.1', handleLatLongCoords=True),
+                   dict(version='1.3.0', handleLatLongCoords=False),
+                   dict(version='1.3.0', crs='CRS:84', handleLatLongCoords=True)]:
+        jobs = list(TileSeeder('/test/wms', ['a'], **kwargs).iterJobs())
+        assert _getBBoxParam(jobs[0][1]) == '-180.0,-90.0,0.0,90.0'
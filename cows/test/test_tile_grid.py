@@ -0,0 +1,63 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test cows.tile_grid
+
+"""
+
+from cows.tile_grid import getTileIndex, getMetaTile, iterLevelTiles, \
+    DEFAULT_EXTENTS, TILE_MATRIX_SETS
+
+def test_getTileIndex():
+    assert getTileIndex((-180, -90, -135, -45), (-180, -90)) == (0, 0)
+    assert getTileIndex((45, 0, 90, 45), (-180, -90)) == (5, 2)
+    assert getTileIndex((40, 0, 85, 45), (-180, -90)) is None
+
+def test_getMetaTile():
+    meta = getMetaTile((45, 0, 90, 45), 256, 256, 2, (-180, -90))
+
+    assert meta.index == (5, 2)
+    assert meta.bbox == (0, 0, 90, 90)
+    assert (meta.width, meta.height) == (512, 512)
+    assert sorted(meta.tiles.keys()) == [(4, 2), (4, 3), (5, 2), (5, 3)]
+
+    # Image rows start at the top
+    assert meta.tiles[(4, 3)] == ((0, 45, 45, 90), (0, 0))
+    assert meta.tiles[(5, 2)] == ((45, 0, 90, 45), (256, 256))
+
+def test_getMetaTile_buffer():
+    meta = getMetaTile((-45, -45, 0, 0), 100, 100, 2, (0, 0), buffer=10)
+
+    assert meta.index == (-1, -1)
+    assert meta.bbox == (-94.5, -94.5, 4.5, 4.5)
+    assert (meta.width, meta.height) == (220, 220)
+    assert meta.tiles[(-1, -1)][1] == (110, 10)
+
+def test_iterLevelTiles():
+    extent = DEFAULT_EXTENTS['EPSG:4326']
+
+    tiles = list(iterLevelTiles(extent, 0))
+    assert tiles == [(0, 0, (-180, -90, 0, 90)), (1, 0, (0, -90, 180, 90))]
+
+    assert len(list(iterLevelTiles(extent, 2))) == 32
+    assert len(list(iterLevelTiles(extent, 2, metaSize=2))) == 8
+    assert len(list(iterLevelTiles(extent, 2, bbox=(-10, -10, 10, 10)))) == 4
+
+def test_tileMatrixSets():
+    google = TILE_MATRIX_SETS['GoogleMapsCompatible']
+    matrix = google.getMatrix('0')
+    assert (matrix.matrixWidth, matrix.matrixHeight) == (1, 1)
+    assert abs(matrix.scaleDenominator - 559082264.0287178) < 1e-3
+    assert google.getMatrix('3').matrixWidth == 8
+
+    crs84 = TILE_MATRIX_SETS['WorldCRS84Quad']
+    matrix = crs84.getMatrix('1')
+    assert (matrix.matrixWidth, matrix.matrixHeight) == (4, 2)
+    assert matrix.getTileBBox(0, 1) == (-90, 0, 0, 90)
+    assert crs84.getLayerCRS(['EPSG:4326']) == 'EPSG:4326'
+    assert crs84.getLayerCRS(['EPSG:27700']) is None
@@ -0,0 +1,39 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test cows.timing
+
+"""
+
+from cows.timing import startTimer, setTimer, getTimer, timePhase, timed
+
+@timed('work')
+def _work(x):
+    return x * 2
+
+def test_phases():
+    timer = startTimer('WMS.GetMap')
+    try:
+        assert _work(2) == 4
+        assert _work(3) == 6
+        assert timePhase('other', lambda: 1) == 1
+    finally:
+        setTimer(None)
+
+    assert timer.phases['work'][1] == 2
+    assert timer.order == ['work', 'other']
+
+    line = timer.format()
+    assert line.startswith('op=WMS.GetMap total=')
+    assert 'work=' in line and '(2)' in line
+    assert 'other' in timer.formatDetail()
+
+def test_no_timer():
+    setTimer(None)
+    assert getTimer() is None
+    assert _work(1) == 2
@@ -0,0 +1,44 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test cows.service.imps.variable_stats
+
+"""
+
+import numpy
+
+from cows.service.imps.variable_stats import computeStats
+
+def test_computeStats():
+    stats = computeStats(numpy.ma.array([[1.0, 2.0], [3.0, 6.0]]))
+
+    assert (stats.minval, stats.maxval, stats.mean, stats.count) == (1.0, 6.0, 3.0, 4)
+
+def test_computeStats_masked():
+    variable = numpy.ma.array([1.0, 100.0, 3.0, -100.0],
+                              mask=[False, True, False, True])
+    stats = computeStats(variable)
+
+    assert (stats.minval, stats.maxval, stats.mean, stats.count) == (1.0, 3.0, 2.0, 2)
+
+def test_computeStats_nonFinite():
+    variable = numpy.ma.array([numpy.nan, 2.0, numpy.inf, 4.0, -numpy.inf],
+                              mask=[False, False, False, True, False])
+    stats = computeStats(variable)
+
+    assert (stats.minval, stats.maxval, stats.mean, stats.count) == (2.0, 2.0, 2.0, 1)
+
+    stats = computeStats(numpy.array([-numpy.inf, 5.0, numpy.nan]))
+    assert (stats.minval, stats.maxval, stats.count) == (5.0, 5.0, 1)
+
+def test_computeStats_noValidValues():
+    for variable in [numpy.ma.masked_all((3, 4)),
+                     numpy.ma.array([1.0, numpy.nan], mask=[True, False]),
+                     numpy.ma.array([])]:
+        stats = computeStats(variable)
+        assert (stats.minval, stats.maxval, stats.mean, stats.count) == (None, None, None, 0)
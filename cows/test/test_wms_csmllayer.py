@@ -0,0 +1,165 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Test the helper functions of cows.service.imps.csmlbackend.wms.wms_csmllayer
+
+"""
+
+import numpy
+
+from cows.service.imps.csmlbackend.config import config
+from cows.service.imps.pywms.render_imp import getAxisIndexMap
+from cows.service.imps.csmlbackend.wms import wms_csmllayer
+from cows.service.imps.csmlbackend.wms.wms_csmllayer import getLegendFont, \
+     formatPointSeries, CSMLwmsLayer, getSubsetIntervals
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+TIMES = ['2000-01-01T00:00:00Z', '2000-02-01T00:00:00Z', '2000-03-01T00:00:00Z']
+
+class _SeriesReader(object):
+    def getPointSeries(self, featureId, dimValues, lon, lat):
+        self.args = (featureId, dimValues, lon, lat)
+        return TIMES, [1.5, None, 3.0], 10.0, 50.5
+
+def _layer():
+    layer = CSMLwmsLayer.__new__(CSMLwmsLayer)
+    layer.title = 'temp'
+    layer.units = 'K'
+    layer.dataReader = _SeriesReader()
+    return layer
+
+def test_getLegendFont():
+    loads = []
+    def truetype(path, size):
+        loads.append((path, size))
+        return object()
+
+    oldTruetype = wms_csmllayer.ImageFont.truetype
+    oldFont = config['legendfont']
+    wms_csmllayer.ImageFont.truetype = truetype
+    config['legendfont'] = '/fonts/test_getLegendFont.ttf'
+    try:
+        font = getLegendFont(16)
+        assert getLegendFont(16) is font
+        assert getLegendFont(12) is not font
+        assert loads == [('/fonts/test_getLegendFont.ttf', 16),
+                         ('/fonts/test_getLegendFont.ttf', 12)]
+
+        # Changing the configured font loads the new one
+        config['legendfont'] = '/fonts/other.ttf'
+        assert getLegendFont(16) is not font
+        assert len(loads) == 3
+    finally:
+        wms_csmllayer.ImageFont.truetype = oldTruetype
+        config['legendfont'] = oldFont
+
+def test_formatPointSeries_csv():
+    csv = formatPointSeries('text/csv', 10.0, 50.5, TIMES, [1.5, None, 3.0], 'K')
+
+    assert csv.splitlines() == ['time,longitude,latitude,value',
+                                '2000-01-01T00:00:00Z,10.0,50.5,1.5',
+                                '2000-02-01T00:00:00Z,10.0,50.5,',
+                                '2000-03-01T00:00:00Z,10.0,50.5,3.0']
+
+def test_formatPointSeries_json():
+    series = json.loads(formatPointSeries('application/json', 10.0, 50.5,
+                                          TIMES, [1.5, None, 3.0], 'K'))
+
+    assert series == {'longitude': 10.0, 'latitude': 50.5, 'units': 'K',
+                      'times': TIMES, 'values': [1.5, None, 3.0]}
+
+def test_formatPointSeries_html():
+    html = formatPointSeries('text/html', 10.0, 50.5, TIMES, [1.5, None, 3.0], 'K')
+
+    assert 'Value (K)' in html
+    assert '<td>2000-01-01T00:00:00Z</td><td>1.5</td>' in html
+    assert '2000-02-01' not in html
+
+def test_isSeriesRequest():
+    layer = _layer()
+
+    assert layer._isSeriesRequest('text/html', {'time': '2000-01-01/2000-03-01'})
+    assert not layer._isSeriesRequest('text/html', {'time': '2000-01-01'})
+    assert not layer._isSeriesRequest('text/html', {})
+    assert layer._isSeriesRequest('text/csv', {'time': '2000-01-01'})
+    assert layer._isSeriesRequest('application/json', {})
+
+def test_getFeatureInfo_series():
+    layer = _layer()
+    dimValues = {'time': '2000-01-01/2000-03-01'}
+
+    response = layer.getFeatureInfo('application/json', 'CRS:84', (10.2, 50.4), dimValues)
+
+    assert layer.dataReader.args == ('temp', dimValues, 10.2, 50.4)
+    assert json.loads(response)['values'] == [1.5, None, 3.0]
+
+def _subsetAxis(axis, interval):
+    # The points a closed interval cdms selection returns
+    return axis[(axis >= interval[0]) & (axis <= interval[1])]
+
+def test_getSubsetIntervals():
+    assert getSubsetIntervals((0.0, 10.0, 20.0, 30.0), 1.5, 2.0) == \
+        ((8.0, 32.0), (-1.5, 21.5))
+
+    # Global requests aren't widened beyond 360 degrees of longitude
+    assert getSubsetIntervals((-180.0, -90.0, 180.0, 90.0), 1.0, 1.0) == \
+        ((-91.0, 91.0), (-180.0, 180.0))
+    assert getSubsetIntervals((-179.5, -90.0, 179.5, 90.0), 2.0, 2.0) == \
+        ((-92.0, 92.0), (-180.0, 180.0))
+
+def test_getSubsetIntervals_coverImage():
+    # A global 1 degree grid with points at the centres of the grid boxes
+    lon = numpy.arange(-179.5, 180.0, 1.0)
+    lat = numpy.arange(-89.5, 90.0, 1.0)
+
+    for bbox in [(2.6, 40.1, 5.8, 42.9), (-10.0, -10.0, 10.0, 10.0),
+                 (0.05, 0.95, 0.45, 1.05)]:
+        latInterval, lonInterval = getSubsetIntervals(bbox, 1.0, 1.0)
+        subLon = _subsetAxis(lon, lonInterval)
+        subLat = _subsetAxis(lat, latInterval)
+
+        xValid = getAxisIndexMap(subLon[0], 1.0, len(subLon), bbox[0], bbox[2], 64)[-1]
+        yValid = getAxisIndexMap(subLat[0], 1.0, len(subLat), bbox[3], bbox[1], 64)[-1]
+        assert xValid.all() and yValid.all()
+
+    # Subsetting to the bbox alone misses the box overlapping its west edge
+    subLon = _subsetAxis(lon, (2.6, 5.8))
+    xValid = getAxisIndexMap(subLon[0], 1.0, len(subLon), 2.6, 5.8, 64)[-1]
+    assert not xValid.all()
+
+class _Reader(object):
+    def __init__(self, fileoruri, lastModified):
+        self.fileoruri = fileoruri
+        self.lastModified = lastModified
+
+def _slabKey(fileoruri, name, lastModified=1000.0):
+    layer = CSMLwmsLayer.__new__(CSMLwmsLayer)
+    layer.name = name
+    layer.dataReader = _Reader(fileoruri, lastModified)
+    return layer.getCacheKey('CRS:84', '', {'time': TIMES[0]}, True, '0xFFFFFF')
+
+def test_getCacheKey():
+    key = _slabKey('a', 'temp')
+
+    assert key == _slabKey('a', 'temp')
+    assert key != _slabKey('a', 'precip')
+
+    # Slabs made before the CSML sources changed aren't used
+    assert key != _slabKey('a', 'temp', 2000.0)
+
+    # Layers of other files with the same name
+    assert key != _slabKey('b', 'temp')
+
+    layer = CSMLwmsLayer.__new__(CSMLwmsLayer)
+    layer.name = 'temp'
+    layer.dataReader = None
+    assert layer.getCacheKey('CRS:84', '', {}, True, '0xFFFFFF') != key
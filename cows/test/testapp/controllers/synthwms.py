@@ -0,0 +1,17 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+A WMS of synthetic layers used by the cows.test.perf load harness.
+
+"""
+
+from cows.pylons.wms_controller import WMSController
+from cows.test.perf.synthetic_backend import SyntheticLayerMapper
+
+class SynthwmsController(WMSController):
+    layerMapper = SyntheticLayerMapper()
@@ -21,5 +21,6 @@ def make_map():
 
     # CUSTOM ROUTES HERE
 
+    map.connect('synthetic/:fileoruri/wms', controller='synthwms')
     map.connect(':controller/:action/:id')
     return map
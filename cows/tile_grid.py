@@ -0,0 +1,311 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Regular tile grids and metatiles.
+
+Tiling clients request a map as a grid of equally sized tiles aligned to
+an origin.  A metatile is an NxN block of neighbouring tiles that is
+rendered as one image and then cut into its tiles, so the per-render
+overhead is shared and labels are placed consistently across tile edges.
+
+Bounding boxes are tuples (llx, lly, urx, ury) as in cows.bbox_util.
+
+"""
+
+import math
+
+# Default grid origins of common CRSs, in (x, y) order
+DEFAULT_ORIGINS = {
+    'EPSG:4326': (-180.0, -90.0),
+    'CRS:84': (-180.0, -90.0),
+    'EPSG:900913': (-20037508.342789244, -20037508.342789244),
+    'EPSG:3857': (-20037508.342789244, -20037508.342789244),
+    'EPSG:102100': (-20037508.342789244, -20037508.342789244),
+    }
+
+# Default extents of the tile grids of common CRSs
+DEFAULT_EXTENTS = {
+    'EPSG:4326': (-180.0, -90.0, 180.0, 90.0),
+    'CRS:84': (-180.0, -90.0, 180.0, 90.0),
+    'EPSG:900913': (-20037508.342789244, -20037508.342789244,
+                    20037508.342789244, 20037508.342789244),
+    'EPSG:3857': (-20037508.342789244, -20037508.342789244,
+                  20037508.342789244, 20037508.342789244),
+    'EPSG:102100': (-20037508.342789244, -20037508.342789244,
+                    20037508.342789244, 20037508.342789244),
+    }
+
+class MetaTile(object):
+    """
+    A block of tiles rendered as one image.
+
+    :ivar bbox: The bounding box of the whole image, including the buffer.
+    :ivar width: The width of the whole image in pixels.
+    :ivar height: The height of the whole image in pixels.
+    :ivar tiles: A dictionary mapping the (column, row) index of each tile
+        to a tuple (bbox, (x, y)) where (x, y) is the pixel offset of the
+        tile's top left corner in the image.
+    :ivar index: The (column, row) index of the requested tile.
+
+    """
+
+    def __init__(self, bbox, width, height, tiles, index):
+        self.bbox = bbox
+        self.width = width
+        self.height = height
+        self.tiles = tiles
+        self.index = index
+
+def getTileIndex(bbox, origin=(0.0, 0.0), tolerance=1e-6):
+    """
+    Find the position of a tile in the grid of tiles the same size as bbox
+    aligned to origin.
+
+    @param tolerance: The largest misalignment allowed, as a fraction of
+        the tile size.
+    :return: The (column, row) index of the tile or None if bbox is not
+        aligned to the grid.
+    """
+    tileWidth = float(bbox[2] - bbox[0])
+    tileHeight = float(bbox[3] - bbox[1])
+    if tileWidth <= 0 or tileHeight <= 0:
+        return None
+
+    x = (bbox[0] - origin[0]) / tileWidth
+    y = (bbox[1] - origin[1]) / tileHeight
+    column = int(round(x))
+    row = int(round(y))
+
+    if abs(x - column) > tolerance or abs(y - row) > tolerance:
+        return None
+
+    return column, row
+
+def getTileBBox(column, row, tileWidth, tileHeight, origin=(0.0, 0.0)):
+    """
+    Return the bounding box of a tile in a grid.
+    """
+    return (origin[0] + column * tileWidth, origin[1] + row * tileHeight,
+            origin[0] + (column + 1) * tileWidth, origin[1] + (row + 1) * tileHeight)
+
+def getMetaTile(bbox, width, height, metaSize, origin=(0.0, 0.0), buffer=0,
+                tolerance=1e-6):
+    """
+    Find the metatile containing a tile.
+
+    Metatiles are aligned to multiples of metaSize tiles from the origin so
+    every tile in a metatile maps to the same metatile.
+
+    @param bbox: The bounding box of the requested tile.
+    @param width: The width of the tile in pixels.
+    @param height: The height of the tile in pixels.
+    @param metaSize: The number of tiles along each side of the metatile.
+    @param buffer: Extra pixels rendered around the metatile and then
+        discarded, so that features near its edges are drawn the same as
+        in the neighbouring metatile.
+    :return: A MetaTile or None if bbox is not aligned to the tile grid.
+    """
+    index = getTileIndex(bbox, origin, tolerance)
+    if index is None:
+        return None
+
+    tileWidth = float(bbox[2] - bbox[0])
+    tileHeight = float(bbox[3] - bbox[1])
+
+    column0 = (index[0] // metaSize) * metaSize
+    row0 = (index[1] // metaSize) * metaSize
+
+    # Image rows run from the top of the metatile
+    tiles = {}
+    for i in range(metaSize):
+        for j in range(metaSize):
+            column, row = column0 + i, row0 + j
+            tileBBox = getTileBBox(column, row, tileWidth, tileHeight, origin)
+            offset = (buffer + i * width, buffer + (metaSize - 1 - j) * height)
+            tiles[(column, row)] = (tileBBox, offset)
+
+    # Tiles snap to the grid, keep the requested tile's bbox exactly
+    tiles[index] = (tuple(bbox), tiles[index][1])
+
+    bufferX = buffer * tileWidth / width
+    bufferY = buffer * tileHeight / height
+    llx, lly = getTileBBox(column0, row0, tileWidth, tileHeight, origin)[:2]
+    metaBBox = (llx - bufferX, lly - bufferY,
+                llx + metaSize * tileWidth + bufferX,
+                lly + metaSize * tileHeight + bufferY)
+
+    return MetaTile(metaBBox, metaSize * width + 2 * buffer,
+                    metaSize * height + 2 * buffer, tiles, index)
+
+def getLevelTileSize(extent, level):
+    """
+    Return the size of the square tiles at a zoom level of a grid over
+    extent.  Level 0 tiles are as big as the shorter side of the extent
+    and each level halves the size.
+    """
+    return min(extent[2] - extent[0], extent[3] - extent[1]) / float(2 ** level)
+
+def iterLevelTiles(extent, level, bbox=None, metaSize=1):
+    """
+    Iterate over the tiles of a zoom level of a grid over extent.  The
+    grid origin is the lower left corner of extent.
+
+    @param bbox: Only tiles intersecting this bounding box are returned.
+    @param metaSize: Only return the first tile of each metaSize x metaSize
+        block.  Rendering it fills the tile cache with the whole block.
+    :return: An iterator of tuples (column, row, bbox).
+    """
+    origin = extent[:2]
+    tileSize = getLevelTileSize(extent, level)
+
+    if bbox is None:
+        bbox = extent
+    llx, lly = max(bbox[0], extent[0]), max(bbox[1], extent[1])
+    urx, ury = min(bbox[2], extent[2]), min(bbox[3], extent[3])
+    if llx >= urx or lly >= ury:
+        return
+
+    column0 = int(math.floor((llx - origin[0]) / tileSize))
+    row0 = int(math.floor((lly - origin[1]) / tileSize))
+    column1 = int(math.ceil((urx - origin[0]) / tileSize))
+    row1 = int(math.ceil((ury - origin[1]) / tileSize))
+
+    column0 = (column0 // metaSize) * metaSize
+    row0 = (row0 // metaSize) * metaSize
+
+    for row in range(row0, row1, metaSize):
+        for column in range(column0, column1, metaSize):
+            yield column, row, getTileBBox(column, row, tileSize, tileSize, origin)
+
+#-----------------------------------------------------------------------------
+# WMTS tile matrix sets
+
+# The standardised rendering pixel size in metres
+PIXEL_SIZE = 0.00028
+
+# Metres per degree on the equator of the WGS84 ellipsoid
+METERS_PER_DEGREE = 6378137 * 2 * math.pi / 360
+
+class TileMatrix(object):
+    """
+    One zoom level of a tile matrix set.  Tiles are numbered from the top
+    left corner with rows increasing downwards.
+
+    :ivar identifier: The name of the matrix, the zoom level as a string.
+    :ivar scaleDenominator: The scale denominator at the standard pixel size.
+    :ivar topLeftCorner: The (x, y) coordinates of the top left corner.
+    :ivar tileWidth: The width of a tile in pixels.
+    :ivar tileHeight: The height of a tile in pixels.
+    :ivar matrixWidth: The number of tiles in a row.
+    :ivar matrixHeight: The number of tiles in a column.
+    :ivar resolution: The size of a pixel in CRS units.
+
+    """
+
+    def __init__(self, identifier, resolution, metersPerUnit, topLeftCorner,
+                 tileWidth, tileHeight, matrixWidth, matrixHeight):
+        self.identifier = identifier
+        self.resolution = resolution
+        self.scaleDenominator = resolution * metersPerUnit / PIXEL_SIZE
+        self.topLeftCorner = topLeftCorner
+        self.tileWidth = tileWidth
+        self.tileHeight = tileHeight
+        self.matrixWidth = matrixWidth
+        self.matrixHeight = matrixHeight
+
+    def getTileBBox(self, row, column):
+        """
+        Return the bounding box of a tile.
+
+        @raise IndexError: If the tile is outside the matrix.
+        """
+        if not (0 <= row < self.matrixHeight and 0 <= column < self.matrixWidth):
+            raise IndexError("Tile (%s, %s) outside matrix %s" %
+                             (row, column, self.identifier))
+
+        spanX = self.tileWidth * self.resolution
+        spanY = self.tileHeight * self.resolution
+        x0, y0 = self.topLeftCorner
+
+        return (x0 + column * spanX, y0 - (row + 1) * spanY,
+                x0 + (column + 1) * spanX, y0 - row * spanY)
+
+class TileMatrixSet(object):
+    """
+    A set of tile matrices, one for each zoom level.
+
+    :ivar identifier: The name of the set.
+    :ivar supportedCRS: The CRS URN advertised in WMTS capabilities.
+    :ivar crss: The CRS names of layers that can be rendered for the set,
+        in order of preference.
+    :ivar extent: The bounding box covered by the set.
+    :ivar wellKnownScaleSet: The URN of the well known scale set, or None.
+    :ivar matrices: A list of TileMatrix objects.
+
+    """
+
+    def __init__(self, identifier, supportedCRS, crss, extent, matrices,
+                 wellKnownScaleSet=None):
+        self.identifier = identifier
+        self.supportedCRS = supportedCRS
+        self.crss = crss
+        self.extent = extent
+        self.matrices = matrices
+        self.wellKnownScaleSet = wellKnownScaleSet
+
+    def getMatrix(self, identifier):
+        """
+        Return the TileMatrix with the given identifier or None.
+        """
+        for matrix in self.matrices:
+            if matrix.identifier == identifier:
+                return matrix
+        return None
+
+    def getLayerCRS(self, layerCRSs):
+        """
+        Return the CRS a layer supporting layerCRSs should be rendered in
+        for this set, or None if the layer can't be rendered.
+        """
+        for crs in self.crss:
+            if crs in layerCRSs:
+                return crs
+        return None
+
+def makeQuadTileMatrixSet(identifier, supportedCRS, crss, extent, metersPerUnit,
+                          levels, tileSize=256, wellKnownScaleSet=None):
+    """
+    Create a TileMatrixSet where each level splits every tile of the level
+    above into four.  Level 0 tiles are as big as the shorter side of
+    extent, as in iterLevelTiles().
+    """
+    tileSpan0 = getLevelTileSize(extent, 0)
+    columns0 = int(round((extent[2] - extent[0]) / tileSpan0))
+    rows0 = int(round((extent[3] - extent[1]) / tileSpan0))
+
+    matrices = []
+    for level in range(levels + 1):
+        matrices.append(TileMatrix(str(level), tileSpan0 / tileSize / 2 ** level,
+                                   metersPerUnit, (extent[0], extent[3]),
+                                   tileSize, tileSize,
+                                   columns0 * 2 ** level, rows0 * 2 ** level))
+
+    return TileMatrixSet(identifier, supportedCRS, crss, extent, matrices,
+                         wellKnownScaleSet)
+
+# The standard WMTS tile matrix sets
+TILE_MATRIX_SETS = {
+    'WorldCRS84Quad': makeQuadTileMatrixSet(
+        'WorldCRS84Quad', 'urn:ogc:def:crs:OGC:1.3:CRS84',
+        ['CRS:84', 'EPSG:4326'], DEFAULT_EXTENTS['CRS:84'],
+        METERS_PER_DEGREE, 17),
+    'GoogleMapsCompatible': makeQuadTileMatrixSet(
+        'GoogleMapsCompatible', 'urn:ogc:def:crs:EPSG:6.18:3:3857',
+        ['EPSG:3857', 'EPSG:900913', 'EPSG:102100'], DEFAULT_EXTENTS['EPSG:3857'],
+        1.0, 18, wellKnownScaleSet='urn:ogc:def:wkss:OGC:1.0:GoogleMapsCompatible'),
+    }
@@ -0,0 +1,163 @@
+# BSD Licence
+# Copyright (c) 2010, Science & Technology Facilities Council (STFC)
+# All rights reserved.
+#
+# See the LICENSE file in the source distribution of this software for
+# the full license text.
+
+"""
+Timing of the phases of a request.
+
+A RequestTimer is started for each OWS request and made current in the
+thread handling it.  Code anywhere in COWS marks phases with the
+:func:`timed` decorator or :func:`timePhase`, which are cheap no-ops when
+no timer is current.  Phase times are inclusive, so an extraction done
+while building a slab counts towards both, and phases run concurrently in
+several threads are summed.
+
+This module must not reference pylons.
+
+"""
+
+import time
+import threading
+
+_current = threading.local()
+
+class RequestTimer(object):
+    """
+    Accumulates the time spent in named phases of one request.
+
+    :ivar name: The operation being timed, e.g. 'WMS.GetMap'.
+    :ivar start: The time the request started.
+    :ivar end: The time the request finished or None.
+    :ivar phases: A dictionary mapping phase names to [seconds, count].
+    :ivar order: Phase names in the order they were first entered.
+    :ivar info: Other key/value pairs to report with the timings.
+
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.start = time.time()
+        self.end = None
+        self.phases = {}
+        self.order = []
+        self.info = {}
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        self._lock.acquire()
+        try:
+            if phase in self.phases:
+                self.phases[phase][0] += seconds
+                self.phases[phase][1] += 1
+            else:
+                self.phases[phase] = [seconds, 1]
+                self.order.append(phase)
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        if self.end is None:
+            self.end = time.time()
+
+    def getTotal(self):
+        if self.end is None:
+            return time.time() - self.start
+        return self.end - self.start
+
+    def format(self):
+        """
+        Return a single line of key=value pairs describing the request.
+        Phases entered more than once are followed by their count in
+        brackets.
+        """
+        items = ['op=%s' % self.name, 'total=%.4f' % self.getTotal()]
+
+        self._lock.acquire()
+        try:
+            for phase in self.order:
+                seconds, count = self.phases[phase]
+                if count == 1:
+                    items.append('%s=%.4f' % (phase, seconds))
+                else:
+                    items.append('%s=%.4f(%d)' % (phase, seconds, count))
+        finally:
+            self._lock.release()
+
+        for k, v in sorted(self.info.items()):
+            items.append('%s=%s' % (k, v))
+
+        return ' '.join(items)
+
+    def formatDetail(self):
+        """
+        Return a multi-line report of the request for the slow request log.
+        """
+        lines = ['%s took %.4fs, started %s' %
+                 (self.name, self.getTotal(),
+                  time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start)))]
+
+        for k, v in sorted(self.info.items()):
+            lines.append('  %s: %s' % (k, v))
+
+        self._lock.acquire()
+        try:
+            for phase in self.order:
+                seconds, count = self.phases[phase]
+                lines.append('  %-16s %9.4fs %5d calls %6.1f%%' %
+                             (phase, seconds, count,
+                              100.0 * seconds / max(self.getTotal(), 1e-9)))
+        finally:
+            self._lock.release()
+
+        return '\n'.join(lines)
+
+def getTimer():
+    """
+    Return the RequestTimer current in this thread or None.
+    """
+    return getattr(_current, 'timer', None)
+
+def setTimer(timer):
+    """
+    Make timer current in this thread.  Worker threads doing part of a
+    request should set the request's timer.
+    """
+    _current.timer = timer
+
+def startTimer(name=None):
+    """
+    Start a new RequestTimer and make it current in this thread.
+    """
+    timer = RequestTimer(name)
+    setTimer(timer)
+    return timer
+
+def timePhase(phase, func, *args, **kwargs):
+    """
+    Call func(*args, **kwargs), adding its duration to the current timer
+    under the given phase name.
+    """
+    timer = getTimer()
+    if timer is None:
+        return func(*args, **kwargs)
+
+    t0 = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        timer.add(phase, time.time() - t0)
+
+def timed(phase):
+    """
+    Decorator timing every call of a function as the given phase.
+    """
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            return timePhase(phase, func, *args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
@@ -59,13 +59,54 @@ def negotiate_version(serverVersions, clientVersion=None):
 
 
 def check_updatesequence(clientUpdateSequence, serverUpdateSequence):
+    """
+    Compare the updateSequence sent by a client with the server's, raising
+    CurrentUpdateSequence if they are equal and InvalidUpdateSequence if
+    the client's is greater.  Sequences of digits are compared as numbers.
+
+    """
     if clientUpdateSequence and serverUpdateSequence:
-        if client_updatesequence == serverUpdateSequence:
-            raise OWS_E.CurrentUpdateSequence
-        elif client_updatesequence > serverUpdateSequence:
-            raise OWS_E.InvalidUpdateSequence
+        client = str(clientUpdateSequence)
+        server = str(serverUpdateSequence)
+        if client.isdigit() and server.isdigit():
+            client, server = int(client), int(server)
+            
+        if client == server:
+            raise OWS_E.CurrentUpdateSequence('updateSequence %s is current' % serverUpdateSequence,
+                                              'updatesequence')
+        elif client > server:
+            raise OWS_E.InvalidUpdateSequence('updateSequence is greater than the current value %s' 
+                                              % serverUpdateSequence, 'updatesequence')
     
-                     
+
+def index_layer_names(layers, fileoruri=None):
+    """
+    Build a mapping from every name a WMS layer can be requested by to the
+    layer.  These are the keys of the layer map and, if fileoruri is
+    given, the names of every layer in the tree made of the fileoruri and
+    the titles of the layer and its ancestors joined by '_'.  Where names
+    collide the layer found first by a depth first search wins, as when
+    the tree used to be searched for each request.
+
+    @param layers: The layer map, a mapping of names to IwmsLayers.
+    @param fileoruri: The fileoruri the layer map was made for.
+
+    """
+    index = {}
+    if fileoruri is not None:
+        _index_layer_children(index, fileoruri + "_", layers.values())
+    index.update(layers)
+
+    return index
+
+def _index_layer_children(index, prefix, layerList):
+    for l in layerList:
+        name = prefix + l.title
+        if name not in index:
+            index[name] = l
+
+        if getattr(l, 'childLayers', None):
+            _index_layer_children(index, name + "_", l.childLayers)
 
 #-----------------------------------------------------------------------------
 
@@ -81,3 +122,72 @@ def test_version_negotiation4():
 def test_version_negotiation5():
     assert negotiate_version(_test_versions, '1.2') == (1,1,1)
 
+def test_updatesequence_current():
+    try:
+        check_updatesequence('10', '10')
+    except OWS_E.CurrentUpdateSequence:
+        pass
+    else:
+        assert False
+def test_updatesequence_invalid():
+    try:
+        check_updatesequence('100', '99')
+    except OWS_E.InvalidUpdateSequence:
+        pass
+    else:
+        assert False
+def test_updatesequence_old():
+    check_updatesequence('99', '100')
+    check_updatesequence(None, '100')
+
+class _TestLayer(object):
+    def __init__(self, title, childLayers=()):
+        self.title = title
+        self.childLayers = list(childLayers)
+
+def _search_layer_children(layerList, name):
+    # How child layers used to be found
+    for l in layerList:
+        if l.title == name:
+            return l
+        if name.find(l.title + "_") == 0:
+            found = _search_layer_children(l.childLayers, name[len(l.title + "_"):])
+            if found is not None:
+                return found
+    return None
+
+def _names(prefix, layerList):
+    for l in layerList:
+        yield prefix + l.title
+        for name in _names(prefix + l.title + "_", l.childLayers):
+            yield name
+
+def test_index_layer_names():
+    temp = _TestLayer('temp')
+    a_b = _TestLayer('b', [_TestLayer('c')])
+    layers = {'a': _TestLayer('a', [a_b, _TestLayer('b_c'), temp]),
+              'a_b': _TestLayer('a_b', [_TestLayer('c')]),
+              'x': _TestLayer('x')}
+
+    index = index_layer_names(layers, 'data')
+
+    assert index['a'] is layers['a']
+    assert index['data_a_temp'] is temp
+    assert index['data_a_b'] is a_b
+    assert 'a_temp' not in index and 'data' not in index
+
+    # Colliding names find the same layer as the old search
+    names = list(_names('data_', layers.values())) + list(layers.keys()) + \
+            ['data_a_c', 'data_', 'data_a_']
+    for name in names:
+        if name in layers:
+            expected = layers[name]
+        elif name.find('data_') == 0:
+            expected = _search_layer_children(layers.values(), name[len('data_'):])
+        else:
+            expected = None
+        assert index.get(name) is expected, name
+
+def test_index_layer_names_no_fileoruri():
+    layers = {'a': _TestLayer('a', [_TestLayer('b')])}
+    assert index_layer_names(layers) == layers
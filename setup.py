@@ -48,6 +48,10 @@ setup(
         [paste.paster_create_template]
         cows_server=cows.pylons.project_templates:CowsServer
 
+        [console_scripts]
+        cows-seed = cows.seeder:main
+        cows-profile-report = cows.profiling:main
+
     """,
     test_suite='nose.collector',
     )